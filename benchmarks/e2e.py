@@ -0,0 +1,430 @@
+"""
+End-to-end load and latency benchmark of the lambda handlers.
+
+Runs the real handlers (classifier, retriever, response, ask and index data)
+against the deterministic stand-ins of benchmarks/stubs.py, with synthetic API
+Gateway and S3 events. Every worker process plays one Lambda container: its
+first invocation, module import included, is a cold start and the following
+ones are warm. Reports cold and warm p50/p95/p99, throughput and how much of
+each warm invocation went to every backend stage.
+
+Needs the layer dependencies (powertools, langchain, opensearch-py, numpy)
+but no AWS account or network.
+
+    python benchmarks/e2e.py --workloads classify retrieve respond --requests 200 --concurrency 4
+    python benchmarks/e2e.py --save-baseline main
+    python benchmarks/e2e.py --baseline main --tolerance 0.2
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+LAYER = os.path.join(ROOT, "layers", "utils_layer", "python")
+LAMBDAS = os.path.join(ROOT, "lambdas")
+CORPUS_DIR = os.path.join(ROOT, "data", "s3_copy")
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(BENCHMARKS, "baselines")
+QUERIES_FILE = os.path.join(BENCHMARKS, "queries.txt")
+
+# Workload: (lambda folder, module, API route, None for S3 events)
+WORKLOADS = {
+    "classify": ("classification_lambda", "classify_lambda", "/api/classifier"),
+    "retrieve": ("retrieval_lambda", "retrieval_lambda", "/api/retriever"),
+    "respond": ("response_lambda", "generate_response_lambda", "/api/response"),
+    "ask": ("ask_lambda", "ask_lambda", "/api/ask"),
+    "index": ("index_data_lambda", "index_data_lambda", None),
+}
+
+COMPANIES = ["amazon", "google"]
+CHUNK_SIZES = {"small": 500, "medium": 2000, "large": 8000}
+
+ENVIRONMENT = {
+    "OPENSEARCH_ENDPOINT": "opensearch.local",
+    "REGION": "us-east-1",
+    "BEDROCK_REGION": "us-east-1",
+    "BEDROCK_TEXT_MODEL_ID": "anthropic.claude-v2",
+    "BEDROCK_EMBEDDING_MODEL_ID": "amazon.titan-embed-text-v1",
+    "BUCKET": "benchmark",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "POWERTOOLS_TRACE_DISABLED": "true",
+    "POWERTOOLS_LOG_LEVEL": "WARNING",
+    "LOG_LEVEL": "WARNING",
+}
+
+
+class LambdaContext:
+    function_name = "benchmark"
+    function_version = "$LATEST"
+    invoked_function_arn = "arn:aws:lambda:us-east-1:000000000000:function:benchmark"
+    memory_limit_in_mb = 1024
+    log_group_name = "/aws/lambda/benchmark"
+    log_stream_name = "benchmark"
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def api_event(route, payload):
+    request_id = str(uuid.uuid4())
+    return {
+        "version": "2.0",
+        "routeKey": f"POST {route}",
+        "rawPath": route,
+        "rawQueryString": "",
+        "headers": {"content-type": "application/json"},
+        "requestContext": {
+            "accountId": "000000000000",
+            "apiId": "benchmark",
+            "domainName": "benchmark.local",
+            "http": {"method": "POST", "path": route, "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1", "userAgent": "benchmark"},
+            "requestId": request_id,
+            "routeKey": f"POST {route}",
+            "stage": "$default",
+            "time": "",
+            "timeEpoch": 0,
+        },
+        # The web app stringifies bodies that Amplify encodes again
+        "body": json.dumps(json.dumps(payload)),
+        "isBase64Encoded": False,
+    }
+
+
+def s3_event(bucket, key, size):
+    return {
+        "Records": [
+            {
+                "eventVersion": "2.1",
+                "eventSource": "aws:s3",
+                "awsRegion": "us-east-1",
+                "eventTime": "1970-01-01T00:00:00.000Z",
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "s3SchemaVersion": "1.0",
+                    "bucket": {"name": bucket, "arn": f"arn:aws:s3:::{bucket}"},
+                    "object": {"key": key, "size": size},
+                },
+            }
+        ]
+    }
+
+
+def corpus_files():
+    files = {}
+    for folder in sorted(os.listdir(CORPUS_DIR)):
+        for name in sorted(os.listdir(os.path.join(CORPUS_DIR, folder))):
+            files[f"{folder}/{name}"] = os.path.join(CORPUS_DIR, folder, name)
+    return files
+
+
+def split_text(text, size):
+    chunks, current = [], ""
+    for paragraph in text.split("\n"):
+        if current and len(current) + len(paragraph) + 1 > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def seed_opensearch(opensearch, hashed_embedding):
+    """Chunk indices for every size and the performance indices, like the restored snapshot."""
+    files = corpus_files()
+    for key, path in files.items():
+        index_name, _ = key.split("/", 1)
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        if index_name.endswith("_performance"):
+            chunks = [text]
+        else:
+            chunks = split_text(text, CHUNK_SIZES[index_name.split("_")[1]])
+        opensearch.load(index_name, [
+            (f"{key}#{i}", {"vector_field": hashed_embedding(chunk), "text": chunk, "url": f"s3://benchmark/{key}"})
+            for i, chunk in enumerate(chunks)
+        ])
+        opensearch.indices_data[index_name]["mappings"] = {
+            "properties": {"url": {"type": "text", "fields": {"keyword": {"type": "keyword"}}}}
+        }
+
+
+def company_of(question):
+    text = question.lower()
+    return "google" if any(word in text for word in ("google", "alphabet", "youtube", "pichai")) else "amazon"
+
+
+def build_requests(workload, count, questions, opensearch_chunks):
+    requests = []
+    files = [key for key in corpus_files() if not key.split("/")[0].endswith("_performance")]
+    for n in range(count):
+        question = questions[n % len(questions)]
+        company = company_of(question)
+        if workload == "classify" or workload == "ask":
+            payload = {"message": question}
+        elif workload == "retrieve":
+            payload = {"message": question, "index": company, "companies": COMPANIES}
+        elif workload == "respond":
+            payload = {"message": question, "index": company, "response": opensearch_chunks[company]}
+        else:
+            # A new key per request so incremental indexing cannot skip the document
+            source = files[n % len(files)]
+            folder, name = source.split("/", 1)
+            payload = {"key": f"{folder}/benchmark-{n}-{name}", "source": source}
+        requests.append(payload)
+    return requests
+
+
+def sample_chunks():
+    chunks = {}
+    for company in COMPANIES:
+        folder = os.path.join(CORPUS_DIR, f"{company}_medium_index")
+        with open(os.path.join(folder, sorted(os.listdir(folder))[0]), encoding="utf-8") as f:
+            texts = split_text(f.read(), CHUNK_SIZES["medium"])[:3]
+        chunks[company] = [{"page_content": text, "metadata": {}} for text in texts]
+    return chunks
+
+
+def run_worker(job):
+    """One Lambda container: import (cold), then invoke every request in turn."""
+    os.environ.update(job["environment"])
+    sys.path[:0] = [LAYER, os.path.join(LAMBDAS, job["folder"])]
+
+    start = time.perf_counter()
+    module = importlib.import_module(job["module"])
+    init_ms = (time.perf_counter() - start) * 1000
+
+    # Imported after the handler so its cold import is not warmed up by the harness
+    import stubs
+    from assistant_utils.clients import registry
+
+    recorder = stubs.StageRecorder()
+    latency = stubs.Latency(job["latency"], job["jitter"], job["seed"], recorder)
+    bedrock = stubs.StubBedrock(latency, job["answer_tokens"])
+    opensearch = stubs.StubOpenSearch(latency)
+    seed_opensearch(opensearch, stubs.hashed_embedding)
+    s3 = stubs.StubS3(latency, corpus_files())
+
+    registry.credentials()
+    registry._clients[("bedrock-runtime", os.environ["BEDROCK_REGION"])] = bedrock
+    registry._clients[("s3", None)] = s3
+    registry._clients["opensearch"] = opensearch
+    registry._clients["search"] = opensearch
+    for name in ("retrieval_lambda", job["module"]):
+        handler_module = sys.modules.get(name)
+        if handler_module is not None:
+            # Stands in for the bedrock_client the workshop asks to create in the retriever
+            handler_module.bedrock_client = bedrock
+            for attribute, client in (("opensearch", opensearch), ("s3", s3)):
+                if hasattr(handler_module, attribute):
+                    setattr(handler_module, attribute, client)
+
+    samples = []
+    for n, payload in enumerate(job["requests"]):
+        if job["route"] is None:
+            s3.files[payload["key"]] = s3.files[payload["source"]]
+            event = s3_event("benchmark", payload["key"], os.path.getsize(s3.files[payload["source"]]))
+        else:
+            event = api_event(job["route"], payload)
+        recorder.reset()
+        started_at = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            response = module.lambda_handler(event, LambdaContext())
+            if isinstance(response, dict) and response.get("statusCode", 200) >= 400:
+                error = f"status {response['statusCode']}"
+        except Exception as e:
+            error = repr(e)
+        ms = (time.perf_counter() - start) * 1000
+        samples.append({
+            "ms": ms + (init_ms if n == 0 else 0),
+            "cold": n == 0,
+            "started_at": started_at,
+            "ended_at": time.time(),
+            "stages": recorder.snapshot(),
+            "error": error,
+        })
+    return {"init_ms": init_ms, "samples": samples}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))], 2)
+
+
+def summarize(workload, results):
+    samples = [sample for result in results for sample in result["samples"]]
+    cold = [sample["ms"] for sample in samples if sample["cold"]]
+    warm_samples = [sample for sample in samples if not sample["cold"]]
+    warm = [sample["ms"] for sample in warm_samples]
+    summary = {
+        "workload": workload,
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if sample["error"]),
+        "init_ms_p50": percentile([result["init_ms"] for result in results], 50),
+        "cold_p50_ms": percentile(cold, 50),
+        "cold_p95_ms": percentile(cold, 95),
+        "cold_p99_ms": percentile(cold, 99),
+        "warm_p50_ms": percentile(warm, 50),
+        "warm_p95_ms": percentile(warm, 95),
+        "warm_p99_ms": percentile(warm, 99),
+        "throughput_rps": None,
+        "stages_ms": {},
+    }
+    if warm_samples:
+        window = max(sample["ended_at"] for sample in warm_samples) - min(sample["started_at"] for sample in warm_samples)
+        summary["throughput_rps"] = round(len(warm_samples) / window, 2) if window > 0 else None
+        stages = {}
+        for sample in warm_samples:
+            for stage, value in sample["stages"].items():
+                stages[stage] = stages.get(stage, 0.0) + value["ms"]
+        breakdown = {stage: round(total / len(warm_samples), 2) for stage, total in sorted(stages.items())}
+        # Stages can overlap when a handler calls backends in parallel, so this is a lower bound
+        breakdown["handler"] = round(max(0.0, sum(warm) / len(warm) - sum(breakdown.values())), 2)
+        summary["stages_ms"] = breakdown
+    first_error = next((sample["error"] for sample in samples if sample["error"]), None)
+    if first_error:
+        summary["first_error"] = first_error
+    return summary
+
+
+def run_workload(workload, args, questions, chunks, latency):
+    folder, module, route = WORKLOADS[workload]
+    environment = {**ENVIRONMENT, **args.env}
+    if args.no_cache:
+        environment.update({"QUERY_CACHE_SIZE": "0", "ANSWER_CACHE_THRESHOLD": "2"})
+    requests = build_requests(workload, args.requests, questions, chunks)
+    jobs = []
+    for worker in range(args.concurrency):
+        jobs.append({
+            "folder": folder,
+            "module": module,
+            "route": route,
+            "requests": requests[worker::args.concurrency],
+            "environment": environment,
+            "latency": latency,
+            "jitter": args.jitter,
+            "seed": args.seed + worker,
+            "answer_tokens": args.answer_tokens,
+        })
+    # Extra containers that only serve one request, to sample more cold starts
+    for extra in range(max(0, args.cold_starts - args.concurrency)):
+        jobs.append({**jobs[0], "requests": requests[extra % len(requests):][:1], "seed": args.seed + args.concurrency + extra})
+    jobs = [job for job in jobs if job["requests"]]
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(len(jobs), initializer=sys.path.insert, initargs=(0, BENCHMARKS)) as pool:
+        results = pool.map(run_worker, jobs)
+    return summarize(workload, results)
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of the latency percentiles and throughput against ``baseline``."""
+    regressions = []
+    previous = {result["workload"]: result for result in baseline["results"]}
+    for result in results:
+        before = previous.get(result["workload"])
+        if before is None:
+            continue
+        for metric in ("cold_p95_ms", "warm_p50_ms", "warm_p95_ms", "warm_p99_ms"):
+            if result[metric] is not None and before.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{result['workload']} {metric}: {before[metric]} -> {result[metric]}")
+        if result["throughput_rps"] and before.get("throughput_rps") and \
+                result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{result['workload']} throughput_rps: {before['throughput_rps']} -> {result['throughput_rps']}")
+    return regressions
+
+
+def key_values(items, cast=str):
+    values = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        values[key] = cast(value)
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lambda handlers against local stand-ins")
+    parser.add_argument("--workloads", nargs="+", default=["classify", "retrieve", "respond", "index"], choices=list(WORKLOADS))
+    parser.add_argument("--requests", type=int, default=100, help="requests per workload")
+    parser.add_argument("--concurrency", type=int, default=2, help="worker processes, one per simulated container")
+    parser.add_argument("--cold-starts", type=int, default=0, help="minimum number of cold starts to sample")
+    parser.add_argument("--latency", nargs="*", default=[], metavar="STAGE=MS",
+                        help="backend latency, stages: " + ", ".join(sorted(__import__("stubs").DEFAULT_LATENCY)))
+    parser.add_argument("--no-latency", action="store_true", help="measure the handlers alone")
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative jitter of the latencies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--no-cache", action="store_true", help="disable the query and answer caches")
+    parser.add_argument("--env", nargs="*", default=[], metavar="NAME=VALUE", help="extra lambda environment")
+    parser.add_argument("--queries", default=QUERIES_FILE)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store the results as benchmarks/baselines/NAME.json")
+    parser.add_argument("--baseline", metavar="NAME", help="fail when results regress against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+    args.env = key_values(args.env)
+
+    import stubs
+
+    latency = {stage: 0 for stage in stubs.DEFAULT_LATENCY} if args.no_latency else {}
+    latency.update(key_values(args.latency, float))
+    with open(args.queries, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    chunks = sample_chunks()
+
+    results = []
+    for workload in args.workloads:
+        print(f"Running {workload}: {args.requests} requests, concurrency {args.concurrency}")
+        results.append(run_workload(workload, args, questions, chunks, latency))
+
+    columns = ["workload", "requests", "errors", "cold_p50_ms", "cold_p99_ms", "warm_p50_ms", "warm_p95_ms",
+               "warm_p99_ms", "throughput_rps"]
+    print("  ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>14}" for column in columns))
+    for result in results:
+        stages = ", ".join(f"{stage} {ms}" for stage, ms in result["stages_ms"].items())
+        print(f"{result['workload']} warm ms per stage: {stages}")
+        if "first_error" in result:
+            print(f"{result['workload']} first error: {result['first_error']}")
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "save_baseline", "baseline")},
+        "latency": {**stubs.DEFAULT_LATENCY, **latency},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, f"{args.save_baseline}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(os.path.join(BASELINES, f"{args.baseline}.json")) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, BENCHMARKS)
+    sys.path.insert(0, LAYER)
+    main()
@@ -0,0 +1,128 @@
+"""
+Import-time profile of the request path lambdas.
+
+Imports every handler module in a fresh interpreter with ``python -X importtime``,
+followed by the modules its first request loads lazily, once for the lean
+runtime (LEAN_RUNTIME=true) and once for the langchain/opensearch-py one.
+Reports the total and the slowest top-level packages of each.
+
+Run it after the utils layer is built (pip install -t layers/utils_layer/python),
+with aws-lambda-powertools installed, e.g. from build.py --import-profile.
+
+    python benchmarks/import_profile.py --output import_profile.json
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER = os.path.join(ROOT, "layers", "utils_layer", "python")
+LAMBDAS = os.path.join(ROOT, "lambdas")
+
+HANDLERS = {
+    "classification": ("classification_lambda", "classify_lambda"),
+    "retriever": ("retrieval_lambda", "retrieval_lambda"),
+    "response": ("response_lambda", "generate_response_lambda"),
+}
+
+# Modules the first request imports in each mode
+FIRST_REQUEST_IMPORTS = {
+    "lean": ["assistant_utils.embeddings", "assistant_utils.bedrock", "assistant_utils.signed_search"],
+    "full": ["langchain_community.embeddings", "langchain_community.llms", "opensearchpy"],
+}
+
+ENVIRONMENT = {
+    "OPENSEARCH_ENDPOINT": "opensearch.local",
+    "REGION": "us-east-1",
+    "BEDROCK_REGION": "us-east-1",
+    "BEDROCK_TEXT_MODEL_ID": "anthropic.claude-v2",
+    "BEDROCK_EMBEDDING_MODEL_ID": "amazon.titan-embed-text-v1",
+    "AWS_ACCESS_KEY_ID": "profile",
+    "AWS_SECRET_ACCESS_KEY": "profile",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "POWERTOOLS_TRACE_DISABLED": "true",
+}
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def parse_importtime(stderr):
+    """(module, self us, cumulative us, depth) for every line of -X importtime."""
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            entries.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return entries
+
+
+def profile(folder, module, mode, top):
+    statements = [f"import {module}"] + [f"import {name}" for name in FIRST_REQUEST_IMPORTS[mode]]
+    env = {
+        **os.environ,
+        **ENVIRONMENT,
+        "LEAN_RUNTIME": "true" if mode == "lean" else "false",
+        "PYTHONPATH": os.pathsep.join(filter(None, [LAYER, os.path.join(LAMBDAS, folder), os.environ.get("PYTHONPATH")])),
+    }
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "; ".join(statements)],
+        env=env,
+        capture_output=True,
+        text=True,
+    )  # nosec B603
+    entries = parse_importtime(proc.stderr)
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed"}
+    roots = [entry for entry in entries if entry[3] == 0]
+    # Top-level imports listed before the handler are interpreter startup (site, encodings)
+    position = next(i for i, entry in enumerate(roots) if entry[0] == module)
+    roots = roots[position:]
+    handler_ms = roots[0][2] / 1000
+    total_ms = sum(cumulative for _, _, cumulative, _ in roots) / 1000
+    slowest = sorted(roots, key=lambda entry: entry[2], reverse=True)[:top]
+    return {
+        "handler_import_ms": round(handler_ms, 1),
+        "first_request_imports_ms": round(total_ms - handler_ms, 1),
+        "total_ms": round(total_ms, 1),
+        "slowest": [{"module": name, "cumulative_ms": round(cumulative / 1000, 1)} for name, _, cumulative, _ in slowest],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile of the request path lambdas")
+    parser.add_argument("--handlers", nargs="+", default=list(HANDLERS), choices=list(HANDLERS))
+    parser.add_argument("--modes", nargs="+", default=["lean", "full"], choices=list(FIRST_REQUEST_IMPORTS))
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to list")
+    parser.add_argument("--output", help="write the profile as JSON to this file")
+    args = parser.parse_args()
+
+    report = {}
+    failed = False
+    for handler in args.handlers:
+        folder, module = HANDLERS[handler]
+        for mode in args.modes:
+            result = profile(folder, module, mode, args.top)
+            report.setdefault(handler, {})[mode] = result
+            if "error" in result:
+                failed = True
+                print(f"{handler} ({mode}): {result['error']}")
+                continue
+            print(
+                f"{handler} ({mode}): {result['total_ms']} ms, handler import {result['handler_import_ms']} ms, "
+                f"first request imports {result['first_request_imports_ms']} ms"
+            )
+            for entry in result["slowest"]:
+                print(f"    {entry['cumulative_ms']:>8} ms  {entry['module']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Recall and latency of the k-NN index profiles on the shipped corpora.
+
+Chunks the documents under data/s3_copy, embeds them with Bedrock (vectors are
+cached on disk so reruns are free), loads them into one index per profile and
+replays a query set against each index. Exact nearest neighbours computed
+locally are the ground truth for recall@k.
+
+Requires OPENSEARCH_ENDPOINT, REGION, BEDROCK_REGION and
+BEDROCK_EMBEDDING_MODEL_ID, and network access to the OpenSearch domain.
+
+    python benchmarks/index_profiles.py --profiles nmslib_hnsw faiss_hnsw faiss_hnsw_fp16 --ef-search 32 100 512
+    python benchmarks/index_profiles.py --train-for amazon_small_index --profiles faiss_ivf
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "layers", "utils_layer", "python"))
+
+from assistant_utils.bulk import BulkIndexer  # noqa: E402
+from assistant_utils.clients import registry  # noqa: E402
+from assistant_utils.embeddings import BatchEmbedder  # noqa: E402
+from assistant_utils.index_profiles import (  # noqa: E402
+    INDEX_PROFILES,
+    get_profile,
+    index_body,
+    model_id_for,
+    train_model,
+    with_ef_search,
+)
+from assistant_utils.search import knn_query  # noqa: E402
+
+CORPUS_DIR = os.path.join(ROOT, "data", "s3_copy")
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.txt")
+
+
+def load_chunks(corpora, chunk_size):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0, length_function=len)
+    chunks = []
+    for corpus in corpora:
+        folder = os.path.join(CORPUS_DIR, corpus)
+        for name in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, name), encoding="utf-8") as f:
+                for text in splitter.split_text(f.read()):
+                    chunks.append({"text": text, "url": f"{corpus}/{name}"})
+    return chunks
+
+
+def cached_embeddings(texts, embed, cache_file):
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    keys = [hashlib.md5(text.encode()).hexdigest() for text in texts]
+    missing = [text for key, text in zip(keys, texts) if key not in cache]
+    if missing:
+        print(f"Embedding {len(missing)} texts")
+        for text, vector in zip(missing, embed(missing)):
+            cache[hashlib.md5(text.encode()).hexdigest()] = vector
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+    return [cache[key] for key in keys]
+
+
+def exact_neighbours(query_vector, vectors, k):
+    distances = [(sum((a - b) ** 2 for a, b in zip(query_vector, vector)), i) for i, vector in enumerate(vectors)]
+    return [i for _, i in sorted(distances)[:k]]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def graph_memory_kb(opensearch):
+    stats = opensearch.transport.perform_request("GET", "/_plugins/_knn/stats")
+    return sum(node.get("graph_memory_usage", 0) for node in stats["nodes"].values())
+
+
+def load_index(opensearch, index_name, body, chunks, vectors):
+    opensearch.indices.delete(index=index_name, ignore=[404])
+    opensearch.indices.create(index=index_name, body=body)
+    with BulkIndexer(opensearch, index_name) as indexer:
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors)):
+            indexer.add(str(i), {"vector_field": vector, "text": chunk["text"], "url": chunk["url"]})
+    opensearch.indices.refresh(index=index_name)
+    return indexer.stats()
+
+
+def run_profile(opensearch, name, profile, dimension, chunks, vectors, queries, truth, k, repeat, model_id=None):
+    index_name = f"bench_{name}".lower()
+    load_start = time.perf_counter()
+    load_stats = load_index(opensearch, index_name, index_body(profile, dimension, model_id=model_id), chunks, vectors)
+    load_s = time.perf_counter() - load_start
+
+    memory_before = graph_memory_kb(opensearch)
+    # Loads the native graphs into memory so the first queries are not measured cold
+    opensearch.transport.perform_request("GET", f"/_plugins/_knn/warmup/{index_name}")
+    memory_kb = graph_memory_kb(opensearch) - memory_before
+    store = opensearch.indices.stats(index=index_name)["_all"]["primaries"]["store"]["size_in_bytes"]
+
+    latencies = []
+    took = []
+    recalls = []
+    for _ in range(repeat):
+        for query_vector, expected in zip(queries, truth):
+            start = time.perf_counter()
+            response = opensearch.search(index=index_name, body=knn_query(query_vector, k))
+            latencies.append((time.perf_counter() - start) * 1000)
+            took.append(response["took"])
+            found = {int(hit["_id"]) for hit in response["hits"]["hits"]}
+            recalls.append(len(found & set(expected)) / k)
+
+    opensearch.indices.delete(index=index_name, ignore=[404])
+    return {
+        "profile": name,
+        "recall_at_k": round(sum(recalls) / len(recalls), 4),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "took_p50_ms": percentile(took, 50),
+        "graph_memory_kb": memory_kb,
+        "store_bytes": store,
+        "load_s": round(load_s, 2),
+        "failed": load_stats["failed"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall@k, latency and memory of k-NN index profiles")
+    parser.add_argument("--profiles", nargs="+", default=[name for name in INDEX_PROFILES if name != "faiss_ivf"],
+                        choices=list(INDEX_PROFILES))
+    parser.add_argument("--corpora", nargs="+", default=["amazon_small_index", "google_small_index"],
+                        help="folders of data/s3_copy to load")
+    parser.add_argument("--queries", default=QUERIES_FILE, help="file with one question per line")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5, help="times the query set is replayed")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[],
+                        help="also run every HNSW profile with these ef_search values")
+    parser.add_argument("--train-for", help="train the models of training profiles for this index and exit")
+    parser.add_argument("--cache-dir", default=os.path.join(ROOT, ".bench_cache"))
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    model_id = os.environ["BEDROCK_EMBEDDING_MODEL_ID"]
+    embedder = BatchEmbedder(registry.bedrock_runtime(), model_id)
+    opensearch = registry.opensearch()
+
+    chunks = load_chunks(args.corpora, args.chunk_size)
+    cache_file = os.path.join(args.cache_dir, f"{model_id}.json")
+    vectors = cached_embeddings([chunk["text"] for chunk in chunks], embedder.embed_documents, cache_file)
+    dimension = len(vectors[0])
+    with open(args.queries, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+    queries = cached_embeddings(questions, lambda texts: [embedder.embed_query(text) for text in texts], cache_file)
+    truth = [exact_neighbours(query, vectors, args.k) for query in queries]
+    print(f"{len(chunks)} chunks of {dimension} dimensions, {len(queries)} queries")
+
+    # A flat index with the corpus is the training set of IVF models
+    training_index = "bench_training"
+    runs = []
+    for name in args.profiles:
+        profile = get_profile(name)
+        trained_model = None
+        if profile.get("training"):
+            load_index(opensearch, training_index, index_body(get_profile("faiss_hnsw"), dimension), chunks, vectors)
+            target = args.train_for or f"bench_{name}"
+            trained_model = model_id_for(target, name)
+            opensearch.transport.perform_request("DELETE", f"/_plugins/_knn/models/{trained_model}", params={"ignore": 404})
+            train_model(opensearch, trained_model, profile, dimension, training_index)
+            opensearch.indices.delete(index=training_index, ignore=[404])
+            if args.train_for:
+                print(f"Trained {trained_model}, create {args.train_for} with INDEX_PROFILE_OVERRIDES")
+                continue
+        runs.append((name, profile, trained_model))
+        if "ef_search" in profile:
+            runs.extend((f"{name}_ef{ef}", with_ef_search(profile, ef), None) for ef in args.ef_search)
+    if args.train_for:
+        return
+
+    results = []
+    for name, profile, trained_model in runs:
+        print(f"Benchmarking {name}")
+        results.append(run_profile(opensearch, name, profile, dimension, chunks, vectors, queries, truth,
+                                   args.k, args.repeat, model_id=trained_model))
+
+    columns = ["profile", "recall_at_k", "p50_ms", "p99_ms", "took_p50_ms", "graph_memory_kb", "store_bytes", "load_s"]
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>16}" for column in columns))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"k": args.k, "chunks": len(chunks), "queries": len(queries), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
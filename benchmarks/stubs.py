@@ -0,0 +1,439 @@
+"""
+Deterministic local stand-ins for Bedrock, OpenSearch and S3.
+
+Every call sleeps for an injectable latency and is recorded per stage, so a
+benchmark can tell how much of a handler's time is spent waiting on each
+backend and how much is the handler itself.
+"""
+
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from fnmatch import fnmatch
+
+import numpy as np
+
+from assistant_utils.local_store import LocalVectorStore
+from assistant_utils.search import TEXT_FIELD, VECTOR_FIELD
+
+# Milliseconds slept per call, "llm_token" is added per generated token
+DEFAULT_LATENCY = {
+    "bedrock_embed": 25,
+    "bedrock_llm": 600,
+    "bedrock_llm_token": 0,
+    "opensearch": 8,
+    "s3": 20,
+}
+
+EMBEDDING_DIMENSION = 1536
+
+
+class StageRecorder:
+    """Time spent in each backend stage since the last :meth:`reset`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+            self.counts = {}
+
+    def add(self, stage, ms):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + ms
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {"ms": round(ms, 3), "calls": self.counts[stage]} for stage, ms in self.totals.items()}
+
+
+class Latency:
+    """Sleeps for the configured latency of a stage, with seeded jitter."""
+
+    def __init__(self, latency=None, jitter=0.0, seed=0, recorder=None):
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.jitter = jitter
+        self.recorder = recorder or StageRecorder()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay_ms(self, stage, extra_ms=0.0):
+        base = self.latency.get(stage, 0) + extra_ms
+        if not base or not self.jitter:
+            return base
+        with self._lock:
+            return max(0.0, base * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    @contextmanager
+    def stage(self, name, extra_ms=0.0):
+        start = time.perf_counter()
+        delay = self.delay_ms(name, extra_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        try:
+            yield
+        finally:
+            self.recorder.add(name, (time.perf_counter() - start) * 1000)
+
+
+def hashed_embedding(text, dimension=EMBEDDING_DIMENSION):
+    """Bag of words hashed into ``dimension`` buckets, texts sharing words stay close."""
+    vector = [0.0] * dimension
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dimension
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class StubBedrock:
+    """bedrock-runtime client answering Titan/Cohere embedding and text completion calls."""
+
+    def __init__(self, latency, answer_tokens=200):
+        self.latency = latency
+        self.answer_tokens = answer_tokens
+
+    def _completion(self, prompt):
+        match = re.search(r'question "(.*?)"\.\s*the list of possible companies names are (\[.*?\])', prompt, re.DOTALL)
+        if match:
+            question = match.group(1).lower()
+            companies = re.findall(r"'(\w+)'", match.group(2))
+            named = [company for company in companies if company in question]
+            return json.dumps({"company": named[0] if len(named) == 1 else "none"}), 12
+        words = ["Revenue", "grew", "compared", "with", "the", "previous", "year", "according", "to", "the", "report."]
+        return " ".join(words[i % len(words)] for i in range(self.answer_tokens)), self.answer_tokens
+
+    @staticmethod
+    def _response(payload):
+        return {
+            "body": io.BytesIO(json.dumps(payload).encode()),
+            "ResponseMetadata": {"HTTPHeaders": {}},
+        }
+
+    def invoke_model(self, modelId, body, accept=None, contentType=None, **kwargs):
+        request = json.loads(body)
+        if "inputText" in request and "embed" in modelId:
+            with self.latency.stage("bedrock_embed"):
+                return self._response({"embedding": hashed_embedding(request["inputText"]),
+                                       "inputTextTokenCount": len(request["inputText"].split())})
+        if "texts" in request:
+            with self.latency.stage("bedrock_embed"):
+                return self._response({"embeddings": [hashed_embedding(text) for text in request["texts"]]})
+        prompt = request.get("prompt") or request.get("inputText") or ""
+        text, tokens = self._completion(prompt)
+        with self.latency.stage("bedrock_llm", tokens * self.latency.latency.get("bedrock_llm_token", 0)):
+            return self._response({"completion": text, "outputText": text, "stop_reason": "stop_sequence"})
+
+    def invoke_model_with_response_stream(self, modelId, body, accept=None, contentType=None, **kwargs):
+        request = json.loads(body)
+        text, _ = self._completion(request.get("prompt") or request.get("inputText") or "")
+
+        def events():
+            with self.latency.stage("bedrock_llm"):
+                pass
+            for word in text.split(" "):
+                with self.latency.stage("bedrock_llm_token"):
+                    yield {"chunk": {"bytes": json.dumps({"completion": word + " ", "outputText": word + " "}).encode()}}
+
+        return {"body": events()}
+
+
+class _Body:
+    def __init__(self, data, latency):
+        self._data = data
+        self._latency = latency
+
+    def iter_chunks(self, chunk_size=1024):
+        for start in range(0, len(self._data), chunk_size):
+            with self._latency.stage("s3"):
+                pass
+            yield self._data[start:start + chunk_size]
+
+    def read(self):
+        return self._data
+
+
+class StubS3:
+    """get_object over local files, ``aliases`` maps extra keys to an existing key."""
+
+    def __init__(self, latency, files=None):
+        self.latency = latency
+        self.files = dict(files or {})
+
+    def _etag(self, path):
+        with open(path, "rb") as f:
+            return f'"{hashlib.md5(f.read()).hexdigest()}"'
+
+    def head_object(self, Bucket, Key, **kwargs):
+        with self.latency.stage("s3"):
+            path = self.files[Key]
+            return {"ETag": self._etag(path), "ContentLength": os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        with self.latency.stage("s3"):
+            path = self.files[Key]
+        if IfMatch is not None and IfMatch != self._etag(path):
+            from botocore.exceptions import ClientError
+
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "At least one of the pre-conditions you specified did not hold"}}, "GetObject")
+        with open(path, "rb") as f:
+            data = f.read()
+        if Range is not None:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": _Body(data, self.latency), "ContentLength": len(data)}
+
+
+class _StubIndices:
+    def __init__(self, client):
+        self.client = client
+
+    def exists(self, index, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return index in self.client.indices_data
+
+    def create(self, index, body=None, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            body = body or {}
+            self.client.indices_data[index] = {
+                "docs": OrderedDict(),
+                "mappings": body.get("mappings", {}),
+                "settings": body.get("settings", {}),
+                "store": None,
+            }
+            return {"acknowledged": True, "index": index}
+
+    def delete(self, index, ignore=None, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            for name in self.client.resolve(index):
+                del self.client.indices_data[name]
+            return {"acknowledged": True}
+
+    def get_alias(self, index="*", **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return {name: {"aliases": {}} for name in self.client.resolve(index)}
+
+    def exists_alias(self, name, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return False
+
+    def get_mapping(self, index, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return {name: {"mappings": self.client.indices_data[name]["mappings"]} for name in self.client.resolve(index)}
+
+    def get_settings(self, index, name=None, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return {index: {"settings": self.client.indices_data[index]["settings"]}}
+
+    def put_settings(self, index, body, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            self.client.indices_data[index]["settings"].setdefault("index", {}).update(body.get("index", {}))
+            return {"acknowledged": True}
+
+    def refresh(self, index=None, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+
+
+class _StubTasks:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, task_id, **kwargs):
+        with self.client.latency.stage("opensearch"):
+            return {"completed": True, "response": self.client.tasks_data.pop(task_id, {"deleted": 0, "failures": []})}
+
+
+class StubOpenSearch:
+    """In-memory OpenSearch speaking the subset of the API the lambdas use.
+
+    k-NN queries are exact, answered by a :class:`LocalVectorStore` per index
+    that is rebuilt after writes.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.indices_data = {}
+        self.tasks_data = {}
+        self.indices = _StubIndices(self)
+        self.tasks = _StubTasks(self)
+        self._lock = threading.RLock()
+
+    def resolve(self, pattern):
+        names = []
+        for part in str(pattern).split(","):
+            names.extend(name for name in self.indices_data if fnmatch(name, part))
+        return sorted(set(names))
+
+    def load(self, index_name, documents):
+        """Seed ``index_name`` with ``(id, source)`` pairs without any latency."""
+        if index_name not in self.indices_data:
+            self.indices_data[index_name] = {"docs": OrderedDict(), "mappings": {}, "settings": {}, "store": None}
+        data = self.indices_data[index_name]
+        for doc_id, source in documents:
+            data["docs"][doc_id] = source
+        data["store"] = None
+
+    def _store(self, index_name):
+        data = self.indices_data[index_name]
+        with self._lock:
+            if data["store"] is None:
+                docs = [(doc_id, source) for doc_id, source in data["docs"].items() if VECTOR_FIELD in source]
+                vectors = np.array([source[VECTOR_FIELD] for _, source in docs], dtype=np.float32)
+                data["store"] = LocalVectorStore(
+                    [source.get(TEXT_FIELD, "") for _, source in docs],
+                    vectors.reshape(len(docs), -1),
+                    [source for _, source in docs],
+                    [doc_id for doc_id, _ in docs],
+                )
+            return data["store"]
+
+    @staticmethod
+    def _source(source, spec):
+        if isinstance(spec, list):
+            return {key: source[key] for key in spec if key in source}
+        if isinstance(spec, dict):
+            excludes = spec.get("excludes", [])
+            return {key: value for key, value in source.items() if key not in excludes}
+        if spec is False:
+            return None
+        return dict(source)
+
+    @staticmethod
+    def _matches(source, query):
+        if not query or "match_all" in query:
+            return True
+        if "term" in query:
+            field, value = next(iter(query["term"].items()))
+            return source.get(field.replace(".keyword", "")) == value
+        if "match_phrase" in query:
+            field, value = next(iter(query["match_phrase"].items()))
+            return value in str(source.get(field, ""))
+        return True
+
+    def _search_index(self, index_name, body):
+        body = body or {}
+        query = body.get("query", {})
+        size = body.get("size", 10)
+        if "knn" in query:
+            field = next(iter(query["knn"].values()))
+            ranked = [
+                (doc["id"], self.indices_data[index_name]["docs"][doc["id"]], doc["score"])
+                for doc in self._store(index_name).search(field["vector"], min(size, field.get("k", size)))
+            ]
+        else:
+            ranked = [
+                (doc_id, source, 1.0)
+                for doc_id, source in self.indices_data[index_name]["docs"].items()
+                if self._matches(source, query)
+            ]
+        return [
+            {"_index": index_name, "_id": doc_id, "_score": score, "_source": self._source(source, body.get("_source"))}
+            for doc_id, source, score in ranked
+        ][:size]
+
+    def _search(self, index, body, scroll=None):
+        start = time.perf_counter()
+        names = self.resolve(index)
+        if not names:
+            return {"error": {"type": "index_not_found_exception", "index": index}, "status": 404}
+        hits = []
+        for name in names:
+            hits.extend(self._search_index(name, {**(body or {}), **({"size": 10 ** 9} if scroll else {})}))
+        hits.sort(key=lambda hit: hit["_score"], reverse=True)
+        if not scroll:
+            hits = hits[: (body or {}).get("size", 10)]
+        response = {
+            "took": int((time.perf_counter() - start) * 1000),
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"total": {"value": len(hits)}, "hits": hits},
+        }
+        if scroll:
+            response["_scroll_id"] = "stub-scroll"
+        return response
+
+    def search(self, index=None, body=None, scroll=None, **kwargs):
+        with self.latency.stage("opensearch"):
+            response = self._search(index, body, scroll)
+        if "error" in response:
+            if kwargs.get("ignore_unavailable") or kwargs.get("allow_no_indices"):
+                return {"took": 0, "timed_out": False, "hits": {"total": {"value": 0}, "hits": []}}
+            raise KeyError(f"no such index [{index}]")
+        return response
+
+    def scroll(self, **kwargs):
+        with self.latency.stage("opensearch"):
+            return {"_scroll_id": "stub-scroll", "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                    "hits": {"hits": []}}
+
+    def clear_scroll(self, **kwargs):
+        return {"succeeded": True}
+
+    def msearch(self, body, **kwargs):
+        with self.latency.stage("opensearch"):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            return {"took": 0, "responses": [self._search(header["index"], query) for header, query in zip(lines[::2], lines[1::2])]}
+
+    def mget(self, index, body, **kwargs):
+        with self.latency.stage("opensearch"):
+            docs = self.indices_data.get(index, {}).get("docs", {})
+            return {"docs": [{"_index": index, "_id": doc_id, "found": doc_id in docs} for doc_id in body["ids"]]}
+
+    def index(self, index, id, body, **kwargs):
+        with self.latency.stage("opensearch"):
+            self.load(index, [(id, body)])
+            return {"_id": id, "result": "created"}
+
+    def delete(self, index, id, **kwargs):
+        with self.latency.stage("opensearch"):
+            docs = self.indices_data.get(index, {}).get("docs", {})
+            found = docs.pop(id, None) is not None
+            if found:
+                self.indices_data[index]["store"] = None
+            return {"_id": id, "result": "deleted" if found else "not_found"}
+
+    def bulk(self, body, index=None, **kwargs):
+        with self.latency.stage("opensearch"):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            items = []
+            position = 0
+            while position < len(lines):
+                action, meta = next(iter(lines[position].items()))
+                name = meta.get("_index", index)
+                if action == "delete":
+                    docs = self.indices_data.get(name, {}).get("docs", {})
+                    docs.pop(meta["_id"], None)
+                    position += 1
+                else:
+                    self.load(name, [(meta["_id"], lines[position + 1])])
+                    position += 2
+                if name in self.indices_data:
+                    self.indices_data[name]["store"] = None
+                items.append({action: {"_id": meta["_id"], "status": 200}})
+            return {"took": 0, "errors": False, "items": items}
+
+    def delete_by_query(self, index, body, **kwargs):
+        with self.latency.stage("opensearch"):
+            deleted = 0
+            for name in self.resolve(index):
+                docs = self.indices_data[name]["docs"]
+                for doc_id in [doc_id for doc_id, source in docs.items() if self._matches(source, body.get("query"))]:
+                    del docs[doc_id]
+                    deleted += 1
+                self.indices_data[name]["store"] = None
+            task_id = f"stub:{len(self.tasks_data) + 1}"
+            self.tasks_data[task_id] = {"deleted": deleted, "failures": []}
+            return {"task": task_id}
@@ -48,23 +48,39 @@ def build_deploy():
     return_dir()
 
 
+def profile_imports(required):
+    # Needs the utils layer packages, installed by the Lambda Layer Creation steps of the README
+    if not os.path.isdir("./layers/utils_layer/python/boto3"):
+        exit_on_failure(1 if required else 0, "Utils layer packages not installed, cannot profile imports")
+        print("Utils layer packages not installed, import profile skipped")
+        return
+    cmd = [sys.executable, "benchmarks/import_profile.py", "--output", "import_profile.json"]
+    proc = subprocess.run(cmd, stderr=subprocess.STDOUT) # nosec B603
+    if required:
+        exit_on_failure(proc.returncode, "Import profile failed")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Builds parts or all of the solution.  If no arguments are passed then all builds are run"
     )
     parser.add_argument("--web", action="store_true", help="builds web app")
     parser.add_argument("--deploy", action="store_true", help="builds iac")
+    parser.add_argument("--import-profile", action="store_true", help="profiles the import time of the lambdas")
     args = parser.parse_args()
 
     if len(sys.argv) == 1:
         build_web_app()
         build_deploy()
+        profile_imports(required=False)
         
     else:
         if args.web:
             build_web_app()
         if args.deploy:
             build_deploy()
+        if args.import_profile:
+            profile_imports(required=True)
 
 
 if __name__ == "__main__":
@@ -20,13 +20,17 @@ import * as cdk from "aws-cdk-lib";
 import { Duration, RemovalPolicy } from "aws-cdk-lib";
 
 import * as s3 from "aws-cdk-lib/aws-s3";
+import * as sqs from "aws-cdk-lib/aws-sqs";
 import * as iam from "aws-cdk-lib/aws-iam";
 import * as ec2 from "aws-cdk-lib/aws-ec2";
 import * as lambda from "aws-cdk-lib/aws-lambda";
 import * as apigwv2 from "aws-cdk-lib/aws-apigatewayv2";
+import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
 import * as opensearch from "aws-cdk-lib/aws-opensearchservice";
 
 import * as triggers from "aws-cdk-lib/triggers";
+import * as events from "aws-cdk-lib/aws-events";
+import * as eventsTargets from "aws-cdk-lib/aws-events-targets";
 import * as s3Deployment from "aws-cdk-lib/aws-s3-deployment";
 import * as lambdaEventSources from "aws-cdk-lib/aws-lambda-event-sources";
 
@@ -142,7 +146,7 @@ export class AppStack extends cdk.Stack {
             userPoolClient: cognito.webClientUserPool,
         });
 
-        new AmplifyConfigLambdaConstruct(this, "AmplifyConfigFn", {
+        const amplifyConfig = new AmplifyConfigLambdaConstruct(this, "AmplifyConfigFn", {
             api: api.apiGatewayV2,
             appClientId: cognito.webClientId,
             userPoolId: cognito.userPoolId,
@@ -281,6 +285,8 @@ export class AppStack extends cdk.Stack {
                         "es:ESHttpPut",
                         "es:ESHttpPost",
                         "es:ESHttpDelete",
+                        // indices.exists and exists_alias are HEAD requests
+                        "es:ESHttpHead",
                     ],
                     resources: [
                         esDomain.domainArn,
@@ -350,7 +356,10 @@ export class AppStack extends cdk.Stack {
             inlinePolicies: {
                 cloudwatchXRayLambdaPolicy: cloudwatchXRayLambdaPolicy,
                 bedrockLLMLambdaPolicy: bedrockLLMLambdaPolicy,
+                // The company router reads the index catalog and embeds ambiguous questions
+                bedrockEmbeddingLambdaPolicy: bedrockEmbeddingLambdaPolicy,
                 eniLambdaPolicy: eniLambdaPolicy,
+                osLambdaPolicy: osLambdaPolicy,
             },
         });
 
@@ -400,6 +409,19 @@ export class AppStack extends cdk.Stack {
 
 
 
+        // Shared tier of the answer cache. The index data and reindex lambdas bump the
+        // generation of a company in it, which retires the answers cached for that company.
+        const answerCacheTable = new dynamodb.Table(this, "AnswerCacheTable", {
+            partitionKey: { name: "key", type: dynamodb.AttributeType.STRING },
+            billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+            timeToLiveAttribute: "expires_at",
+            removalPolicy: RemovalPolicy.DESTROY,
+        });
+        const answerCacheEnvironment = {
+            ...lambdaDefaults.environment,
+            ANSWER_CACHE_TABLE: answerCacheTable.tableName,
+        };
+
         // Response lambda and role
         const responseLambdaRole = new iam.Role(this, "ResponseLambdaRole", {
             assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
@@ -407,6 +429,7 @@ export class AppStack extends cdk.Stack {
             inlinePolicies: {
                 cloudwatchXRayLambdaPolicy: cloudwatchXRayLambdaPolicy,
                 bedrockLLMLambdaPolicy: bedrockLLMLambdaPolicy,
+                bedrockEmbeddingLambdaPolicy: bedrockEmbeddingLambdaPolicy,
                 eniLambdaPolicy: eniLambdaPolicy,
             },
         });
@@ -417,7 +440,9 @@ export class AppStack extends cdk.Stack {
             code: lambda.Code.fromAsset("../lambdas/response_lambda"),
             handler: "generate_response_lambda.lambda_handler",
             role: responseLambdaRole,
+            environment: answerCacheEnvironment,
         });
+        answerCacheTable.grantReadWriteData(responseLambdaRole);
 
         const responseLambdaAPI = new ApiGatewayV2LambdaConstruct(this, "ResponseLambdaIntegration", {
             routePath: "/api/response",
@@ -427,6 +452,82 @@ export class AppStack extends cdk.Stack {
             apiRouteAuthorizer: api.apiRouteAuthorizer,
         });
 
+        // Streaming response lambda: the same code served by the Lambda Web Adapter on a
+        // function URL in RESPONSE_STREAM mode, tokens reach the browser as they are generated
+        const lambdaWebAdapterLayer = lambda.LayerVersion.fromLayerVersionArn(
+            this,
+            "LambdaWebAdapterLayer",
+            `arn:aws:lambda:${this.region}:753240598075:layer:LambdaAdapterLayerArm64:22`,
+        );
+
+        responseLambdaRole.addToPrincipalPolicy(new iam.PolicyStatement({
+            effect: iam.Effect.ALLOW,
+            actions: ["bedrock:InvokeModelWithResponseStream"],
+            resources: [`arn:aws:bedrock:${bedrock_region}::foundation-model/${process.env.BEDROCK_TEXT_MODEL_ID!}`],
+        }));
+
+        const responseStreamLambda = new lambda.Function(this, "responseStreamLambda", {
+            ...lambdaDefaults,
+            layers: [awsPowerToolsLayer, utilsLayer, lambdaWebAdapterLayer],
+            functionName: "gen-ai-assistant-response-stream-lambda",
+            code: lambda.Code.fromAsset("../lambdas/response_lambda"),
+            handler: "run.sh",
+            role: responseLambdaRole,
+            environment: {
+                ...answerCacheEnvironment,
+                AWS_LAMBDA_EXEC_WRAPPER: "/opt/bootstrap",
+                AWS_LWA_INVOKE_MODE: "response_stream",
+                AWS_LWA_PORT: "8080",
+            },
+        });
+
+        const responseStreamUrl = responseStreamLambda.addFunctionUrl({
+            // Callers are authenticated in the function with their Cognito access token
+            authType: lambda.FunctionUrlAuthType.NONE,
+            invokeMode: lambda.InvokeMode.RESPONSE_STREAM,
+            cors: {
+                allowedOrigins: ["*"],
+                allowedMethods: [lambda.HttpMethod.POST],
+                allowedHeaders: ["authorization", "content-type"],
+            },
+        });
+        amplifyConfig.amplifyConfigLambda.addEnvironment("STREAM_URL", responseStreamUrl.url);
+
+
+        // Ask lambda and role: classification, retrieval and generation in one invocation
+        const askLambdaRole = new iam.Role(this, "AskLambdaRole", {
+            assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
+            description: "Allows Ask Lambda task to use services",
+            inlinePolicies: {
+                cloudwatchXRayLambdaPolicy: cloudwatchXRayLambdaPolicy,
+                bedrockLLMLambdaPolicy: bedrockLLMLambdaPolicy,
+                bedrockEmbeddingLambdaPolicy: bedrockEmbeddingLambdaPolicy,
+                eniLambdaPolicy: eniLambdaPolicy,
+                osLambdaPolicy: osLambdaPolicy,
+            },
+        });
+
+        // Packages the step lambdas next to the ask lambda so it can import them
+        const askLambda = new lambda.Function(this, "askLambda", {
+            ...lambdaDefaults,
+            functionName: "gen-ai-assistant-ask-lambda",
+            code: lambda.Code.fromAsset("../lambdas", {
+                exclude: ["index_data_lambda", "opensearch_restore_snapshot", "opensearch_snapshot", "reindex_lambda"],
+            }),
+            handler: "ask_lambda/ask_lambda.lambda_handler",
+            role: askLambdaRole,
+            environment: answerCacheEnvironment,
+        });
+        answerCacheTable.grantReadWriteData(askLambdaRole);
+
+        const askLambdaAPI = new ApiGatewayV2LambdaConstruct(this, "AskLambdaIntegration", {
+            routePath: "/api/ask",
+            methods: [apigwv2.HttpMethod.POST],
+            api: api.apiGatewayV2,
+            lambdaFn: askLambda,
+            apiRouteAuthorizer: api.apiRouteAuthorizer,
+        });
+
 
         // Index data lambda and role
         const indexLambdaRole = new iam.Role(this, "IndexDataLambdaRole", {
@@ -441,15 +542,82 @@ export class AppStack extends cdk.Stack {
             },
         });
 
+        // Work units of large documents, queued by the index data lambda for the ingest workers
+        const ingestDeadLetterQueue = new sqs.Queue(this, "IngestDeadLetterQueue", {
+            retentionPeriod: Duration.days(14),
+            enforceSSL: true,
+        });
+        const ingestQueue = new sqs.Queue(this, "IngestQueue", {
+            // Six times the worker timeout, as recommended for Lambda event sources
+            visibilityTimeout: Duration.minutes(30),
+            enforceSSL: true,
+            deadLetterQueue: { queue: ingestDeadLetterQueue, maxReceiveCount: 5 },
+        });
+        // Progress of every unit, so a unit delivered again resumes after its last batch
+        const ingestCheckpointTable = new dynamodb.Table(this, "IngestCheckpointTable", {
+            partitionKey: { name: "key", type: dynamodb.AttributeType.STRING },
+            billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+            timeToLiveAttribute: "expires_at",
+            removalPolicy: RemovalPolicy.DESTROY,
+        });
+        ingestQueue.grantSendMessages(indexLambdaRole);
+        ingestCheckpointTable.grantReadWriteData(indexLambdaRole);
+        answerCacheTable.grantReadWriteData(indexLambdaRole);
+        const ingestEnvironment = {
+            ...answerCacheEnvironment,
+            INGEST_QUEUE_URL: ingestQueue.queueUrl,
+            INGEST_CHECKPOINT_TABLE: ingestCheckpointTable.tableName,
+        };
+
         const indexLambda = new lambda.Function(this, "indexDataLambda", {
             code: lambda.Code.fromAsset("../lambdas/index_data_lambda"),
             handler: "index_data_lambda.lambda_handler",
             functionName: "gen-ai-assistant-index-data-lambda",
             ...lambdaDefaults,
+            environment: ingestEnvironment,
+            role: indexLambdaRole,
+        });
+
+        // Same code as the index data lambda, embeds and writes one work unit per message
+        const ingestWorkerLambda = new lambda.Function(this, "ingestWorkerLambda", {
+            code: lambda.Code.fromAsset("../lambdas/index_data_lambda"),
+            handler: "index_data_lambda.unit_handler",
+            functionName: "gen-ai-assistant-ingest-worker-lambda",
+            ...lambdaDefaults,
+            environment: ingestEnvironment,
+            role: indexLambdaRole,
+        });
+        ingestWorkerLambda.addEventSource(new lambdaEventSources.SqsEventSource(ingestQueue, {
+            batchSize: 1,
+            reportBatchItemFailures: true,
+            // Workers running at once, raise it with the Bedrock embedding quota
+            maxConcurrency: 10,
+        }));
+
+        // Rebuilds an index from its S3 prefix into a new version and moves its alias, invoked by hand
+        const reindexLambda = new lambda.Function(this, "reindexLambda", {
+            code: lambda.Code.fromAsset("../lambdas/reindex_lambda"),
+            handler: "reindex_lambda.lambda_handler",
+            functionName: "gen-ai-assistant-reindex-lambda",
+            ...lambdaDefaults,
+            environment: answerCacheEnvironment,
+            timeout: Duration.minutes(15),
             role: indexLambdaRole,
         });
 
 
+        // Role OpenSearch assumes to read and write the snapshot repository in S3
+        const restoreSnapshotOSRole = new iam.Role(this, "RestoreSnapshotOSRole", {
+            assumedBy: new iam.ServicePrincipal("es.amazonaws.com"),
+            description: "Allows Restore Snapshot OS task to use services",
+            inlinePolicies: {
+                cloudwatchXRayLambdaPolicy: cloudwatchXRayLambdaPolicy,
+                s3SnapshotLambdaPolicy: s3SnapshotLambdaPolicy,
+                osSnapshotLambdaPolicy: osLambdaPolicy,
+                eniLambdaPolicy: eniLambdaPolicy,
+            },
+        });
+
         // Snapshot lambda and role
         const snapshotLambdaRole = new iam.Role(this, "SnapshotLambdaRole", {
             assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
@@ -467,21 +635,29 @@ export class AppStack extends cdk.Stack {
             handler: "lambda.lambda_handler",
             ...lambdaDefaults,
             role: snapshotLambdaRole,
+            environment: {
+                ...lambdaDefaults.environment,
+                SNAPSHOT_BUCKET: snapshotBucket.bucketName,
+                IAM_ROLE: restoreSnapshotOSRole.roleArn,
+            },
         });
 
+        snapshotLambdaRole.addToPrincipalPolicy(new iam.PolicyStatement({
+            effect: iam.Effect.ALLOW,
+            actions: ["iam:PassRole"],
+            resources: [
+                restoreSnapshotOSRole.roleArn,
+            ],
+        }));
 
-        // Restore snapshot lambda and role, and OS role
-        const restoreSnapshotOSRole = new iam.Role(this, "RestoreSnapshotOSRole", {
-            assumedBy: new iam.ServicePrincipal("es.amazonaws.com"),
-            description: "Allows Restore Snapshot OS task to use services",
-            inlinePolicies: {
-                cloudwatchXRayLambdaPolicy: cloudwatchXRayLambdaPolicy,
-                s3SnapshotLambdaPolicy: s3SnapshotLambdaPolicy,
-                osSnapshotLambdaPolicy: osLambdaPolicy,
-                eniLambdaPolicy: eniLambdaPolicy,
-            },
+        // Starts a snapshot once a day and resumes the one in progress on the other runs
+        new events.Rule(this, "SnapshotSchedule", {
+            schedule: events.Schedule.rate(Duration.minutes(15)),
+            targets: [new eventsTargets.LambdaFunction(snapshotLambda)],
         });
 
+
+        // Restore snapshot lambda and role
         const restoreSnapshotLambdaRole = new iam.Role(this, "RestoreSnapshotLambdaRole", {
             assumedBy: new iam.ServicePrincipal("lambda.amazonaws.com"),
             description: "Allows Restore Snapshot Lambda task to use services",
@@ -525,12 +701,15 @@ export class AppStack extends cdk.Stack {
                 "es:UpdateDomain",
                 "es:ESHttpGet",
                 "es:ESHttpPut",
+                "es:ESHttpHead",
             ],
             effect: iam.Effect.ALLOW,
             principals: [
                 new iam.ArnPrincipal(restoreSnapshotLambdaRole.roleArn),
                 new iam.ArnPrincipal(snapshotLambdaRole.roleArn),
+                new iam.ArnPrincipal(classificationLambdaRole.roleArn),
                 new iam.ArnPrincipal(retrieverLambdaRole.roleArn),
+                new iam.ArnPrincipal(askLambdaRole.roleArn),
             ],
             resources: [
                 esDomain.domainArn,
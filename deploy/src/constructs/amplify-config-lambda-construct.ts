@@ -60,6 +60,11 @@ const defaultProps: Partial<AmplifyConfigLambdaConstructProps> = {};
  * amplify configuration setup
  */
 export class AmplifyConfigLambdaConstruct extends Construct {
+    /**
+     * The lambda serving the configuration, add environment variables to extend it
+     */
+    public amplifyConfigLambda: cdk.aws_lambda.Function;
+
     constructor(parent: Construct, name: string, props: AmplifyConfigLambdaConstructProps) {
         super(parent, name);
 
@@ -141,7 +146,7 @@ export class AmplifyConfigLambdaConstruct extends Construct {
             },
         });
 
-        const amplifyConfigLambda = new cdk.aws_lambda.Function(this, "AmplifyConfigLambda", {
+        const amplifyConfigLambda = this.amplifyConfigLambda = new cdk.aws_lambda.Function(this, "AmplifyConfigLambda", {
             runtime: cdk.aws_lambda.Runtime.PYTHON_3_12,
             handler: "index.lambda_handler",
             code: cdk.aws_lambda.Code.fromInline(this.getPythonLambdaFunction()), // TODO: support both python and typescript versions
@@ -203,7 +208,8 @@ def lambda_handler(event, context):
   response = {
       "region": region,
       "userPoolId": user_pool_id,
-      "appClientId": app_client_id
+      "appClientId": app_client_id,
+      "streamUrl": os.getenv("STREAM_URL", None)
   }
   return {
       "statusCode": "200",
@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+# Single endpoint running classification, retrieval and generation in one invocation.
+# It reuses the code of the three step lambdas, which are packaged next to this folder,
+# so changes made to them in the workshop apply here too.
+
+import os
+import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from aws_lambda_powertools import Logger, Tracer
+from aws_lambda_powertools.event_handler import APIGatewayHttpResolver, CORSConfig
+from aws_lambda_powertools.logging import correlation_paths
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+lambdas_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("classification_lambda", "retrieval_lambda", "response_lambda"):
+    sys.path.insert(0, os.path.join(lambdas_root, folder))
+
+import classify_lambda
+import retrieval_lambda
+import generate_response_lambda
+
+tracer = Tracer()
+logger = Logger()
+cors_config = CORSConfig(allow_origin="*", max_age=300)
+
+app = APIGatewayHttpResolver(cors=cors_config)
+
+# Runs the speculative retrieval work while the question is being classified
+executor = ThreadPoolExecutor(max_workers=2)
+
+NO_ANSWER = "Validation failed, no answer received."
+NO_CONTEXT = "Validation failed, no context received."
+
+
+def companies_text(companies):
+    names = [company.capitalize() for company in companies]
+    if len(names) <= 2:
+        return " or ".join(names)
+    return ", ".join(names[:-1]) + ", or " + names[-1]
+
+
+def timed(timings, name, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+@app.post("/api/ask")
+@tracer.capture_method
+def ask():
+    query: dict = json.loads(app.current_event.json_body)
+    logger.info(query)
+    message_text = query["message"]
+
+    val = {
+        "step1": "working",
+        "step2": "waiting",
+        "step3": "waiting",
+        "step4": "waiting",
+        "step5": "waiting",
+        "info": "",
+    }
+    timings = {}
+    response = {"result": NO_ANSWER, "context": NO_CONTEXT, "val": val, "complete": False, "timings": timings}
+
+    # The question embedding does not depend on the company, compute it while classifying
+    speculative = executor.submit(timed, timings, "speculative_embedding_ms",
+                                  retrieval_lambda.prefetch_question_embedding, message_text)
+
+    # Step 1: classification
+    try:
+        classification = timed(timings, "classifier_ms", classify_lambda.classify, message_text)
+    except Exception as e:
+        logger.exception("Classification failed")
+        val["step1"] = "failed"
+        val["info"] = "Lambda Error: You either forgot to enable Bedrock, or have some error in your code. Please check the CloudWatch logs of your Classification Lambda to see what went wrong."
+        return response
+
+    company = classification["index"]
+    companies = classification["companies"]
+    if company not in companies:
+        val["step1"] = "failed"
+        val["info"] = f"Question Error: The classifier cannot determine which company you are asking about. Please reword the question and be sure to be asking about {companies_text(companies)}."
+        response["result"] = f"It is unclear which company you are asking about. Please reword the question and be sure to be asking about {companies_text(companies)}."
+        return response
+    val["step1"] = "completed"
+    val["step2"] = "working"
+    val["company"] = company
+    response["company"] = company
+
+    # Step 2: retrieval, reusing the speculative embedding through the query cache
+    try:
+        speculative.result()
+    except Exception as e:
+        logger.info(f"Speculative embedding failed, retrieval embeds again: {e}")
+    try:
+        retrieval = timed(timings, "retriever_ms", retrieval_lambda.retrieve,
+                          {"message": message_text, **classification})
+    except Exception as e:
+        logger.exception("Retrieval failed")
+        val["step2"] = "failed"
+        val["info"] = "Lambda Error: There seems to be a logic or syntax error in your code. Please check the CloudWatch logs of your Retrieval Lambda to see what went wrong."
+        return response
+    response["json"] = retrieval.get("json", {})
+    if retrieval.get("error") == "boto3 not implemented":
+        val["step2"] = "failed"
+        val["info"] = "RAG Error: " + retrieval["error_explication"]
+        return response
+    val["step2"] = "completed"
+    val["step3"] = "working"
+
+    # Step 3: generation, the chunks stay on the server instead of going through the browser
+    try:
+        generation = generate_response_lambda.prepare_generation({"message": message_text, **retrieval})
+        result = generation["cached_result"]
+        if result is None:
+            result = timed(timings, "generation_ms", generation["llm"]._call, generation["prompt"])
+            generate_response_lambda.store_answer(generation, result)
+        generated = generate_response_lambda.build_response(generation, result)
+    except Exception as e:
+        logger.exception("Generation failed")
+        val["step3"] = "failed"
+        val["info"] = "Lambda Error: There seems to be a logic or syntax error in your code. Please check the CloudWatch logs of your Response Generation Lambda to see what went wrong."
+        return response
+
+    response["result"] = generated["result"]
+    response["context"] = generated["context"]
+    response["packing"] = generated["packing"]
+    if generated.get("error") in ("prompt does not contain context", "prompt does not contain tags"):
+        val["step3"] = "warning"
+        val["info"] = "Warning: " + generated["error_explication"]
+        response["context"] = NO_CONTEXT
+        return response
+
+    # Step 4: validation of the whole pipeline
+    val["step3"] = "completed"
+    if "error" in retrieval:
+        val["step4"] = "warning"
+        val["info"] = "Warning: " + retrieval["error_explication"]
+    elif "error" in generated:
+        val["step4"] = "completed"
+        val["step5"] = "optional"
+        val["info"] = "Validation successful! \n \n \n One optional task left: " + generated["error_explication"]
+        response["complete"] = True
+    else:
+        val["step4"] = "completed"
+        val["step5"] = "completed"
+        val["info"] = "Validation successful!"
+        response["complete"] = True
+
+    logger.info(response)
+    return response
+
+
+@logger.inject_lambda_context(
+    log_event=True, correlation_id_path=correlation_paths.API_GATEWAY_REST
+)
+@tracer.capture_lambda_handler
+def lambda_handler(event: dict, context: LambdaContext) -> dict:
+    return app.resolve(event, context)
@@ -2,13 +2,14 @@
 # SPDX-License-Identifier: MIT-0
 
 import os
-import boto3
 import json
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.event_handler import APIGatewayHttpResolver, CORSConfig
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from langchain_community.llms import Bedrock
+from assistant_utils.cache import CachedQueryEmbeddings, get_cache
+from assistant_utils.clients import registry
+from assistant_utils.router import DEFAULT_ALIASES, CompanyRouter, parse_company
 tracer = Tracer()
 logger = Logger()
 # CORS will match when Origin is only https://www.example.com
@@ -29,28 +30,50 @@ Provide the response following the JSON format as above example:
 @tracer.capture_method
 def get_relevant_documents():
     query: dict = json.loads(app.current_event.json_body)
-    message_text = query["message"]
     logger.info(query)
+    return classify(query["message"])
+
+
+def classify(message_text):
+    response = router.route(message_text)
+    logger.info(response)
+    return response
+
+
+def llm_classify(message_text, companies):
     model_id = os.environ["BEDROCK_TEXT_MODEL_ID"]
     region = os.environ["REGION"]
 
-    llm = Bedrock(
-            model_id=model_id,
+    # The LLM wrapper and its boto3 client are reused across warm invocations
+    llm = registry.bedrock_llm(
+            model_id,
+            model_kwargs={"max_tokens_to_sample":200},
             region_name=region,
-            client=get_bedrock_client(),
-            model_kwargs={"max_tokens_to_sample":200}
         )
     logger.info(llm)
-    companies = ["amazon", "google"]
     formatted_prompt = prompt.format(question=message_text,companies=companies,string=string)
     response = llm._call(prompt = formatted_prompt)
-    response = {
-        "index": json.loads(response)["company"],
-        "companies": companies
-    }    
-    logger.info(response)
+    return parse_company(response, companies)
 
-    return response
+
+def embed_question(message_text):
+    # Shares the query cache with the retriever, so an /api/ask call embeds the question once
+    model_id = os.environ["BEDROCK_EMBEDDING_MODEL_ID"]
+    embeddings = registry.bedrock_embeddings(model_id)
+    return CachedQueryEmbeddings(embeddings, model_id, get_cache("QUERY_CACHE")).embed_query(message_text)
+
+
+# Companies come from the indices in OpenSearch, COMPANIES is only used when it cannot be reached
+router = CompanyRouter(
+    registry.search_client,
+    embed_question,
+    llm_classify,
+    fallback_companies=os.environ.get("COMPANIES", "amazon,google").split(","),
+    extra_aliases={**DEFAULT_ALIASES, **json.loads(os.environ.get("COMPANY_ALIASES", "{}"))},
+    ttl=int(os.environ.get("COMPANY_CATALOG_TTL", 600)),
+    min_similarity=float(os.environ.get("ROUTER_MIN_SIMILARITY", 0.3)),
+    margin=float(os.environ.get("ROUTER_MARGIN", 0.05)),
+)
 
 
 @logger.inject_lambda_context(
@@ -62,8 +85,4 @@ def lambda_handler(event: dict, context: LambdaContext) -> dict:
 
 
 def get_bedrock_client():
-    bedrock_region_name = os.environ["BEDROCK_REGION"]
-    return boto3.client(
-        "bedrock-runtime",
-        region_name=bedrock_region_name
-    )
+    return registry.bedrock_runtime()
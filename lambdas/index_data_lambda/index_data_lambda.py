@@ -2,28 +2,70 @@
 # SPDX-License-Identifier: MIT-0
 
 import os
+import json
 import urllib.parse
-import boto3
 import hashlib
+import threading
+import time
+from contextlib import ExitStack
+from functools import partial
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.utilities.data_classes import event_source, S3Event
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+from opensearchpy.helpers import scan
+from botocore.exceptions import ClientError
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import TextLoader
-from langchain_community.embeddings import BedrockEmbeddings
+from assistant_utils.aliases import concrete_indices
+from assistant_utils.bulk import BulkIndexer, deferred_refresh
+from assistant_utils.cache import build_answer_cache
+from assistant_utils.clients import registry
+from assistant_utils.embeddings import BatchEmbedder, EmbeddingStats
+from assistant_utils.fanout import (
+    build_checkpoints,
+    build_queue,
+    chunk_ranges,
+    job_id,
+    plan_units,
+    range_header,
+    unit_texts,
+)
+from assistant_utils.index_profiles import DEFAULT_PROFILE, get_profile, index_body, model_id_for, model_state, with_ef_search
+from assistant_utils.ingest import iter_s3_text, split_stream, split_hierarchy, batched, pipeline
+from assistant_utils.router import company_of_index
+from assistant_utils.s3_events import SequencerLog, coalesce, run_concurrently
 
 tracer = Tracer()
 logger = Logger()
 
-endpoint = os.environ["OPENSEARCH_ENDPOINT"]
-port = os.environ.get("OPENSEARCH_ENDPOINT_PORT", 443)
-region = os.environ["REGION"]
 model_id = os.environ["BEDROCK_EMBEDDING_MODEL_ID"]
-
-
-service = "es"
-credentials = boto3.Session().get_credentials()
-s3 = boto3.client("s3")
+# Write chunks through the _bulk API, set to "false" to index them one by one
+bulk_indexing = os.environ.get("BULK_INDEXING", "true").lower() == "true"
+# Chunks embedded per batch and batches allowed to wait between pipeline stages
+embedding_batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+pipeline_depth = int(os.environ.get("PIPELINE_DEPTH", 2))
+# Only embed chunks that are not indexed yet for the same url and drop the ones that disappeared
+incremental_indexing = os.environ.get("INCREMENTAL_INDEXING", "true").lower() == "true"
+# Longest time a removal waits for its delete-by-query task before reporting progress
+remove_wait_seconds = int(os.environ.get("REMOVE_WAIT_SECONDS", 60))
+# k-NN index profile of new indices, INDEX_PROFILE_OVERRIDES maps index names to other profiles
+index_profile = os.environ.get("INDEX_PROFILE", DEFAULT_PROFILE)
+index_profile_overrides = json.loads(os.environ.get("INDEX_PROFILE_OVERRIDES", "{}"))
+# Objects of one event indexed at the same time, they share the embedder and its Bedrock concurrency
+event_concurrency = int(os.environ.get("EVENT_CONCURRENCY", 4))
+# Objects of at least this size are split into byte-range work units and indexed in parallel
+# by the ingest worker lambda when INGEST_QUEUE_URL is set, "local" runs the units in this container
+fanout_min_bytes = int(os.environ.get("FANOUT_MIN_BYTES", 32 * 1024 * 1024))
+fanout_local_workers = int(os.environ.get("FANOUT_LOCAL_WORKERS", 4))
+# Time a worker keeps back to checkpoint and hand its unit back before the Lambda times out
+fanout_reserved_seconds = int(os.environ.get("FANOUT_RESERVED_SECONDS", 30))
+# Longest a worker may take removing stale chunks before another one can finish the job. Below
+# the visibility timeout of the queue, so the lease of a worker killed while finalizing has lapsed
+# when its unit is delivered again.
+fanout_finalize_seconds = int(os.environ.get("FANOUT_FINALIZE_SECONDS", 300))
+
+
+# Clients of the registry, taken again by every invocation so rotated credentials are picked up
+opensearch = registry.opensearch()
+s3 = registry.s3()
 
 chunk_size = 28000
 chunk_overlap = 0
@@ -31,55 +73,113 @@ chunk_overlap = 0
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len
 )
-
-auth = AWSV4SignerAuth(credentials, region, service)
-
-opensearch = OpenSearch(
-    hosts=[{"host": endpoint, "port": int(port)}],
-    http_auth=auth,
-    use_ssl=True,
-    verify_certs=True,
-    connection_class=RequestsHttpConnection,
-    timeout=300,
+# Chunk configuration recorded in the mapping of indices rebuilt by the reindex lambda, by concrete index
+index_chunking = {}
+text_splitters = {(chunk_size, chunk_overlap): text_splitter}
+
+# Uploads under <company>_index/ are split once into every granularity and written to
+# <company>_<granularity>_index, chunk sizes in characters
+granularity_chunk_sizes = json.loads(
+    os.environ.get("GRANULARITY_CHUNK_SIZES", '{"large": 28000, "medium": 7000, "small": 1750}')
 )
+granularity_chunk_overlap = int(os.environ.get("GRANULARITY_CHUNK_OVERLAP", 0))
+
+# Created on first use and kept for the lifetime of the container
+embedder = None
+embedder_lock = threading.Lock()
+# Objects of one event run in threads, two of them may find the same index missing
+create_index_lock = threading.Lock()
+# Drops deliveries of object states this container already indexed
+sequencer_log = SequencerLog()
+# Shares ANSWER_CACHE_TABLE with the response lambda so cached answers are dropped on index changes
+answer_cache = build_answer_cache()
+# Whether each concrete index maps url with a keyword sub-field, indices created before that only have text
+url_keyword_indices = {}
+# Work units of large documents and the progress of each, None when fan-out is off
+ingest_queue = build_queue()
+checkpoints = build_checkpoints()
+
+def refresh_clients():
+    # The registry rebuilds its clients when the credentials are about to expire
+    global opensearch, s3
+    opensearch = registry.opensearch()
+    s3 = registry.s3()
+
 
 @logger.inject_lambda_context(log_event=True)
 @tracer.capture_lambda_handler
 @event_source(data_class=S3Event)
 def lambda_handler(event: S3Event, context):
-    
-    service = 'es'
-    credentials = boto3.Session().get_credentials()
-    
-    logger.info(event)
-    documents_to_add, documents_to_remove = get_documents_from_s3_record(event)
-    index_documents = []
-
-    for document in documents_to_add:
-        index_documents.append(add_document_to_index(document))
-
-    for document in documents_to_remove:
-        index_documents.append(remove_document_from_index(document))
-
-    return index_documents
+    """Index the final state of every object of the event, EVENT_CONCURRENCY objects at a time.
+
+    Returns one result per object with the records collapsed into it.
+    """
+    refresh_clients()
+    objects = coalesce(event.records)
+    # Folders create the index their documents are written to and delete it with them
+    created_folders, documents, removed_folders = [], [], []
+    results = {}
+    for item in objects:
+        result = {
+            "bucket": item["bucket"],
+            "key": item["key"],
+            "event": item["event"],
+            "records": item["records"],
+            "duplicates": item["duplicates"],
+        }
+        results[(item["bucket"], item["key"])] = result
+        if not item["event"].startswith(("ObjectCreated", "ObjectRemoved")):
+            result["state"] = "IGNORED"
+        elif sequencer_log.is_stale(item["bucket"], item["key"], item["sequencer"]):
+            result["state"] = "STALE"
+        elif item["key"].endswith("/"):
+            (created_folders if item["event"].startswith("ObjectCreated") else removed_folders).append(item)
+        else:
+            documents.append(item)
+    logger.info(
+        f"{len(event['Records'])} records for {len(objects)} objects: {len(created_folders)} folders created, "
+        f"{len(documents)} documents, {len(removed_folders)} folders removed"
+    )
 
+    for phase in (created_folders, documents, removed_folders):
+        for item, (response, error) in zip(phase, run_concurrently(process_object, phase, event_concurrency)):
+            result = results[(item["bucket"], item["key"])]
+            if error is not None:
+                result.update(state="FAILED", error=repr(error))
+            else:
+                result.update(state="DONE", response=response)
+    return list(results.values())
 
-def get_documents_from_s3_record(event):
-    logger.debug(f"Getting documents from S3 record: ", event)
-    documents_to_add = []
-    documents_to_remove = []
 
-    for record in event.records:
-        event_name = record.event_name
-        if event_name.startswith("ObjectCreated"):
-            documents_to_add.append(record)
+def process_object(item):
+    if item["event"].startswith("ObjectCreated"):
+        response = add_document_to_index(item["record"])
+    else:
+        response = remove_document_from_index(item["record"])
+    sequencer_log.record(item["bucket"], item["key"], item["sequencer"])
+    return response
 
-        if event_name.startswith("ObjectRemoved"):
-            documents_to_remove.append(record)
 
-    logger.debug(f"documents_to_add: {documents_to_add}")
-    logger.debug(f"documents_to_remove: {documents_to_remove}")
-    return documents_to_add, documents_to_remove
+@logger.inject_lambda_context
+@tracer.capture_lambda_handler
+def unit_handler(event, context):
+    """Ingest worker: indexes the work units of the SQS messages of the event.
+
+    A unit that fails or runs out of time is reported back to SQS, which
+    delivers it again and the worker resumes from its checkpoint.
+    """
+    refresh_clients()
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - fanout_reserved_seconds
+    results = []
+    failures = []
+    for record in event["Records"]:
+        try:
+            results.append(process_unit(json.loads(record["body"]), deadline))
+        except Exception as e:
+            logger.warning(f"Work unit of message {record['messageId']} not finished: {e}")
+            failures.append({"itemIdentifier": record["messageId"]})
+    logger.info(results)
+    return {"batchItemFailures": failures}
 
 
 @tracer.capture_method
@@ -92,6 +192,9 @@ def add_document_to_index(document):
     url = f"s3://{bucket_name}/{object_key}"
     index_name = object_key.split("/")[0].lower()
     logger.info(f"Index: {index_name}")
+    company = granularity_company(index_name)
+    if company:
+        return add_document_to_granularity_indices(bucket_name, object_key, company)
     if object_key[-1] == "/":
         try:
              # Optional properties
@@ -103,7 +206,9 @@ def add_document_to_index(document):
             metadata_field = resource_properties.get("MetadataField", "metadata")
             port = resource_properties.get("Port", 443)
             timeout = resource_properties.get("Timeout", 300)
-            knn_algo_param_ef_search = resource_properties.get("KnnAlgoParamEfSearch", 512)
+            profile_name = resource_properties.get("Profile", index_profile_overrides.get(index_name, index_profile))
+            knn_algo_param_ef_search = resource_properties.get("KnnAlgoParamEfSearch")
+            forget_mappings(index_name)
             response = create_index(
                 opensearch,
                 index_name,
@@ -112,6 +217,7 @@ def add_document_to_index(document):
                 metadata_field,
                 dimension,
                 knn_algo_param_ef_search,
+                profile_name,
             )
             return response
         except Exception as e:
@@ -121,59 +227,466 @@ def add_document_to_index(document):
             return error
         
         
-    logger.info(f"Loading document from s3://{bucket_name}/{object_key}")
-    object_key_local = object_key.replace("/","")
-    local_file_name = '/tmp/' + object_key_local
-    s3.download_file(bucket_name, object_key, local_file_name)
-    
+    if ingest_queue is not None and document.s3.get_object.get("size", 0) >= fanout_min_bytes:
+        response = fan_out_document(bucket_name, object_key, index_name)
+        if response is not None:
+            return response
 
-    loader = TextLoader(local_file_name)
-    
-    logger.debug(f"loader: {loader}")
-
-    logger.info(f"Splitting document from s3://{bucket_name}/{object_key}")
-    texts = text_splitter.split_documents(loader.load())
-    logger.debug(f"texts: {texts}")
-
-    text_data = [text.page_content for text in texts]
-    logger.debug(f"text_data: {text_data}")
-    logger.info(text_data)
-
-    text_data_split = [
-        text_data[i : i + chunk_size] for i in range(0, len(text_data), chunk_size)
-    ]
-
-    query_result = []
-    logger.info(f"LOG---> indexing document: {object_key} ----- Using chunk_size: {chunk_size} ----- in index: {index_name}")
-    for chunk in text_data_split:
-        query_result_current = _get_embeddings(chunk)
-        query_result.extend(query_result_current)
-
-    data = list(zip(text_data, query_result))
-    logger.debug(f"data: {data}")
-
-    for item in data:
-        logger.info(f"Indexing document for {object_key}")
-        logger.debug(f"item: {item}")
-        index_id = hashlib.md5(item[0].encode()).hexdigest()
-        response = opensearch.index(
-            index=index_name,
-            id = index_id,
-            body={"vector_field": item[1], "text": item[0], "url": url},
-        )
-        print(f"Document {url} added:")
-        print(response)
+    logger.info(f"Streaming document from s3://{bucket_name}/{object_key}")
+    # Read, split, embed and write stage by stage so only a few batches are in memory
+    existing_ids = get_indexed_ids(index_name, url) if incremental_indexing else set()
+    seen_ids = set()
+    pieces = iter_s3_text(s3, bucket_name, object_key)
+    splitter, index_chunk_size = get_text_splitter(index_name)
+    chunks = _skip_indexed(
+        split_stream(pieces, splitter, window=2 * index_chunk_size), existing_ids, seen_ids
+    )
+    embedding_stats = EmbeddingStats()
+    embed = partial(_embed_batch, stats=embedding_stats)
+    batches = pipeline(batched(chunks, embedding_batch_size), embed, maxsize=pipeline_depth)
+
+    logger.info(f"LOG---> indexing document: {object_key} ----- Using chunk_size: {index_chunk_size} ----- in index: {index_name}")
+    if bulk_indexing:
+        stats = bulk_index(index_name, url, batches, existing_ids, seen_ids)
+    else:
+        stats = single_index(index_name, url, batches, existing_ids, seen_ids)
+    stats["unchanged"] = len(existing_ids & seen_ids)
+    logger.info(
+        f"Indexed {stats['indexed']} chunks of {url}, {stats['unchanged']} unchanged, "
+        f"{stats['deleted']} deleted, {stats['failed']} failed"
+    )
+    logger.info(f"Embedding throughput for {url}: {embedding_stats.as_dict()}")
+    if stats["indexed"] or stats["deleted"]:
+        invalidate_answers(index_name)
 
     response = {
         "bucket": bucket_name,
         "key": object_key,
-        "indexed": len(query_result),
+        **stats,
+        "embedding": embedding_stats.as_dict(),
     }
 
     logger.debug(f"response: {response}")
     return response
 
 
+def granularity_company(index_name):
+    """Company of a <company>_index upload prefix, whose documents go to every granularity.
+
+    Company names can have underscores, <company>_<size>_index is the index of one granularity.
+    """
+    if not index_name.endswith("_index"):
+        return None
+    company = index_name[:-len("_index")]
+    if not company or any(company.endswith(f"_{name}") for name in granularity_chunk_sizes):
+        return None
+    return company
+
+
+def granularity_indices(company):
+    return {name: f"{company}_{name}_index" for name in granularity_chunk_sizes}
+
+
+@tracer.capture_method
+def add_document_to_granularity_indices(bucket_name, object_key, company):
+    """Read a document once and write its chunks of every granularity to their indices.
+
+    Each chunk keeps its offset in the document, and the id and offset of the
+    chunk of the next larger granularity it was split from.
+    """
+    targets = granularity_indices(company)
+    with create_index_lock:
+        for index_name in targets.values():
+            if not opensearch.indices.exists(index=index_name):
+                create_index(opensearch, index_name, "vector_field", "text", "metadata", 1536,
+                             profile_name=index_profile_overrides.get(index_name, index_profile))
+    if object_key[-1] == "/":
+        return {"bucket": bucket_name, "key": object_key, "indices": list(targets.values())}
+
+    url = f"s3://{bucket_name}/{object_key}"
+    # Largest chunks first, a reindexed index keeps the chunk size recorded in its mapping
+    levels = []
+    for name, index_name in targets.items():
+        size, overlap = get_chunking(index_name, granularity_chunk_sizes[name], granularity_chunk_overlap)
+        levels.append((size, name, get_splitter(size, overlap)))
+    levels.sort(key=lambda level: level[0], reverse=True)
+    logger.info(f"Indexing {url} at chunk sizes {[(name, size) for size, name, _ in levels]}")
+
+    existing_ids = {
+        name: get_indexed_ids(index_name, url) if incremental_indexing else set()
+        for name, index_name in targets.items()
+    }
+    seen_ids = {name: set() for name in targets}
+    chunks = split_hierarchy(
+        iter_s3_text(s3, bucket_name, object_key),
+        [(name, splitter) for _, name, splitter in levels],
+        window=2 * levels[0][0],
+    )
+    records = _granularity_records(chunks, existing_ids, seen_ids)
+    embedding_stats = EmbeddingStats()
+    embed = partial(_embed_records, stats=embedding_stats)
+    batches = pipeline(batched(records, embedding_batch_size), embed, maxsize=pipeline_depth)
+
+    with ExitStack() as stack:
+        indexers = {}
+        for name, index_name in targets.items():
+            stack.enter_context(deferred_refresh(opensearch, index_name))
+            indexers[name] = stack.enter_context(BulkIndexer(opensearch, index_name))
+        for batch in batches:
+            for record, vector in batch:
+                indexers[record["granularity"]].add(record["id"], {
+                    "vector_field": vector,
+                    "text": record["text"],
+                    "url": url,
+                    "offset": record["offset"],
+                    "parent_id": record["parent_id"],
+                    "parent_offset": record["parent_offset"],
+                })
+        for name in targets:
+            for index_id in existing_ids[name] - seen_ids[name]:
+                indexers[name].delete(index_id)
+
+    indices = {}
+    for name, index_name in targets.items():
+        indices[index_name] = {**indexers[name].stats(), "unchanged": len(existing_ids[name] & seen_ids[name])}
+        logger.info(f"Indexed chunks of {url} in {index_name}: {indices[index_name]}")
+    logger.info(f"Embedding throughput for {url}: {embedding_stats.as_dict()}")
+    if any(stats["indexed"] or stats["deleted"] for stats in indices.values()):
+        answer_cache.invalidate(company)
+
+    return {
+        "bucket": bucket_name,
+        "key": object_key,
+        "indices": indices,
+        "embedding": embedding_stats.as_dict(),
+    }
+
+
+def _granularity_records(chunks, existing_ids, seen_ids):
+    for chunk in chunks:
+        # Set before skipping so the children of an unchanged chunk still know their parent
+        chunk["id"] = hashlib.md5(chunk["text"].encode()).hexdigest()
+        name = chunk["granularity"]
+        if chunk["id"] in seen_ids[name]:
+            continue
+        seen_ids[name].add(chunk["id"])
+        if chunk["id"] in existing_ids[name]:
+            continue
+        parent = chunk["parent"]
+        yield {
+            "granularity": name,
+            "id": chunk["id"],
+            "text": chunk["text"],
+            "offset": chunk["offset"],
+            "parent_id": parent["id"] if parent else None,
+            "parent_offset": chunk["parent_offset"],
+        }
+
+
+def _embed_records(records, stats=None):
+    # Embed each distinct text once, a chunk shorter than the next chunk size is its own only child
+    texts = list(dict.fromkeys(record["text"] for record in records))
+    vectors = dict(zip(texts, _get_embeddings(texts, stats)))
+    return [(record, vectors[record["text"]]) for record in records]
+
+
+@tracer.capture_method
+def remove_document_from_granularity_indices(bucket_name, object_key, company):
+    url = f"s3://{bucket_name}/{object_key}"
+    response = {"bucket": bucket_name, "key": object_key}
+    for index_name in granularity_indices(company).values():
+        if not opensearch.indices.exists(index=index_name):
+            continue
+        if object_key[-1] == "/":
+            concrete = mapping_key(index_name)
+            response[index_name] = opensearch.indices.delete(index=concrete)
+            forget_mappings(index_name, concrete)
+        else:
+            response[index_name] = delete_by_url(index_name, url)
+    answer_cache.invalidate(company)
+    logger.info(response)
+    return response
+
+
+def mapping_key(index_name):
+    """The indices behind ``index_name``, what the mapping caches are keyed on.
+
+    A reindex moves the alias to an index with its own mapping, which is then read
+    on the next document instead of the one cached for the old index.
+    """
+    return ",".join(concrete_indices(opensearch, index_name))
+
+
+def forget_mappings(*names):
+    for name in names:
+        url_keyword_indices.pop(name, None)
+        index_chunking.pop(name, None)
+
+
+def get_chunking(index_name, default_size=chunk_size, default_overlap=chunk_overlap):
+    """Chunk size and overlap recorded in the index mapping by a reindex, or the defaults."""
+    key = mapping_key(index_name)
+    if key not in index_chunking:
+        meta = {}
+        if opensearch.indices.exists(index=key):
+            mapping = opensearch.indices.get_mapping(index=key)
+            meta = next(iter(mapping.values()))["mappings"].get("_meta", {})
+        index_chunking[key] = meta
+    meta = index_chunking[key]
+    return meta.get("chunk_size", default_size), meta.get("chunk_overlap", default_overlap)
+
+
+def get_splitter(size, overlap):
+    if (size, overlap) not in text_splitters:
+        text_splitters[(size, overlap)] = RecursiveCharacterTextSplitter(
+            chunk_size=size, chunk_overlap=overlap, length_function=len
+        )
+    return text_splitters[(size, overlap)]
+
+
+def get_text_splitter(index_name):
+    """The splitter of the index and its chunk size."""
+    size, overlap = get_chunking(index_name)
+    return get_splitter(size, overlap), size
+
+
+def get_indexed_ids(index_name, url):
+    """Ids of the chunks already stored for ``url``, chunk ids are the md5 of their text."""
+    if not opensearch.indices.exists(index=index_name):
+        return set()
+    hits = scan(
+        opensearch,
+        index=index_name,
+        query={"query": url_query(index_name, url), "_source": False},
+        size=1000,
+    )
+    return {hit["_id"] for hit in hits}
+
+
+def _skip_indexed(chunks, existing_ids, seen_ids):
+    for chunk in chunks:
+        index_id = hashlib.md5(chunk.encode()).hexdigest()
+        if index_id in seen_ids:
+            continue
+        seen_ids.add(index_id)
+        if index_id not in existing_ids:
+            yield chunk
+
+
+@tracer.capture_method
+def bulk_index(index_name, url, batches, existing_ids, seen_ids):
+    # Refresh once after the whole file is written instead of on every interval
+    with deferred_refresh(opensearch, index_name):
+        with BulkIndexer(opensearch, index_name) as indexer:
+            for batch in batches:
+                for text, vector in batch:
+                    index_id = hashlib.md5(text.encode()).hexdigest()
+                    indexer.add(index_id, {"vector_field": vector, "text": text, "url": url})
+            # The whole document has been read, what was not seen again is stale
+            for index_id in existing_ids - seen_ids:
+                indexer.delete(index_id)
+    return indexer.stats()
+
+
+def single_index(index_name, url, batches, existing_ids, seen_ids):
+    indexed = 0
+    deleted = 0
+    failed = 0
+    for text, vector in (item for batch in batches for item in batch):
+        index_id = hashlib.md5(text.encode()).hexdigest()
+        try:
+            opensearch.index(
+                index=index_name,
+                id=index_id,
+                body={"vector_field": vector, "text": text, "url": url},
+            )
+            indexed += 1
+        except Exception as e:
+            logger.error(f"Failed to index {index_id} of {url}: {e}")
+            failed += 1
+    for index_id in existing_ids - seen_ids:
+        opensearch.delete(index=index_name, id=index_id, ignore=[404])
+        deleted += 1
+    return {"indexed": indexed, "deleted": deleted, "failed": failed}
+
+
+@tracer.capture_method
+def fan_out_document(bucket_name, object_key, index_name):
+    """Split a large object into work units of whole chunks and queue them.
+
+    The object is read once without embedding to find the byte range of every
+    chunk. Deliveries of the same upload get the same job, so a retried event
+    queues the units again and the workers skip the finished ones. Returns
+    None when the chunks cannot be mapped to byte ranges.
+    """
+    url = f"s3://{bucket_name}/{object_key}"
+    etag = s3.head_object(Bucket=bucket_name, Key=object_key)["ETag"]
+    job = job_id(url, etag)
+    stored = checkpoints.get_job(job)
+    if stored and "result" in stored:
+        logger.info(f"Job {job} of {url} already finished: {stored['result']}")
+        return {"bucket": bucket_name, "key": object_key, "job": job, "units": stored["units"],
+                "state": stored["result"]["state"], "finalized": stored["result"]}
+
+    size, overlap = get_chunking(index_name)
+    pieces = iter_s3_text(s3, bucket_name, object_key, errors="surrogateescape", IfMatch=etag)
+    try:
+        units = plan_units(chunk_ranges(pieces, get_splitter(size, overlap), window=2 * size))
+    except ValueError as e:
+        logger.warning(f"Indexing {url} in one invocation: {e}")
+        return None
+
+    record = {
+        "bucket": bucket_name,
+        "key": object_key,
+        "etag": etag,
+        "index": index_name,
+        "chunk_size": size,
+        "chunk_overlap": overlap,
+        "units": len(units),
+    }
+    checkpoints.start_job(job, record)
+    ingest_queue.send({"job": job, **record, **unit} for unit in units)
+    logger.info(f"Queued {len(units)} work units of {url} as job {job}")
+    response = {"bucket": bucket_name, "key": object_key, "job": job, "units": len(units), "state": "QUEUED"}
+    if not ingest_queue.local:
+        return response
+
+    # No worker lambda, the units run on threads of this container
+    dead_letters = len(ingest_queue.dead_letters)
+    results = ingest_queue.drain(process_unit, workers=fanout_local_workers)
+    for name in ("indexed", "unchanged", "failed"):
+        response[name] = sum(result.get(name, 0) for result in results)
+    response["finalized"] = next((result["finalized"] for result in results if "finalized" in result), None)
+    response["dead_letters"] = len(ingest_queue.dead_letters) - dead_letters
+    response["state"] = response["finalized"]["state"] if response["finalized"] else "INCOMPLETE"
+    return response
+
+
+@tracer.capture_method
+def process_unit(message, deadline=None):
+    """Embed and write the chunks of one work unit, checkpointing after every batch.
+
+    Raises TimeoutError once ``deadline`` (``time.monotonic()``) has passed, the
+    next delivery of the unit continues after its last checkpoint.
+    """
+    job, unit = message["job"], message["unit"]
+    index_name = message["index"]
+    url = f"s3://{message['bucket']}/{message['key']}"
+    progress = checkpoints.get_unit(job, unit)
+    if progress["done"]:
+        return complete_unit(message, {"state": "DONE"})
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError(f"No time left for unit {unit} of job {job}")
+
+    try:
+        data = s3.get_object(
+            Bucket=message["bucket"], Key=message["key"], Range=range_header(message), IfMatch=message["etag"]
+        )["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("PreconditionFailed", "412"):
+            raise
+        # A newer upload has its own job, which also removes the chunks of this one
+        logger.info(f"{url} changed after job {job} was planned, unit {unit} skipped")
+        return {"job": job, "unit": unit, "state": "SUPERSEDED"}
+
+    chunks = list(enumerate(unit_texts(data, message)))
+    ids = {position: hashlib.md5(text.encode()).hexdigest() for position, text in chunks}
+    existing_ids = get_existing_ids(index_name, set(ids.values())) if incremental_indexing else set()
+    seen_ids = set()
+    pending = []
+    for position, text in chunks[progress["chunks_done"]:]:
+        if ids[position] in seen_ids or ids[position] in existing_ids:
+            continue
+        seen_ids.add(ids[position])
+        pending.append((position, text))
+
+    embedding_stats = EmbeddingStats()
+    embed = partial(_embed_positions, stats=embedding_stats)
+    batches = pipeline(batched(pending, embedding_batch_size), embed, maxsize=pipeline_depth)
+    with BulkIndexer(opensearch, index_name) as indexer:
+        for batch in batches:
+            for position, text, vector in batch:
+                indexer.add(ids[position], {"vector_field": vector, "text": text, "url": url})
+            indexer.flush()
+            if indexer.failed:
+                raise RuntimeError(f"{indexer.failed} chunks of unit {unit} of job {job} were not written: {indexer.errors}")
+            checkpoints.save_unit(job, unit, batch[-1][0] + 1)
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Unit {unit} of job {job} paused after chunk {batch[-1][0]}")
+
+    stats = {
+        "state": "DONE",
+        "indexed": indexer.indexed,
+        "unchanged": len(chunks) - progress["chunks_done"] - len(pending),
+        "failed": indexer.failed,
+        "embedding": embedding_stats.as_dict(),
+    }
+    return complete_unit(message, stats)
+
+
+def complete_unit(message, stats):
+    """Record the unit as done, the worker completing the last one finishes the job.
+
+    A failed finalization gives its lease back and fails the unit, the next delivery
+    of any completed unit of the job finalizes it again.
+    """
+    job, unit = message["job"], message["unit"]
+    response = {"job": job, "unit": unit, **stats}
+    completed = checkpoints.complete_unit(job, unit)
+    if completed < message["units"]:
+        return response
+    lease = checkpoints.claim_finalize(job, fanout_finalize_seconds)
+    if lease is None:
+        return response
+    try:
+        response["finalized"] = finalize_job(message)
+    except Exception:
+        checkpoints.release_finalize(job, lease)
+        raise
+    return response
+
+
+@tracer.capture_method
+def finalize_job(message):
+    """Drop the chunks the new version of the document no longer has and refresh once."""
+    bucket_name, object_key, index_name = message["bucket"], message["key"], message["index"]
+    url = f"s3://{bucket_name}/{object_key}"
+    result = {"state": "DONE", "deleted": 0}
+    if s3.head_object(Bucket=bucket_name, Key=object_key)["ETag"] != message["etag"]:
+        result["state"] = "SUPERSEDED"
+    elif incremental_indexing:
+        # Same split as the plan, the ids are those the workers wrote
+        pieces = iter_s3_text(s3, bucket_name, object_key, errors="surrogateescape", IfMatch=message["etag"])
+        splitter = get_splitter(message["chunk_size"], message["chunk_overlap"])
+        ids = {
+            hashlib.md5(text.encode()).hexdigest()
+            for _, _, text in chunk_ranges(pieces, splitter, window=2 * message["chunk_size"])
+        }
+        with BulkIndexer(opensearch, index_name) as indexer:
+            for index_id in get_indexed_ids(index_name, url) - ids:
+                indexer.delete(index_id)
+        result["deleted"] = indexer.deleted
+    opensearch.indices.refresh(index=index_name)
+    invalidate_answers(index_name)
+    checkpoints.finish_job(message["job"], result)
+    logger.info(f"Finished job {message['job']} of {url}: {result}")
+    return result
+
+
+def get_existing_ids(index_name, ids):
+    """Which of ``ids`` the index already holds."""
+    if not ids or not opensearch.indices.exists(index=index_name):
+        return set()
+    response = opensearch.mget(index=index_name, body={"ids": sorted(ids)}, _source=False)
+    return {doc["_id"] for doc in response["docs"] if doc.get("found")}
+
+
+def _embed_positions(items, stats=None):
+    vectors = _get_embeddings([text for _, text in items], stats)
+    return [(position, text, vector) for (position, text), vector in zip(items, vectors)]
+
+
 @tracer.capture_method
 def remove_document_from_index(document):
     bucket_name = document.s3.bucket.name
@@ -184,11 +697,16 @@ def remove_document_from_index(document):
 
     url = f"s3://{bucket_name}/{object_key}"
     index_name = object_key.split("/")[0].lower()
+    company = granularity_company(index_name)
+    if company:
+        return remove_document_from_granularity_indices(bucket_name, object_key, company)
     
     if object_key[-1] == "/":
-        response = opensearch.indices.delete(
-            index = index_name
-        )
+        # A restored index is served under an alias, delete the indices behind it
+        concrete = mapping_key(index_name)
+        response = opensearch.indices.delete(index=concrete)
+        forget_mappings(index_name, concrete)
+        invalidate_answers(index_name)
         logger.info(f"Found {index_name} index to delete")
         response = {
             "bucket": bucket_name,
@@ -196,19 +714,13 @@ def remove_document_from_index(document):
             "removed": response,
         }
     else:
-        response = opensearch.search(
-            index=index_name, body={"query": {"match": {"url": url}},"size": 10000}
-        )
-        logger.info(f"Found {response['hits']['total']['value']} documents to delete")
-
-        for hit in response["hits"]["hits"]:
-            logger.info(f"Deleting document {hit['_id']}")
-            opensearch.delete(index=index_name, id=hit["_id"])
-
+        response = delete_by_url(index_name, url)
+        logger.info(f"Removed {response['removed']} documents of {url}")
+        invalidate_answers(index_name)
         response = {
             "bucket": bucket_name,
             "key": object_key,
-            "removed": response["hits"]["total"]["value"],
+            **response,
         }
 
     logger.debug(f"response: {response}")
@@ -216,27 +728,79 @@ def remove_document_from_index(document):
 
 
 
-def _get_embeddings(inputs):
-    logger.debug(f"Running get embeddings with inputs: {inputs}")
+def invalidate_answers(index_name):
+    # Answers are cached per company, indices not named after one are cached under their own name
+    answer_cache.invalidate(company_of_index(index_name) or index_name)
 
-    embeddings = BedrockEmbeddings(
-        client=get_bedrock_client(),
-        model_id=model_id
+
+def url_query(index_name, url):
+    """Exact match on the document url, using the keyword sub-field when the index has one."""
+    key = mapping_key(index_name)
+    if key not in url_keyword_indices:
+        mapping = opensearch.indices.get_mapping(index=key)
+        properties = next(iter(mapping.values()))["mappings"].get("properties", {})
+        url_keyword_indices[key] = "keyword" in properties.get("url", {}).get("fields", {})
+    if url_keyword_indices[key]:
+        return {"term": {"url.keyword": url}}
+    return {"match_phrase": {"url": url}}
+
+
+@tracer.capture_method
+def delete_by_url(index_name, url):
+    """Remove every chunk of ``url`` with one sliced delete-by-query task."""
+    task = opensearch.delete_by_query(
+        index=index_name,
+        body={"query": url_query(index_name, url)},
+        conflicts="proceed",
+        slices="auto",
+        refresh=True,
+        wait_for_completion=False,
     )
+    task_id = task["task"]
+
+    # Poll with backoff up to the configured wait, a large delete keeps running server side
+    deadline = time.monotonic() + remove_wait_seconds
+    delay = 0.2
+    while True:
+        status = opensearch.tasks.get(task_id=task_id)
+        if status.get("completed") or time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+    result = status.get("response") or status["task"]["status"]
+    return {
+        "removed": result.get("deleted", 0),
+        "completed": bool(status.get("completed")),
+        "task": task_id,
+        "failures": result.get("failures", []),
+    }
+
+
+def _embed_batch(texts, stats=None):
+    return list(zip(texts, _get_embeddings(texts, stats)))
 
-    logger.debug("Getting embeddings")
-    query_result = embeddings.embed_documents(inputs)
-    logger.debug(f"embeddings: {query_result}")
+
+def _get_embeddings(inputs, stats=None):
+    logger.debug(f"Running get embeddings for {len(inputs)} inputs")
+
+    # Vectors come back in input order so they can be zipped with the texts
+    query_result = get_embedder().embed_documents(inputs, stats)
+    logger.debug(f"embeddings: {len(query_result)}")
 
     return query_result
 
 
+def get_embedder():
+    global embedder
+    with embedder_lock:
+        if embedder is None:
+            embedder = BatchEmbedder(get_bedrock_client(), model_id)
+    return embedder
+
+
 def get_bedrock_client():
-    bedrock_region_name = os.environ["BEDROCK_REGION"]
-    return boto3.client(
-        "bedrock-runtime",
-        region_name=bedrock_region_name
-    )
+    return registry.bedrock_runtime()
     
 
 def create_index(
@@ -246,36 +810,23 @@ def create_index(
     text_field,
     metadata_field,
     dimension,
-    knn_algo_param_ef_search,
+    knn_algo_param_ef_search=None,
+    profile_name=DEFAULT_PROFILE,
 ):
-    index_body = {
-        "settings": {
-            "index": {
-                "knn": True,
-                "knn.algo_param.ef_search": knn_algo_param_ef_search,
-            }
-        },
-        "mappings": {
-            "properties": {
-                vector_field: {
-                    "type": "knn_vector",
-                    "dimension": int(dimension),
-                    "method": {
-                        "name": "hnsw",
-                        "space_type": "l2",
-                        "engine": "nmslib",
-                        "parameters": {"ef_construction": 512, "m": 16},
-                    },
-                },
-                text_field: {"type": "text", "index": False},
-                "url": {"type": "text", "index": True},
-            }
-        },
-    }
-    logger.info(f"Creating index {index_name} with body:")
-    logger.info(index_body)
-
-    response = opensearch.indices.create(index_name, body=index_body)
+    profile = get_profile(profile_name)
+    if knn_algo_param_ef_search is not None:
+        profile = with_ef_search(profile, knn_algo_param_ef_search)
+    model_id = None
+    if profile.get("training"):
+        # Trained once per index, e.g. with benchmarks/index_profiles.py --train-for
+        model_id = model_id_for(index_name, profile_name)
+        if model_state(opensearch, model_id) != "created":
+            raise ValueError(f"Profile {profile_name} needs the trained k-NN model {model_id}")
+    body = index_body(profile, dimension, vector_field, text_field, model_id=model_id)
+    logger.info(f"Creating index {index_name} with profile {profile_name} and body:")
+    logger.info(body)
+
+    response = opensearch.indices.create(index_name, body=body)
     logger.info(response)
     return response
 
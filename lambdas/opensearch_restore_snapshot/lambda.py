@@ -2,66 +2,152 @@
 # SPDX-License-Identifier: MIT-0
 
 
-import boto3
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+# Restores indices from a snapshot without taking search down.
+#
+# "swap" mode (the default) restores the selected indices under versioned names,
+# waits for their shards to recover, warms their k-NN graphs up and then moves the
+# read aliases over in one atomic call. The indices they replace are deleted last.
+# Event: {"indices": ["amazon_*"], "snapshot": "<name>"}, every index of the latest
+# snapshot by default. When recovery outlives RESTORE_MAX_WAIT_SECONDS the response
+# has "swap", invoking again with {"swap": {...}} finishes the job. On a cluster that
+# has none of the indices yet, e.g. the first deploy, there is nothing to keep serving:
+# the aliases are created right away and the shards recover behind them.
+#
+# "replace" mode ({"mode": "replace"}) is the original one: delete every index and
+# restore the whole snapshot over it.
+
 import os
+import time
+import fnmatch
+from aws_lambda_powertools import Logger
+from assistant_utils.clients import registry
+from assistant_utils.aliases import (
+    RENAME_PATTERN,
+    base_name,
+    new_version,
+    swap_aliases,
+    versioned_name,
+    wait_for_recovery,
+    warmup_knn,
+)
+from assistant_utils.snapshots import (
+    latest_snapshot,
+    register_repository,
+    repository_settings,
+)
 
+logger = Logger()
 
+REPOSITORY = os.environ.get("SNAPSHOT_REPOSITORY", "last_snapshot_repo")
+# Restored when the event does not name a snapshot and the repository has no other one
+DEFAULT_SNAPSHOT = os.environ.get("RESTORE_SNAPSHOT", "last_snapshot")
+# Longest a run waits for the restored shards to recover
+MAX_WAIT_SECONDS = int(os.environ.get("RESTORE_MAX_WAIT_SECONDS", "180"))
+# Health the restored indices need before the aliases move, green also waits for replicas
+WAIT_FOR_STATUS = os.environ.get("RESTORE_WAIT_FOR_STATUS", "yellow")
 
-def lambda_handler(event, context):
-    endpoint = os.environ["OPENSEARCH_ENDPOINT"]
-
-    snapshot_bucket = os.environ["SNAPSHOT_BUCKET"]
-    iam_role = os.environ["IAM_ROLE"]
-
-    port = os.environ.get("OPENSEARCH_ENDPOINT_PORT", 443)
-    region = os.environ["REGION"]
-    service = 'es'
-    credentials = boto3.Session().get_credentials()
-
-    auth = AWSV4SignerAuth(credentials, region, service)
-    opensearch = OpenSearch(
-        hosts=[{"host": endpoint, "port": int(port)}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        timeout=300,
-    )
-    
+
+def selected_indices(snapshot_indices, patterns):
+    """Indices of the snapshot matching ``patterns``, a "-" prefix excludes."""
+    if isinstance(patterns, str):
+        patterns = patterns.split(",")
+    selected = []
+    for name in snapshot_indices:
+        if name.startswith("."):
+            continue
+        included = False
+        for pattern in patterns:
+            if pattern.startswith("-"):
+                if fnmatch.fnmatch(name, pattern[1:]):
+                    included = False
+            elif fnmatch.fnmatch(name, pattern):
+                included = True
+        if included:
+            selected.append(name)
+    return sorted(selected)
+
+
+def finish_swap(opensearch, targets, deadline):
+    """Wait for recovery, warm up and swap, or hand the targets back to the next run.
+
+    Without any live index or alias for the targets the aliases are created at once,
+    the deploy-time trigger invokes asynchronously and would drop a "swap" response.
+    """
+    indices = sorted(targets.values())
+    if not any(opensearch.indices.exists(index=alias) for alias in targets):
+        replaced = swap_aliases(opensearch, targets)
+        logger.info(f"No live index for {sorted(targets)}, aliases created while {indices} recover")
+        return {"state": "SWAPPED", "aliases": targets, "warmup": None, "replaced": replaced}
+    if not wait_for_recovery(opensearch, indices, deadline, status=WAIT_FOR_STATUS):
+        logger.info(f"Indices {indices} still recovering, invoke again with the swap of the response")
+        return {"state": "RECOVERING", "swap": targets}
+
+    warmup = warmup_knn(opensearch, indices)
+    replaced = swap_aliases(opensearch, targets)
+    return {"state": "SWAPPED", "aliases": targets, "warmup": warmup, "replaced": replaced}
+
+
+def replace_all(opensearch, snapshot_name):
     #delete indices (just in case)
-    r = opensearch.indices.delete(
-        index = "*"
-    )
-    print("INDICES DELETED",r)
-    
-    repository_name = "last_snapshot_repo"
-    snapshot_name = "last_snapshot"
-    
-    
-    #register repository:
-    payload = {
-    "type": "s3",
-    "settings": {
-        "bucket": snapshot_bucket,
-        "base_path": "snapshot/",
-        "region": region,
-        "role_arn": iam_role
-    }
-    }
-    print("Sending put request for register the repository")
-    response = opensearch.snapshot.create_repository(repository=repository_name, body=payload)
-    print("Repository registered",response)
-    
-   
-    # Restore the snapshot to a specific index
-    index_to_restore = "*" # Name of the index to restore
-
-    r = opensearch.snapshot.restore(repository=repository_name, snapshot=snapshot_name, body={
-     "indices": index_to_restore,
-     "ignore_unavailable": True,
-     "include_global_state": False
+    r = opensearch.indices.delete(index="*,-.*")
+    logger.info(f"INDICES DELETED {r}")
+
+    r = opensearch.snapshot.restore(repository=REPOSITORY, snapshot=snapshot_name, body={
+        "indices": "*,-.*",
+        "ignore_unavailable": True,
+        "include_global_state": False
     })
-    print("INDICES restored",r)
-    
+    logger.info(f"INDICES restored {r}")
     return r
+
+
+def lambda_handler(event, context):
+    event = event or {}
+    opensearch = registry.opensearch()
+
+    # Leave time to swap the aliases and return before the Lambda times out
+    wait_seconds = min(MAX_WAIT_SECONDS, context.get_remaining_time_in_millis() / 1000 - 30)
+    deadline = time.monotonic() + max(wait_seconds, 0)
+
+    if event.get("swap"):
+        response = finish_swap(opensearch, event["swap"], deadline)
+        logger.info(response)
+        return response
+
+    settings = repository_settings(os.environ["SNAPSHOT_BUCKET"], os.environ["IAM_ROLE"], os.environ["REGION"])
+    register_repository(opensearch, REPOSITORY, settings)
+
+    snapshot = event.get("snapshot")
+    if not snapshot:
+        latest = latest_snapshot(opensearch, REPOSITORY)
+        snapshot = latest["snapshot"] if latest else DEFAULT_SNAPSHOT
+
+    if event.get("mode", "swap") == "replace":
+        return replace_all(opensearch, snapshot)
+
+    info = opensearch.snapshot.get(repository=REPOSITORY, snapshot=snapshot)["snapshots"][0]
+    indices = selected_indices(info["indices"], event.get("indices", "*"))
+    if not indices:
+        logger.info(f"No index of snapshot {snapshot} matches {event.get('indices')}")
+        return {"state": "NOTHING_TO_RESTORE", "snapshot": snapshot}
+
+    # Restored next to the live indices, searches keep using those until the swap
+    version = new_version()
+    targets = {base_name(name): versioned_name(name, version) for name in indices}
+    r = opensearch.snapshot.restore(
+        repository=REPOSITORY,
+        snapshot=snapshot,
+        body={
+            "indices": ",".join(indices),
+            "ignore_unavailable": True,
+            "include_global_state": False,
+            "include_aliases": False,
+            "rename_pattern": RENAME_PATTERN,
+            "rename_replacement": f"$1-{version}",
+        },
+    )
+    logger.info(f"Restoring {indices} of {snapshot} as version {version}: {r}")
+
+    response = {"snapshot": snapshot, **finish_swap(opensearch, targets, deadline)}
+    logger.info(response)
+    return response
@@ -2,76 +2,104 @@
 # SPDX-License-Identifier: MIT-0
 
 
-import boto3
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
-import os
+# Takes incremental, timestamped snapshots of the assistant indices without blocking.
+# Each run resumes the snapshot still in progress, if any, instead of starting another
+# one, polls it with backoff for at most SNAPSHOT_MAX_WAIT_SECONDS and returns.
+# The schedule runs it again until the snapshot completes, then old ones are pruned.
 
+import os
+import time
+from datetime import datetime, timezone
+from aws_lambda_powertools import Logger
+from assistant_utils.clients import registry
+from assistant_utils.snapshots import (
+    COMPLETED_STATES,
+    RUNNING_STATES,
+    latest_snapshot,
+    list_snapshots,
+    prune_snapshots,
+    register_repository,
+    repository_settings,
+    snapshot_name,
+    wait_for_snapshot,
+)
 
-def lambda_handler(event, context):
-    endpoint = os.environ["OPENSEARCH_ENDPOINT"]
-    port = os.environ.get("OPENSEARCH_ENDPOINT_PORT", 443)
-    region = os.environ["REGION"]
-    service = "es"
-    credentials = boto3.Session().get_credentials()
+logger = Logger()
 
-    auth = AWSV4SignerAuth(credentials, region, service)
-    opensearch = OpenSearch(
-        hosts=[{"host": endpoint, "port": int(port)}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        timeout=300,
-    )
+REPOSITORY = os.environ.get("SNAPSHOT_REPOSITORY", "last_snapshot_repo")
+# Only snapshots named <prefix>-<timestamp> are pruned, the one shipped with the workshop is kept
+PREFIX = os.environ.get("SNAPSHOT_PREFIX", "assistant")
+# Hidden and system indices are left out
+INDICES = os.environ.get("SNAPSHOT_INDICES", "*,-.*")
+# Completed snapshots to keep
+RETENTION = max(int(os.environ.get("SNAPSHOT_RETENTION", "7")), 1)
+# A new snapshot is started when the last completed one is older than this
+INTERVAL_MINUTES = int(os.environ.get("SNAPSHOT_INTERVAL_MINUTES", "1440"))
+# Longest a run waits for the snapshot, the next scheduled run picks it up from there
+MAX_WAIT_SECONDS = int(os.environ.get("SNAPSHOT_MAX_WAIT_SECONDS", "60"))
+# Copy throttle of the repository, lower it if snapshots slow searches down
+MAX_BYTES_PER_SEC = os.environ.get("SNAPSHOT_MAX_BYTES_PER_SEC", "20mb")
 
-    # Register repository
 
-    repository_name = "last_snapshot_repo"
-    snapshot_name = "last_snapshot"
+def age_minutes(snapshot):
+    started = snapshot.get("start_time_in_millis", 0) / 1000
+    return (datetime.now(timezone.utc).timestamp() - started) / 60
 
-    payload = {
-        "type": "s3",
-        "settings": {
-            "bucket": "re-invent-chatbot-snapshotbucketb2bf31d3-1xclu7rubowji",
-            "base_path": "snapshot/",
-            "region": region,
-            "role_arn": "arn:aws:iam::385951263826:role/re-invent-chatbot-SnapshotRole53D7C789-Cklx4EoEwiLA",
-        },
-    }
 
-    print("Sending put request for register the repository")
+def lambda_handler(event, context):
+    event = event or {}
+    opensearch = registry.opensearch()
 
-    response = opensearch.snapshot.create_repository(
-        repository=repository_name, body=payload
+    settings = repository_settings(
+        os.environ["SNAPSHOT_BUCKET"],
+        os.environ["IAM_ROLE"],
+        os.environ["REGION"],
+        max_bytes_per_sec=MAX_BYTES_PER_SEC,
     )
-    print("registry created", response)
+    register_repository(opensearch, REPOSITORY, settings)
 
-    # Take snapshot
-    # Define the snapshot name
-    # Define the indices to include in the snapshot (use "*" to include all indices)
-    indices_to_snapshot = "*"
-    # Create the snapshot
-    response = opensearch.snapshot.create(
-        repository=repository_name,
-        snapshot=snapshot_name,
-        body={
-            "indices": indices_to_snapshot,
-            "ignore_unavailable": True,  # Ignore unavailable indices
-            "include_global_state": False,  # Exclude cluster global state
-        },
-    )
-    print("snapshot created", response)
+    # Leave time to prune and return before the Lambda times out
+    wait_seconds = min(MAX_WAIT_SECONDS, context.get_remaining_time_in_millis() / 1000 - 30)
+    deadline = time.monotonic() + max(wait_seconds, 0)
 
-    # Print the response
-    response = opensearch.snapshot.status(
-        repository=repository_name, snapshot=snapshot_name
-    )
+    running = [snapshot for snapshot in list_snapshots(opensearch, REPOSITORY, PREFIX) if snapshot["state"] in RUNNING_STATES]
+    resumed = bool(running)
+    if running:
+        name = running[-1]["snapshot"]
+        logger.info(f"Resuming snapshot {name}")
+    else:
+        latest = latest_snapshot(opensearch, REPOSITORY, PREFIX)
+        if latest and not event.get("force") and age_minutes(latest) < INTERVAL_MINUTES:
+            logger.info(f"Snapshot {latest['snapshot']} is recent enough, no new snapshot")
+            # It may have completed after the run that started it returned
+            pruned = prune_snapshots(opensearch, REPOSITORY, PREFIX, RETENTION)
+            return {"snapshot": latest["snapshot"], "state": "SKIPPED", "done": True, "pruned": pruned}
 
-    while response["snapshots"][0]["state"] == "STARTED":
-        response = opensearch.snapshot.status(
-            repository=repository_name, snapshot=snapshot_name
-        )
-        print("in process", response["snapshots"][0]["state"])
+        name = snapshot_name(PREFIX)
+        try:
+            # Snapshots are incremental, only segments not in an earlier snapshot are copied
+            response = opensearch.snapshot.create(
+                repository=REPOSITORY,
+                snapshot=name,
+                body={
+                    "indices": event.get("indices", INDICES),
+                    "ignore_unavailable": True,
+                    "include_global_state": False,
+                },
+                wait_for_completion=False,
+            )
+        except Exception as e:
+            # Another snapshot (e.g. the automated one of the domain) is running, try on the next run
+            if getattr(e, "status_code", None) in (400, 503) and "concurrent_snapshot_execution" in str(e):
+                logger.info(f"Snapshot deferred: {e}")
+                return {"snapshot": None, "state": "DEFERRED", "done": False, "pruned": []}
+            raise
+        logger.info(f"Snapshot {name} started: {response}")
 
+    state = wait_for_snapshot(opensearch, REPOSITORY, name, deadline)
+    done = state not in RUNNING_STATES
+    pruned = prune_snapshots(opensearch, REPOSITORY, PREFIX, RETENTION) if state in COMPLETED_STATES else []
 
+    response = {"snapshot": name, "state": state, "resumed": resumed, "done": done, "pruned": pruned}
+    logger.info(response)
     return response
@@ -0,0 +1,274 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+# Blue/green rebuild of one index from its source documents in S3.
+#
+# The documents under s3://BUCKET/<index>/ are split with the requested chunk
+# configuration into a new <index>-<version> index while the live one keeps serving.
+# Once the new index holds every chunk, it is warmed up and the <index> alias the
+# retriever reads is moved over; the old index is deleted after that.
+#
+# Event: {"index": "amazon_small_index", "chunk_size": 4000, "chunk_overlap": 200,
+#         "profile": "faiss_hnsw", "max_chunks_per_second": 20, "swap": true}
+# When the Lambda runs out of time the response has "resume", invoke again with it.
+
+import os
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from aws_lambda_powertools import Logger, Tracer
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from assistant_utils.aliases import (
+    alias_indices,
+    new_version,
+    swap_aliases,
+    versioned_name,
+    wait_for_recovery,
+    warmup_knn,
+)
+from assistant_utils.bulk import BulkIndexer, deferred_refresh
+from assistant_utils.cache import build_answer_cache
+from assistant_utils.clients import registry
+from assistant_utils.embedding_plan import model_limits
+from assistant_utils.embeddings import BatchEmbedder, EmbeddingStats
+from assistant_utils.index_profiles import (
+    DEFAULT_PROFILE,
+    get_profile,
+    index_body,
+    model_id_for,
+    model_state,
+    vector_dimension,
+)
+from assistant_utils.ingest import iter_s3_text, split_stream, batched, pipeline, rate_limited
+from assistant_utils.router import company_of_index
+
+tracer = Tracer()
+logger = Logger()
+
+bucket = os.environ["BUCKET"]
+model_id = os.environ["BEDROCK_EMBEDDING_MODEL_ID"]
+# Chunk configuration of the index data lambda, used when the event does not set one
+default_chunk_size = int(os.environ.get("CHUNK_SIZE", 28000))
+default_chunk_overlap = int(os.environ.get("CHUNK_OVERLAP", 0))
+index_profile = os.environ.get("INDEX_PROFILE", DEFAULT_PROFILE)
+index_profile_overrides = json.loads(os.environ.get("INDEX_PROFILE_OVERRIDES", "{}"))
+# Chunks written per second, keeps the rebuild from competing with live searches
+max_chunks_per_second = float(os.environ.get("REINDEX_MAX_CHUNKS_PER_SECOND", 20))
+embedding_batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+pipeline_depth = int(os.environ.get("PIPELINE_DEPTH", 2))
+# Share of the written chunks allowed to be missing from the new index before the swap is refused,
+# chunks with the same text in two documents are stored once
+count_tolerance = float(os.environ.get("REINDEX_COUNT_TOLERANCE", 0.01))
+# Time kept back to return the resume state before the Lambda times out
+reserved_seconds = int(os.environ.get("REINDEX_RESERVED_SECONDS", 120))
+# Objects modified this long before the last catch up are looked at again: S3 sets
+# LastModified in whole seconds, to the start of the upload
+catch_up_margin_seconds = int(os.environ.get("REINDEX_CATCH_UP_MARGIN_SECONDS", 300))
+
+embedder = None
+answer_cache = build_answer_cache()
+
+
+@logger.inject_lambda_context(log_event=True)
+@tracer.capture_lambda_handler
+def lambda_handler(event, context):
+    opensearch = registry.opensearch()
+    s3 = registry.s3()
+    job = start_job(opensearch, event)
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - reserved_seconds
+
+    # Build: every object of the prefix, in key order so a later run can continue after the last one
+    if job["state"] == "BUILDING":
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=job["chunk_size"], chunk_overlap=job["chunk_overlap"], length_function=len
+        )
+        for key in list_keys(s3, job["index"], start_after=job.get("start_after")):
+            if time.monotonic() > deadline:
+                return pause(job)
+            job["chunks"] += index_object(opensearch, s3, job, key, splitter)
+            job["start_after"] = key
+        job["state"] = "CATCHING_UP"
+
+    # Objects changed while building were indexed into the live index by the index data lambda
+    if job["state"] == "CATCHING_UP":
+        job["chunks"] += catch_up(opensearch, s3, job)
+        job["state"] = "VERIFYING"
+
+    response = verify_and_swap(opensearch, s3, job, deadline)
+    logger.info(response)
+    return response
+
+
+def start_job(opensearch, event):
+    if "resume" in event:
+        return event["resume"]
+
+    index_name = event["index"]
+    version = event.get("version") or new_version()
+    job = {
+        "index": index_name,
+        "target": versioned_name(index_name, version),
+        "chunk_size": int(event.get("chunk_size", default_chunk_size)),
+        "chunk_overlap": int(event.get("chunk_overlap", default_chunk_overlap)),
+        "profile": event.get("profile", index_profile_overrides.get(index_name, index_profile)),
+        "max_chunks_per_second": float(event.get("max_chunks_per_second", max_chunks_per_second)),
+        "swap": event.get("swap", True),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "state": "BUILDING",
+        "chunks": 0,
+    }
+    if not opensearch.indices.exists(index=job["target"]):
+        profile = get_profile(job["profile"])
+        model = None
+        if profile.get("training"):
+            model = model_id_for(index_name, job["profile"])
+            if model_state(opensearch, model) != "created":
+                raise ValueError(f"Profile {job['profile']} needs the trained k-NN model {model}")
+        # The dimension of the live index, or the default one of the embedding model for a new index
+        dimension = vector_dimension(opensearch, index_name) or model_limits(model_id)["dimension"]
+        body = index_body(profile, dimension, "vector_field", "text", model_id=model)
+        # No replicas while building, they are added before the swap
+        body["settings"]["index"]["number_of_replicas"] = 0
+        # The index data lambda splits later uploads to this index the same way
+        body["mappings"]["_meta"] = {"chunk_size": job["chunk_size"], "chunk_overlap": job["chunk_overlap"]}
+        opensearch.indices.create(index=job["target"], body=body)
+        logger.info(f"Created {job['target']} with profile {job['profile']}")
+    return job
+
+
+def pause(job):
+    logger.info(f"Out of time after {job.get('start_after')}, {job['chunks']} chunks written")
+    return {"state": "IN_PROGRESS", "target": job["target"], "chunks": job["chunks"], "resume": job}
+
+
+def list_keys(s3, index_name, start_after=None, modified_since=None):
+    paginator = s3.get_paginator("list_objects_v2")
+    params = {"Bucket": bucket, "Prefix": f"{index_name}/"}
+    if start_after:
+        params["StartAfter"] = start_after
+    for page in paginator.paginate(**params):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith("/"):
+                continue
+            if modified_since and item["LastModified"] < modified_since:
+                continue
+            yield item["Key"]
+
+
+@tracer.capture_method
+def index_object(opensearch, s3, job, key, splitter):
+    """Write the chunks of one object, returns how many distinct chunks it has."""
+    url = f"s3://{bucket}/{key}"
+    seen_ids = set()
+
+    def distinct(chunks):
+        for chunk in chunks:
+            index_id = hashlib.md5(chunk.encode()).hexdigest()
+            if index_id not in seen_ids:
+                seen_ids.add(index_id)
+                yield chunk
+
+    chunks = rate_limited(
+        distinct(split_stream(iter_s3_text(s3, bucket, key), splitter, window=2 * job["chunk_size"])),
+        job["max_chunks_per_second"],
+    )
+    embed = partial(_embed_batch, stats=EmbeddingStats())
+    batches = pipeline(batched(chunks, embedding_batch_size), embed, maxsize=pipeline_depth)
+    with deferred_refresh(opensearch, job["target"]):
+        with BulkIndexer(opensearch, job["target"]) as indexer:
+            for batch in batches:
+                for text, vector in batch:
+                    indexer.add(hashlib.md5(text.encode()).hexdigest(), {"vector_field": vector, "text": text, "url": url})
+    stats = indexer.stats()
+    if stats["failed"]:
+        raise RuntimeError(f"{stats['failed']} chunks of {url} were not written: {stats.get('errors')}")
+    logger.info(f"Wrote {len(seen_ids)} chunks of {url} to {job['target']}")
+    return len(seen_ids)
+
+
+def catch_up(opensearch, s3, job):
+    """Rewrite the objects changed since the last catch up, or the start of the job,
+    and drop the removed ones. Can run again, each run moves ``caught_up_at`` on."""
+    since = datetime.fromisoformat(job.get("caught_up_at", job["started_at"]))
+    since -= timedelta(seconds=catch_up_margin_seconds)
+    caught_up_at = datetime.now(timezone.utc)
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=job["chunk_size"], chunk_overlap=job["chunk_overlap"], length_function=len
+    )
+    chunks = 0
+    for key in list_keys(s3, job["index"], modified_since=since):
+        url = f"s3://{bucket}/{key}"
+        # Chunk ids are the md5 of their text, old chunks of a changed object would stay
+        removed = opensearch.delete_by_query(
+            index=job["target"], body={"query": {"term": {"url.keyword": url}}}, refresh=True
+        )
+        chunks += index_object(opensearch, s3, job, key, splitter) - removed.get("deleted", 0)
+
+    urls = {f"s3://{bucket}/{key}" for key in list_keys(s3, job["index"])}
+    opensearch.indices.refresh(index=job["target"])
+    indexed_urls = opensearch.search(
+        index=job["target"],
+        body={"size": 0, "aggs": {"urls": {"terms": {"field": "url.keyword", "size": 10000}}}},
+    )["aggregations"]["urls"]["buckets"]
+    for bucket_entry in indexed_urls:
+        if bucket_entry["key"] not in urls:
+            removed = opensearch.delete_by_query(
+                index=job["target"], body={"query": {"term": {"url.keyword": bucket_entry["key"]}}}, refresh=True
+            )
+            chunks -= removed.get("deleted", 0)
+            logger.info(f"Dropped {removed.get('deleted', 0)} chunks of removed {bucket_entry['key']}")
+    job["caught_up_at"] = caught_up_at.isoformat()
+    return chunks
+
+
+def verify_and_swap(opensearch, s3, job, deadline):
+    target = job["target"]
+    opensearch.indices.refresh(index=target)
+    count = opensearch.count(index=target)["count"]
+    live = alias_indices(opensearch, job["index"]) or (
+        [job["index"]] if opensearch.indices.exists(index=job["index"]) else []
+    )
+    live_count = opensearch.count(index=",".join(live))["count"] if live else 0
+    report = {"target": target, "chunks": job["chunks"], "count": count, "live_count": live_count}
+
+    # The written chunks must be searchable before the alias moves
+    if count == 0 or count > job["chunks"] or count < job["chunks"] * (1 - count_tolerance):
+        logger.error(f"{target} has {count} documents, {job['chunks']} were written, the alias stays")
+        return {"state": "COUNT_MISMATCH", **report}
+    if not job["swap"]:
+        return {"state": "BUILT", **report}
+
+    # Same replicas as the live index, the cluster default when there is none
+    replicas = None
+    if live:
+        settings = opensearch.indices.get_settings(index=live[0], name="index.number_of_replicas")
+        replicas = next(iter(settings.values()), {}).get("settings", {}).get("index", {}).get("number_of_replicas")
+    opensearch.indices.put_settings(index=target, body={"index": {"number_of_replicas": replicas}})
+    if not wait_for_recovery(opensearch, [target], deadline):
+        job["state"] = "VERIFYING"
+        return {**pause(job), **report}
+    report["warmup"] = warmup_knn(opensearch, [target])
+    # Uploads and deletions since the first catch up only reached the live index,
+    # the alias moves right after the target has them as well
+    delta = catch_up(opensearch, s3, job)
+    job["chunks"] += delta
+    report["chunks"] = job["chunks"]
+    report["caught_up"] = delta
+    report["replaced"] = swap_aliases(opensearch, {job["index"]: target})
+    # Answers are cached per company, indices not named after one under their own name
+    answer_cache.invalidate(company_of_index(job["index"]) or job["index"])
+    return {"state": "SWAPPED", **report}
+
+
+def _embed_batch(texts, stats=None):
+    return list(zip(texts, get_embedder().embed_documents(texts, stats)))
+
+
+def get_embedder():
+    global embedder
+    if embedder is None:
+        embedder = BatchEmbedder(registry.bedrock_runtime(), model_id)
+    return embedder
@@ -4,13 +4,14 @@
 
 # Import required modules and packages
 import os
-import boto3
 import json
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.event_handler import APIGatewayHttpResolver, CORSConfig
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from langchain_community.llms import Bedrock
+from assistant_utils.cache import CachedQueryEmbeddings, build_answer_cache, get_cache
+from assistant_utils.clients import registry
+from assistant_utils.context import context_token_budget, pack_context
 
 # Initialize Tracer for AWS X-Ray and Logger for logging
 tracer = Tracer()
@@ -22,6 +23,19 @@ cors_config = CORSConfig(allow_origin="*", max_age=300)
 # Create an API Gateway HTTP Resolver with CORS configuration
 app = APIGatewayHttpResolver(cors=cors_config)
 
+# Answers for near-duplicate questions over the same retrieved context, configured
+# with ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL and ANSWER_CACHE_TABLE
+answer_cache = build_answer_cache()
+query_cache = get_cache("QUERY_CACHE")
+
+# Estimated tokens of retrieved context put in the prompt, the most relevant chunks go first.
+# Unset, it is what the context window of the model leaves after the prompt and the answer.
+CONTEXT_TOKEN_BUDGET = os.environ.get("CONTEXT_TOKEN_BUDGET")
+# Characters per token used to estimate the size of the chunks
+CONTEXT_CHARS_PER_TOKEN = float(os.environ.get("CONTEXT_CHARS_PER_TOKEN", "4"))
+# A chunk that does not fit is truncated when at least this many tokens are left, otherwise dropped
+CONTEXT_MIN_TRUNCATED_TOKENS = int(os.environ.get("CONTEXT_MIN_TRUNCATED_TOKENS", "200"))
+
 
 
 
@@ -40,6 +54,17 @@ def get_relevant_documents():
     # Parse the JSON body from the incoming event
     query: dict = json.loads(app.current_event.json_body)
 
+    generation = prepare_generation(query)
+    result = generation["cached_result"]
+    if result is None:
+        # Call the Bedrock LLM with the formatted prompt
+        result = generation["llm"]._call(prompt=generation["prompt"])
+        store_answer(generation, result)
+
+    return build_response(generation, result)
+
+
+def prepare_generation(query):
     # Extract response and message text from the query
     chunks = query["response"]
     message_text = query["message"]
@@ -50,10 +75,9 @@ def get_relevant_documents():
     # Get Bedrock model ID and region from environment variables
     model_id = os.environ["BEDROCK_TEXT_MODEL_ID"]
 
-    # Initialize the Bedrock Large Language Model (LLM) client
-    llm = Bedrock(
-            model_id=model_id,
-            client=get_bedrock_client(),
+    # Get the Bedrock Large Language Model (LLM) client, created once per container
+    llm = registry.bedrock_llm(
+            model_id,
             model_kwargs={
                 "max_tokens_to_sample":400,
                 "temperature":1
@@ -62,25 +86,71 @@ def get_relevant_documents():
     # Log the Bedrock LLM client info
     logger.info(llm)
     
-    # Combine chunks of documents into a single string
-    full_chunks = ""
-    for chunk in chunks:
-        chunk = chunk["page_content"]
-        full_chunks += "\n<document>\n{}\n</document>".format(chunk)
+    # Combine the most relevant chunks of documents into a single string within the token budget
+    token_budget = query.get("context_token_budget", CONTEXT_TOKEN_BUDGET)
+    if token_budget is None:
+        token_budget = context_token_budget(
+            model_id,
+            prompt.format(question=message_text, documents=""),
+            llm.model_kwargs["max_tokens_to_sample"],
+            chars_per_token=CONTEXT_CHARS_PER_TOKEN,
+        )
+    full_chunks, packing = pack_context(
+        chunks,
+        message_text,
+        int(token_budget),
+        chars_per_token=CONTEXT_CHARS_PER_TOKEN,
+        min_truncated_tokens=CONTEXT_MIN_TRUNCATED_TOKENS,
+    )
+    logger.info(f"Packed context: {packing}")
 
     # Format the prompt with the question and the combined documents
     formatted_prompt = prompt.format(question=message_text, documents=full_chunks)
     logger.info(f"LOGGING PROMPT:   {formatted_prompt}")
 
-    # Call the Bedrock LLM with the formatted prompt
-    response = llm._call(prompt=formatted_prompt)
+    # Reuse the answer of a near-duplicate question asked over the same context. The question is
+    # embedded here rather than taken from the request, /api/ask finds it in the query cache the
+    # retrieval warmed in the same process
+    question_vector = get_question_embeddings().embed_query(message_text)
+    bucket_key = answer_cache.bucket_key(
+        query.get("index", ""),
+        {"model_id": model_id, "model_kwargs": llm.model_kwargs, "prompt": prompt},
+        full_chunks,
+    )
+    cached_result, similarity = answer_cache.lookup(bucket_key, question_vector)
+    if cached_result is not None:
+        logger.info(f"Answer cache hit with similarity {similarity}")
+
+    return {
+        "llm": llm,
+        "model_id": model_id,
+        "prompt": formatted_prompt,
+        "context": full_chunks,
+        "question_vector": question_vector,
+        "bucket_key": bucket_key,
+        "cached_result": cached_result,
+        "cache": {"hit": similarity is not None, "similarity": similarity},
+        "packing": packing,
+    }
+
+
+def store_answer(generation, result):
+    answer_cache.store(generation["bucket_key"], generation["question_vector"], result)
 
 
+def build_response(generation, result):
+    llm = generation["llm"]
+    full_chunks = generation["context"]
+    cache_info = generation["cache"]
+    packing = generation["packing"]
+
     # Check if the prompt is still the initial template and return a specific response
     if '{documents}' not in prompt and '{context}' not in prompt:
         response = {
-                "result": response,
+                "result": result,
                 "context": full_chunks,
+                "cache": cache_info,
+                "packing": packing,
                 "error_explication": "It seems like the responses do not have the proper context. That means the model will use its training knowledge which may not be accurate.",
                 "error": "prompt does not contain context"
                 }
@@ -90,8 +160,10 @@ def get_relevant_documents():
     # Check if the prompt does not include "<document>" and return a specific response
     if "<document>" not in prompt and "<documents>" not in prompt:
         response = {
-                "result": response,
+                "result": result,
                 "context": full_chunks,
+                "cache": cache_info,
+                "packing": packing,
                 "error_explication": "It looks like the prompt can be improved using best practices of Anthropic Claude, try mentioning the XML tags present.",
                 "error": "prompt does not contain tags"
                 }
@@ -101,8 +173,10 @@ def get_relevant_documents():
     # Check the temperature and return a specific response
     if llm.model_kwargs['temperature'] > 0.2:
         response = {
-                "result": response,
+                "result": result,
                 "context": full_chunks,
+                "cache": cache_info,
+                "packing": packing,
                 "error_explication": "It looks like the temperature is not optimal for this use case.",
                 "error": "tempurature not optimal"
                 }
@@ -111,8 +185,10 @@ def get_relevant_documents():
 
     # Prepare the final response
     response = {
-        "result": response,
-        "context": full_chunks
+        "result": result,
+        "context": full_chunks,
+        "cache": cache_info,
+        "packing": packing,
     }
     
     # Log and return the final response
@@ -128,10 +204,11 @@ def lambda_handler(event: dict, context: LambdaContext) -> dict:
     # Resolve the event using the app (APIGatewayHttpResolver)
     return app.resolve(event, context)
 
-# Function to get a Bedrock client using boto3
+# Function to get the cached embeddings used to compare questions
+def get_question_embeddings():
+    embeddings = registry.bedrock_embeddings(os.environ["BEDROCK_EMBEDDING_MODEL_ID"])
+    return CachedQueryEmbeddings(embeddings, os.environ["BEDROCK_EMBEDDING_MODEL_ID"], query_cache)
+
+# Function to get the shared Bedrock client
 def get_bedrock_client():
-    bedrock_region_name = os.environ["BEDROCK_REGION"]
-    return boto3.client(
-        "bedrock-runtime",
-        region_name=bedrock_region_name
-    )
+    return registry.bedrock_runtime()
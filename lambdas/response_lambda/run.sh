@@ -0,0 +1,4 @@
+#!/bin/bash
+# Started by the Lambda Web Adapter for the streaming response function
+export PYTHONPATH="/opt/python:${LAMBDA_TASK_ROOT}:${PYTHONPATH}"
+exec python3 stream_server.py
@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+# Streaming variant of the response lambda. It runs behind the Lambda Web Adapter
+# on a function URL in RESPONSE_STREAM mode, so every token Bedrock produces is
+# written to the browser as soon as it arrives. The body is newline delimited
+# JSON: {"type": "token", "text": ...} events followed by one {"type": "done"}
+# event carrying the same fields as the /api/response payload.
+
+import hashlib
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from aws_lambda_powertools import Logger
+
+from assistant_utils.streaming import stream_completion
+from generate_response_lambda import build_response, prepare_generation, store_answer
+
+logger = Logger()
+
+# Access tokens already checked against Cognito, by token hash
+verified_tokens = {}
+TOKEN_CACHE_SECONDS = 300
+
+cognito = boto3.client("cognito-idp", region_name=os.environ["REGION"])
+
+
+def is_authorized(header):
+    # Function URLs cannot use the Cognito authorizer, so the access token is
+    # validated by Cognito itself (GetUser rejects expired or forged tokens)
+    if not header or not header.startswith("Bearer "):
+        return False
+    token = header[len("Bearer "):]
+    key = hashlib.sha256(token.encode()).hexdigest()
+    if verified_tokens.get(key, 0) > time.time():
+        return True
+    try:
+        cognito.get_user(AccessToken=token)
+    except Exception as e:
+        logger.info(f"Rejected access token: {e}")
+        return False
+    verified_tokens[key] = time.time() + TOKEN_CACHE_SECONDS
+    return True
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Readiness check of the Lambda Web Adapter
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if not is_authorized(self.headers.get("Authorization")):
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        query = json.loads(self.rfile.read(length))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache, no-store")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            generation = prepare_generation(query)
+            result = generation["cached_result"]
+            if result is None:
+                pieces = []
+                llm = generation["llm"]
+                for text in stream_completion(
+                    llm.client, generation["model_id"], generation["prompt"], llm.model_kwargs
+                ):
+                    pieces.append(text)
+                    self.write_event({"type": "token", "text": text})
+                result = "".join(pieces)
+                store_answer(generation, result)
+            else:
+                self.write_event({"type": "token", "text": result})
+            self.write_event({"type": "done", **build_response(generation, result)})
+        except Exception as e:
+            logger.exception("Streaming response failed")
+            self.write_event({"type": "error", "error": str(e)})
+        self.write_chunk(b"")
+
+    def write_event(self, event):
+        self.write_chunk(json.dumps(event).encode() + b"\n")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("AWS_LWA_PORT", os.environ.get("PORT", 8080)))
+    ThreadingHTTPServer(("127.0.0.1", port), StreamHandler).serve_forever()
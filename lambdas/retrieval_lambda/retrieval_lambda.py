@@ -9,10 +9,12 @@ from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.event_handler import APIGatewayHttpResolver, CORSConfig
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain_community.vectorstores import OpenSearchVectorSearch
-from opensearchpy import RequestsHttpConnection, AWSV4SignerAuth
+from assistant_utils.cache import CachedQueryEmbeddings, get_cache
+from assistant_utils.clients import registry
+from assistant_utils.local_store import LocalStoreCache
+from assistant_utils.search import LatencyTracker, drop_contained, knn_msearch, reciprocal_rank_fusion
 import json
+import time
 
 # Initialize Tracer for X-Ray tracing
 tracer = Tracer()
@@ -27,6 +29,25 @@ app = APIGatewayHttpResolver(cors=cors_config)
 model_id = os.environ["BEDROCK_EMBEDDING_MODEL_ID"]
 bedrock_region_name = os.environ["BEDROCK_REGION"]
 
+# Question embeddings, configured with QUERY_CACHE_SIZE, QUERY_CACHE_TTL and QUERY_CACHE_TABLE
+query_cache = get_cache("QUERY_CACHE")
+
+# "single" searches the chunk size index selected below, "fusion" searches every
+# granularity and merges them with reciprocal rank fusion. Requests can pass "mode".
+retrieval_mode = os.environ.get("RETRIEVAL_MODE", "single")
+chunk_sizes = ["small", "medium", "large"]
+# Chunks fetched per granularity and kept after fusion
+fusion_k = int(os.environ.get("FUSION_K", 3))
+fusion_top_k = int(os.environ.get("FUSION_TOP_K", 4))
+rrf_k = int(os.environ.get("RRF_K", 60))
+# Granularities expected to take longer than this are skipped, 0 disables the budget.
+# Requests can pass "latency_budget_ms".
+latency_budget_ms = int(os.environ.get("RETRIEVAL_LATENCY_BUDGET_MS", 0))
+index_latency = LatencyTracker()
+# The few performance documents of each company are searched in memory, reloaded every LOCAL_STORE_TTL seconds
+local_performance = os.environ.get("LOCAL_PERFORMANCE_STORE", "true").lower() == "true"
+local_stores = LocalStoreCache(registry.search_client, ttl=int(os.environ.get("LOCAL_STORE_TTL", 600)))
+
 
 # Define a POST route for '/api/retriever'
 @app.post("/api/retriever")
@@ -35,17 +56,20 @@ def get_relevant_documents():
     # Parse the incoming JSON body to a Python dictionary
     query: dict = json.loads(app.current_event.json_body)
     logger.info(query)  # Log the received query
-    message_text = query["message"]
-    index = query["index"]
-    logger.info(query)
-    index_name = index
-
-    # Construct OpenSearch endpoint URL
-    endpoint = "https://" + os.environ["OPENSEARCH_ENDPOINT"] + ":443"
+    return retrieve(query)
 
 
+def prefetch_question_embedding(message_text):
+    # Warm the query cache before the company is known, retrieve() then gets a cache hit
+    embeddings = registry.bedrock_embeddings(model_id)
+    return CachedQueryEmbeddings(embeddings, model_id, query_cache).embed_query(message_text)
 
 
+def retrieve(query):
+    message_text = query["message"]
+    index = query["index"]
+    logger.info(query)
+    index_name = index
 
     #TODO: Initialize Bedrock client with Boto3, uncomment next line and initiate boto3 bedrock client
     #bedrock_client = 
@@ -63,21 +87,8 @@ def get_relevant_documents():
     # Try block to handle potential errors during vector store creation
     try:
 
-        ###Bedrock Embeddings Class Below
-        embeddings = BedrockEmbeddings(
-            client=bedrock_client,
-            model_id=model_id)
-
-        # Initialize OpenSearchVectorSearch with the necessary parameters selecting the index defined before in chunk size index
-        vector_store = OpenSearchVectorSearch(
-            index_name=index_name + "_" + chunk_size_index+ "_index",
-            embedding_function=embeddings,
-            opensearch_url=endpoint,
-            http_auth=get_aws4_auth(),
-            use_ssl=True,
-            verify_certs=True,
-            connection_class=RequestsHttpConnection,
-        )
+        ###Bedrock Embeddings Class Below, cached per container by the client registry
+        embeddings = registry.bedrock_embeddings(model_id, client=bedrock_client)
     except Exception as e:
         # Handle exceptions and log error
         response = {
@@ -88,60 +99,90 @@ def get_relevant_documents():
         logger.info(response)
         return response
 
-    # Create a retriever from the vector store
-    retriever = vector_store.as_retriever(search_kwargs={'k': 3})
-    logger.info(retriever)
-
-    # Retrieve relevant documents based on the query
-    docs = retriever.get_relevant_documents(message_text)
+    # Embed the question once, the same vector is used for every index. Questions
+    # asked before are served from the cache without calling Bedrock.
+    start = time.perf_counter()
+    misses = query_cache.misses
+    query_vector = CachedQueryEmbeddings(embeddings, model_id, query_cache).embed_query(message_text)
+    embedding_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"Query embedding cache: {query_cache.stats()}")
+
+    mode = query.get("mode", retrieval_mode)
+    budget_ms = query.get("latency_budget_ms", latency_budget_ms)
+    if mode == "fusion":
+        # Every granularity at once, the manual chunk size selection is not needed
+        candidates = [index_name + "_" + size + "_index" for size in chunk_sizes]
+        chunk_indices = index_latency.within_budget(candidates, budget_ms)
+        k = fusion_k
+    else:
+        # Document chunks from the index defined before in chunk size index
+        candidates = chunk_indices = [index_name + "_" + chunk_size_index + "_index"]
+        k = 3
+
+    # Plus the performance data for analysis, from the local store when it is enabled
+    performance_index = index_name + "_performance"
+    performance_search = None
+    if local_performance:
+        try:
+            start = time.perf_counter()
+            documents = local_stores.get(performance_index).search(query_vector, 1)
+            performance_search = {
+                "index": performance_index,
+                "documents": documents,
+                "took_ms": round((time.perf_counter() - start) * 1000, 2),
+                "timed_out": False,
+                "local": True,
+            }
+        except Exception as e:
+            logger.warning(f"Local search of {performance_index} failed, searching OpenSearch: {e}")
+
+    # Everything else is fetched in a single _msearch round trip
+    searches = [(name, k) for name in chunk_indices]
+    if performance_search is None:
+        searches.append((performance_index, 1))
+    results, msearch_ms = knn_msearch(registry.search_client(), searches, query_vector, timeout_ms=budget_ms or None)
+    for search in results:
+        index_latency.observe(search["index"], search["took_ms"])
+    chunk_searches = results[:len(chunk_indices)]
+    if performance_search is None:
+        performance_search = results[-1]
+
+    if mode == "fusion":
+        fused = reciprocal_rank_fusion([search["documents"] for search in chunk_searches], k=rrf_k)
+        docs = drop_contained(fused)[:fusion_top_k]
+    else:
+        docs = chunk_searches[0]["documents"]
+    performance = performance_search["documents"]
     logger.info(docs)
 
-    # Performance data retrieval for analysis
-    performance_data = OpenSearchVectorSearch(
-        index_name=index_name + "_performance",
-        embedding_function=embeddings,
-        opensearch_url=endpoint,
-        http_auth=get_aws4_auth(),
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-    )
-    retriever_performance = performance_data.as_retriever(search_kwargs={'k': 1})
-    performance = retriever_performance.get_relevant_documents(message_text)
-
-    if chunk_size_index == "small":
-        response = {
-        "response": [
-            {
-                "page_content": doc.page_content,
-                "metadata": {
-                    k: v for k, v in doc.metadata.items() if k != "vector_field"
-                },
-            }
-            for doc in docs
+    timings = {
+        "embedding_ms": round(embedding_ms, 1),
+        "embedding_cached": query_cache.misses == misses,
+        "msearch_ms": round(msearch_ms, 1),
+        "searches": [
+            {"index": search["index"], "took_ms": search["took_ms"], "timed_out": search["timed_out"],
+             "local": search.get("local", False)}
+            for search in chunk_searches + [performance_search]
         ],
-        "json": json.loads(performance[0].page_content),
-        "error_explication": "Seems like your chunk configuration may be to small. Meaning you are using very small chunks of the documents. Try to fix it in the Retriever.",
-        "error": "chunk configuration not optimal"
-        }
-        logger.info(response)
-        return response
+        "skipped": [name for name in candidates if name not in chunk_indices],
+    }
 
     # Construct response with document data and performance information
     response = {
         "response": [
-            {
-                "page_content": doc.page_content,
-                "metadata": {
-                    k: v for k, v in doc.metadata.items() if k != "vector_field"
-                },
-            }
+            {"page_content": doc["page_content"], "metadata": doc["metadata"]}
             for doc in docs
         ],
-        "json": json.loads(performance[0].page_content)
+        "json": json.loads(performance[0]["page_content"]),
+        "index": index_name,
+        "timings": timings,
     }
-    logger.info(response)
 
+    if mode != "fusion" and chunk_size_index == "small":
+        response["error_explication"] = "Seems like your chunk configuration may be to small. Meaning you are using very small chunks of the documents. Try to fix it in the Retriever."
+        response["error"] = "chunk configuration not optimal"
+
+    logger.info(response)
     return response
 
 
@@ -154,11 +195,7 @@ def lambda_handler(event: dict, context: LambdaContext) -> dict:
     # Resolve the incoming event using the APIGatewayHttpResolver
     return app.resolve(event, context)
 
-# Function to generate AWS4Auth object for OpenSearch authentication
+# Function to get the cached AWS4Auth object for OpenSearch authentication
 def get_aws4_auth():
-    region = os.environ["REGION"]
-    service = "es"
-    # Get AWS credentials from the current session
-    credentials = boto3.Session().get_credentials()
-    # Return the AWSV4SignerAuth object
-    return AWSV4SignerAuth(credentials, region, service)
+    # Credentials are refreshed by the registry shortly before they expire
+    return registry.aws_auth()
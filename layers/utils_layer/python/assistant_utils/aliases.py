@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Versioned indices behind read aliases: the lambdas search <company>_<size>_index,
+# which is either a plain index or an alias of <company>_<size>_index-<version>.
+
+import re
+import time
+from datetime import datetime, timezone
+
+from aws_lambda_powertools import Logger
+
+from assistant_utils.snapshots import backoff_delays
+
+logger = Logger(child=True)
+
+VERSION_SUFFIX = re.compile(r"-(\d{8}-\d{6})$")
+# Java regex used to rename restored indices, drops the version suffix of an already versioned name
+RENAME_PATTERN = r"^(.+?)(?:-\d{8}-\d{6})?$"
+
+
+def new_version(now=None):
+    now = now or datetime.now(timezone.utc)
+    return f"{now:%Y%m%d-%H%M%S}"
+
+
+def versioned_name(name, version):
+    return f"{base_name(name)}-{version}"
+
+
+def base_name(index_name):
+    """Alias an index is served under: its name without the version suffix."""
+    return VERSION_SUFFIX.sub("", index_name)
+
+
+def alias_indices(opensearch, alias):
+    """Indices behind ``alias``, empty when it is not an alias."""
+    if not opensearch.indices.exists_alias(name=alias):
+        return []
+    return sorted(opensearch.indices.get_alias(name=alias))
+
+
+def concrete_indices(opensearch, name):
+    """The indices behind an alias, or ``[name]`` for a plain index."""
+    return alias_indices(opensearch, name) or [name]
+
+
+def wait_for_recovery(opensearch, indices, deadline, status="yellow"):
+    """Wait until the shards of ``indices`` are allocated and recovered.
+
+    Uses the waiting cluster health call in slices of at most 30 seconds, so the
+    cluster answers when recovery is done instead of being polled. Returns
+    whether the indices reached ``status`` before ``deadline`` (``time.monotonic()``).
+    """
+    delays = backoff_delays(maximum=30.0, jitter=0.0)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        wait_seconds = max(1, int(min(next(delays), remaining)))
+        health = opensearch.cluster.health(
+            index=",".join(indices),
+            wait_for_status=status,
+            wait_for_no_initializing_shards=True,
+            timeout=f"{wait_seconds}s",
+        )
+        if not health.get("timed_out"):
+            return True
+        logger.info(
+            f"Waiting for recovery of {indices}: {health.get('status')}, "
+            f"{health.get('initializing_shards')} initializing, {health.get('unassigned_shards')} unassigned"
+        )
+
+
+def warmup_knn(opensearch, indices):
+    """Load the k-NN graphs of ``indices`` into memory before they get searches.
+
+    Without it the first query on each segment pays for reading its graph from
+    disk. Failures are logged, a cold index still answers.
+    """
+    try:
+        response = opensearch.transport.perform_request("GET", f"/_plugins/_knn/warmup/{','.join(indices)}")
+    except Exception as e:
+        logger.warning(f"k-NN warmup of {indices} failed: {e}")
+        return None
+    logger.info(f"k-NN warmup of {indices}: {response}")
+    return response.get("_shards")
+
+
+def swap_aliases(opensearch, targets, delete_replaced=True):
+    """Point each alias of ``targets`` (alias -> index) at its new index in one atomic call.
+
+    A plain index that has the name of the alias is deleted in the same call
+    (``remove_index``), so searches never see the name missing. Indices that
+    were behind the aliases are deleted afterwards, unless ``delete_replaced``
+    is false. Returns the replaced indices.
+    """
+    actions = []
+    replaced = []
+    removed = []
+    for alias, index in targets.items():
+        current = alias_indices(opensearch, alias)
+        if current:
+            for old_index in current:
+                if old_index != index:
+                    actions.append({"remove": {"index": old_index, "alias": alias}})
+                    replaced.append(old_index)
+        elif opensearch.indices.exists(index=alias):
+            actions.append({"remove_index": {"index": alias}})
+            removed.append(alias)
+        actions.append({"add": {"index": index, "alias": alias}})
+
+    response = opensearch.indices.update_aliases(body={"actions": actions})
+    logger.info(f"Swapped aliases {targets}: {response}")
+
+    if delete_replaced and replaced:
+        response = opensearch.indices.delete(index=",".join(replaced))
+        logger.info(f"Deleted replaced indices {replaced}: {response}")
+    return removed + replaced
@@ -0,0 +1,39 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Text generation with a plain invoke_model call, without loading langchain.
+
+import json
+
+from assistant_utils.streaming import completion_body, completion_text
+
+
+class BedrockTextModel:
+    """The part of langchain's ``Bedrock`` LLM the lambdas use: ``_call``,
+    ``client``, ``model_id`` and ``model_kwargs``."""
+
+    def __init__(self, client, model_id, model_kwargs=None, **kwargs):
+        self.client = client
+        self.model_id = model_id
+        self.model_kwargs = dict(model_kwargs or {})
+
+    def _call(self, prompt, stop=None, **kwargs):
+        model_kwargs = dict(self.model_kwargs)
+        if stop and self.model_id.startswith("anthropic."):
+            model_kwargs["stop_sequences"] = stop
+        response = self.client.invoke_model(
+            modelId=self.model_id,
+            body=json.dumps(completion_body(self.model_id, prompt, model_kwargs)),
+            accept="application/json",
+            contentType="application/json",
+        )
+        payload = json.loads(response["body"].read())
+        if self.model_id.startswith("amazon.titan"):
+            return payload["results"][0]["outputText"]
+        return completion_text(self.model_id, payload)
+
+    def invoke(self, prompt):
+        return self._call(prompt)
+
+    def __repr__(self):
+        return f"BedrockTextModel(model_id={self.model_id!r}, model_kwargs={self.model_kwargs!r})"
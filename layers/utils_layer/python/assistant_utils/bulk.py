@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Batched writes through the OpenSearch _bulk API.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+BULK_MAX_DOCS = int(os.environ.get("BULK_MAX_DOCS", 500))
+# Stay well below the 10 MiB HTTP payload limit of the smaller OpenSearch instance types
+BULK_MAX_BYTES = int(os.environ.get("BULK_MAX_BYTES", 5 * 1024 * 1024))
+BULK_MAX_RETRIES = int(os.environ.get("BULK_MAX_RETRIES", 3))
+BULK_RETRY_BACKOFF = float(os.environ.get("BULK_RETRY_BACKOFF", 0.5))
+
+# Item statuses worth sending again, anything else is reported as failed
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+MAX_REPORTED_ERRORS = 10
+
+
+class BulkIndexer:
+    """Buffers index and delete operations and sends them in batches bounded by count and bytes.
+
+    Items rejected with a retryable status are resent on their own with
+    exponential backoff, the rest of the batch is not sent again.
+    """
+
+    def __init__(
+        self,
+        opensearch,
+        index_name,
+        max_docs=BULK_MAX_DOCS,
+        max_bytes=BULK_MAX_BYTES,
+        max_retries=BULK_MAX_RETRIES,
+        retry_backoff=BULK_RETRY_BACKOFF,
+    ):
+        self.opensearch = opensearch
+        self.index_name = index_name
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.indexed = 0
+        self.deleted = 0
+        self.failed = 0
+        self.errors = []
+        self.requests = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def add(self, doc_id, source):
+        action = json.dumps({"index": {"_index": self.index_name, "_id": doc_id}})
+        self._append(doc_id, action + "\n" + json.dumps(source) + "\n")
+
+    def delete(self, doc_id):
+        action = json.dumps({"delete": {"_index": self.index_name, "_id": doc_id}})
+        self._append(doc_id, action + "\n")
+
+    def _append(self, doc_id, lines):
+        size = len(lines.encode())
+        if self._buffer and (
+            len(self._buffer) >= self.max_docs or self._buffer_bytes + size > self.max_bytes
+        ):
+            self.flush()
+        self._buffer.append((doc_id, lines))
+        self._buffer_bytes += size
+
+    def flush(self):
+        pending = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        attempt = 0
+        while pending:
+            response = self._send(pending)
+            retry = []
+            for (doc_id, lines), item in zip(pending, response["items"]):
+                operation, result = next(iter(item.items()))
+                status = result.get("status", 500)
+                if operation == "delete" and status in (200, 404):
+                    # A document that is already gone counts as deleted
+                    self.deleted += 1
+                elif status < 300:
+                    self.indexed += 1
+                elif status in RETRYABLE_STATUSES and attempt < self.max_retries:
+                    retry.append((doc_id, lines))
+                else:
+                    self._record_failure(doc_id, status, result.get("error"))
+
+            pending = retry
+            if pending:
+                attempt += 1
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                logger.info(f"Retrying {len(pending)} bulk items in {delay}s (attempt {attempt})")
+                time.sleep(delay)
+
+    def _send(self, items):
+        self.requests += 1
+        body = "".join(lines for _, lines in items)
+        return self.opensearch.bulk(body=body, index=self.index_name)
+
+    def _record_failure(self, doc_id, status, error):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"id": doc_id, "status": status, "error": error})
+        logger.error(f"Failed to write {doc_id} in {self.index_name}: {status} {error}")
+
+    def stats(self):
+        return {
+            "indexed": self.indexed,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "bulk_requests": self.requests,
+            "errors": self.errors,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+
+# Indices whose refreshes are deferred by this process: saved interval and number of writers
+_deferred = {}
+_deferred_lock = threading.Lock()
+
+
+@contextmanager
+def deferred_refresh(opensearch, index_name):
+    """Disable periodic refreshes while writing and refresh once at the end.
+
+    Writers of the same index running at once in this process share the
+    setting: the first one saves and disables the interval, the last one
+    puts it back, so none of them restores the other's ``-1``.
+    """
+    with _deferred_lock:
+        entry = _deferred.get(index_name)
+        if entry is None:
+            settings = opensearch.indices.get_settings(
+                index=index_name, name="index.refresh_interval"
+            )
+            # Keyed by the concrete index when index_name is an alias
+            previous = (
+                next(iter(settings.values()), {})
+                .get("settings", {})
+                .get("index", {})
+                .get("refresh_interval")
+            )
+            opensearch.indices.put_settings(
+                index=index_name, body={"index": {"refresh_interval": "-1"}}
+            )
+            entry = _deferred[index_name] = {"previous": previous, "writers": 0}
+        entry["writers"] += 1
+    try:
+        yield
+    finally:
+        with _deferred_lock:
+            entry["writers"] -= 1
+            if entry["writers"] == 0:
+                del _deferred[index_name]
+                # None puts the index back on the cluster default
+                opensearch.indices.put_settings(
+                    index=index_name, body={"index": {"refresh_interval": entry["previous"]}}
+                )
+        opensearch.indices.refresh(index=index_name)
@@ -0,0 +1,292 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Two tier caches: an in-process LRU per container and an optional shared tier.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+
+def normalize_text(text):
+    """Case and whitespace insensitive form of a question, used in cache keys."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def cache_key(*parts):
+    return hashlib.sha256("\n".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def items(self):
+        now = time.time()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at) in self._entries.items() if expires_at >= now]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InMemorySharedTier(LRUCache):
+    """Local stand-in for the shared tier, for tests and single container runs."""
+
+
+class DynamoDBSharedTier:
+    """Shared tier on a DynamoDB table with a ``key`` hash key and ``expires_at`` TTL attribute."""
+
+    def __init__(self, table_name, ttl=3600):
+        import boto3
+
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.ttl = ttl
+
+    def get(self, key):
+        item = self.table.get_item(Key={"key": key}).get("Item")
+        # TTL deletion is lazy, expired items can still be returned for a while
+        if item is None or int(item["expires_at"]) < time.time():
+            return None
+        return json.loads(item["value"])
+
+    def set(self, key, value):
+        self.table.put_item(
+            Item={
+                "key": key,
+                "value": json.dumps(value),
+                "expires_at": int(time.time() + self.ttl),
+            }
+        )
+
+    def delete(self, key):
+        self.table.delete_item(Key={"key": key})
+
+
+class TieredCache:
+    """Looks up the local LRU first, then the shared tier, and counts hits per tier."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                # The shared tier is an optimization, never fail the request on it
+                self.errors += 1
+                logger.warning(f"Shared cache lookup failed: {e}")
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache write failed: {e}")
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round((self.local_hits + self.shared_hits) / lookups, 3) if lookups else 0.0,
+            "size": len(self.local),
+        }
+
+
+def build_cache(prefix):
+    """Build a cache configured by ``<prefix>_SIZE``, ``<prefix>_TTL`` and ``<prefix>_TABLE``.
+
+    Without a table the cache only has the local tier, ``<prefix>_TABLE=local``
+    uses the in-memory stand-in as the shared tier.
+    """
+    ttl = int(os.environ.get(f"{prefix}_TTL", 3600))
+    local = LRUCache(maxsize=int(os.environ.get(f"{prefix}_SIZE", 1024)), ttl=ttl)
+    table = os.environ.get(f"{prefix}_TABLE")
+    if not table:
+        shared = None
+    elif table == "local":
+        shared = InMemorySharedTier(ttl=ttl)
+    else:
+        shared = DynamoDBSharedTier(table, ttl=ttl)
+    return TieredCache(local, shared)
+
+
+_caches = {}
+
+
+def get_cache(prefix):
+    """Process wide cache for ``prefix``, shared by every module that asks for it."""
+    if prefix not in _caches:
+        _caches[prefix] = build_cache(prefix)
+    return _caches[prefix]
+
+
+class CachedQueryEmbeddings:
+    """Wraps an embeddings object so repeated questions skip the embedding model."""
+
+    def __init__(self, embeddings, model_id, cache):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.cache = cache
+
+    def key(self, text):
+        return cache_key(self.model_id, normalize_text(text))
+
+    def embed_query(self, text):
+        key = self.key(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) * sum(y * y for y in b)) ** 0.5
+    return dot / norm if norm else 0.0
+
+
+class SemanticAnswerCache:
+    """Answers reused for near-duplicate questions asked over the same context.
+
+    Entries are grouped in buckets keyed by the generation parameters, a hash
+    of the retrieved context and the generation of the company index. Inside
+    a bucket the most similar earlier question above ``threshold`` wins.
+    Bumping a company's generation with :meth:`invalidate` makes every bucket
+    built before the change unreachable, and they age out through the LRU/TTL.
+    """
+
+    def __init__(self, cache, threshold=0.95, max_entries=8):
+        self.cache = cache
+        self.threshold = threshold
+        self.max_entries = max_entries
+
+    def _generation_key(self, company):
+        return cache_key("generation", company)
+
+    def generation(self, company):
+        # Read through to the shared tier so invalidations from other functions are seen
+        key = self._generation_key(company)
+        if self.cache.shared is not None:
+            try:
+                return self.cache.shared.get(key) or 0
+            except Exception as e:
+                logger.warning(f"Could not read generation of {company}: {e}")
+        return self.cache.local.get(key) or 0
+
+    def invalidate(self, company):
+        key = self._generation_key(company)
+        generation = time.time_ns()
+        self.cache.local.set(key, generation)
+        if self.cache.shared is not None:
+            self.cache.shared.set(key, generation)
+        logger.info(f"Answer cache invalidated for {company}")
+
+    def bucket_key(self, company, params, context):
+        context_hash = hashlib.sha256(context.encode()).hexdigest()
+        return cache_key("answers", company, self.generation(company), json.dumps(params, sort_keys=True), context_hash)
+
+    def lookup(self, bucket_key, vector):
+        best, best_similarity = None, self.threshold
+        for entry in self.cache.get(bucket_key) or []:
+            similarity = cosine_similarity(vector, entry["vector"])
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        if best is None:
+            return None, None
+        return best["result"], best_similarity
+
+    def _entries(self, bucket_key):
+        # The shared tier has the entries other containers stored since this one read the bucket
+        if self.cache.shared is not None:
+            try:
+                entries = self.cache.shared.get(bucket_key)
+                if entries is not None:
+                    return list(entries)
+            except Exception as e:
+                logger.warning(f"Could not read answers of {bucket_key}: {e}")
+        return list(self.cache.local.get(bucket_key) or [])
+
+    def store(self, bucket_key, vector, result):
+        entries = self._entries(bucket_key)
+        # Rounded vectors keep buckets small enough for the shared tier
+        entries.append({"vector": [round(x, 5) for x in vector], "result": result})
+        self.cache.set(bucket_key, entries[-self.max_entries:])
+
+
+def build_answer_cache(prefix="ANSWER_CACHE"):
+    return SemanticAnswerCache(
+        build_cache(prefix),
+        threshold=float(os.environ.get(f"{prefix}_THRESHOLD", 0.95)),
+        max_entries=int(os.environ.get(f"{prefix}_MAX_ENTRIES", 8)),
+    )
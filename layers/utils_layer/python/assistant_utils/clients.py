@@ -0,0 +1,216 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Per-container registry of AWS and OpenSearch clients.
+#
+# Lambda keeps the execution environment (and module globals) alive between
+# invocations, so everything created here is built once on the first request
+# and reused by every warm request that follows: pooled HTTP connections,
+# SigV4 credentials and the langchain wrappers built on top of them.
+
+import os
+import threading
+from datetime import datetime, timezone
+
+import boto3
+from botocore.config import Config
+
+OPENSEARCH_SERVICE = "es"
+
+# Seconds before expiry at which cached credentials are replaced
+CREDENTIALS_REFRESH_MARGIN = int(os.environ.get("CREDENTIALS_REFRESH_MARGIN", 300))
+# Maximum number of pooled keep-alive connections per client
+CLIENT_POOL_MAXSIZE = int(os.environ.get("CLIENT_POOL_MAXSIZE", 10))
+CLIENT_TIMEOUT = int(os.environ.get("CLIENT_TIMEOUT", 300))
+# Request path clients without langchain and opensearch-py, which dominate cold starts.
+# Those libraries are imported on first use only, when LEAN_RUNTIME is "false".
+LEAN_RUNTIME = os.environ.get("LEAN_RUNTIME", "true").lower() == "true"
+
+
+class ClientRegistry:
+    """Lazily builds and caches clients for the lifetime of the container."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._session = None
+        self._credentials = None
+        self._auth = None
+        self._clients = {}
+        self._embeddings = {}
+        self._llms = {}
+        self._vector_stores = {}
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = boto3.Session()
+        return self._session
+
+    def _credentials_expiring(self):
+        expiry = getattr(self._credentials, "_expiry_time", None)
+        if expiry is None:
+            return False
+        remaining = (expiry - datetime.now(timezone.utc)).total_seconds()
+        return remaining < CREDENTIALS_REFRESH_MARGIN
+
+    def credentials(self):
+        with self._lock:
+            if self._credentials is None or self._credentials_expiring():
+                self._credentials = self._get_session().get_credentials()
+                # Anything signing with the old credentials has to be rebuilt
+                self._auth = None
+                self._clients.pop("opensearch", None)
+                self._clients.pop("search", None)
+                self._vector_stores.clear()
+            return self._credentials
+
+    def aws_auth(self):
+        """SigV4 signer for OpenSearch, rebuilt only when credentials rotate."""
+        from opensearchpy import AWSV4SignerAuth
+
+        with self._lock:
+            credentials = self.credentials()
+            if self._auth is None:
+                self._auth = AWSV4SignerAuth(
+                    credentials, os.environ["REGION"], OPENSEARCH_SERVICE
+                )
+            return self._auth
+
+    def _boto3_client(self, service_name, region_name=None):
+        key = (service_name, region_name)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self._get_session().client(
+                    service_name,
+                    region_name=region_name,
+                    config=Config(
+                        max_pool_connections=CLIENT_POOL_MAXSIZE,
+                        tcp_keepalive=True,
+                        retries={"mode": "standard"},
+                    ),
+                )
+            return self._clients[key]
+
+    def bedrock_runtime(self):
+        return self._boto3_client(
+            "bedrock-runtime", region_name=os.environ["BEDROCK_REGION"]
+        )
+
+    def s3(self):
+        return self._boto3_client("s3")
+
+    def sqs(self):
+        return self._boto3_client("sqs")
+
+    def opensearch_kwargs(self):
+        """Connection settings shared by every OpenSearch client we create."""
+        from opensearchpy import RequestsHttpConnection
+
+        return {
+            "http_auth": self.aws_auth(),
+            "use_ssl": True,
+            "verify_certs": True,
+            "connection_class": RequestsHttpConnection,
+            "pool_maxsize": CLIENT_POOL_MAXSIZE,
+            "timeout": CLIENT_TIMEOUT,
+        }
+
+    def opensearch(self):
+        """Full opensearch-py client, for index management and bulk writes."""
+        from opensearchpy import OpenSearch
+
+        with self._lock:
+            self.credentials()
+            if "opensearch" not in self._clients:
+                port = int(os.environ.get("OPENSEARCH_ENDPOINT_PORT", 443))
+                self._clients["opensearch"] = OpenSearch(
+                    hosts=[{"host": os.environ["OPENSEARCH_ENDPOINT"], "port": port}],
+                    **self.opensearch_kwargs(),
+                )
+            return self._clients["opensearch"]
+
+    def search_client(self):
+        """Client for the searches on the request path, signed requests over urllib3 in lean mode."""
+        if not LEAN_RUNTIME:
+            return self.opensearch()
+        from assistant_utils.signed_search import SignedSearchClient
+
+        with self._lock:
+            credentials = self.credentials()
+            if "search" not in self._clients:
+                self._clients["search"] = SignedSearchClient(
+                    os.environ["OPENSEARCH_ENDPOINT"],
+                    os.environ["REGION"],
+                    credentials,
+                    port=int(os.environ.get("OPENSEARCH_ENDPOINT_PORT", 443)),
+                    service=OPENSEARCH_SERVICE,
+                    timeout=CLIENT_TIMEOUT,
+                    maxsize=CLIENT_POOL_MAXSIZE,
+                )
+            return self._clients["search"]
+
+    def bedrock_embeddings(self, model_id, client=None):
+        """Object with ``embed_query`` and ``embed_documents`` for ``model_id``."""
+        with self._lock:
+            if model_id not in self._embeddings:
+                if LEAN_RUNTIME:
+                    from assistant_utils.embeddings import BatchEmbedder
+
+                    self._embeddings[model_id] = BatchEmbedder(client or self.bedrock_runtime(), model_id)
+                else:
+                    from langchain_community.embeddings import BedrockEmbeddings
+
+                    self._embeddings[model_id] = BedrockEmbeddings(
+                        client=client or self.bedrock_runtime(),
+                        model_id=model_id,
+                    )
+            return self._embeddings[model_id]
+
+    def bedrock_llm(self, model_id, model_kwargs=None, **kwargs):
+        model_kwargs = model_kwargs or {}
+        key = (model_id, tuple(sorted(model_kwargs.items())), tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._llms:
+                if LEAN_RUNTIME:
+                    from assistant_utils.bedrock import BedrockTextModel
+
+                    llm_class = BedrockTextModel
+                else:
+                    from langchain_community.llms import Bedrock
+
+                    llm_class = Bedrock
+                self._llms[key] = llm_class(
+                    model_id=model_id,
+                    client=self.bedrock_runtime(),
+                    model_kwargs=dict(model_kwargs),
+                    **kwargs,
+                )
+            return self._llms[key]
+
+    def vector_store(self, index_name, embeddings):
+        """OpenSearchVectorSearch handle for ``index_name``, one per index."""
+        from langchain_community.vectorstores import OpenSearchVectorSearch
+
+        with self._lock:
+            self.credentials()
+            if index_name not in self._vector_stores:
+                self._vector_stores[index_name] = OpenSearchVectorSearch(
+                    index_name=index_name,
+                    embedding_function=embeddings,
+                    opensearch_url="https://" + os.environ["OPENSEARCH_ENDPOINT"] + ":443",
+                    **self.opensearch_kwargs(),
+                )
+            return self._vector_stores[index_name]
+
+    def reset(self):
+        """Drop every cached client, e.g. after a configuration change."""
+        with self._lock:
+            self._session = None
+            self._credentials = None
+            self._auth = None
+            self._clients.clear()
+            self._embeddings.clear()
+            self._llms.clear()
+            self._vector_stores.clear()
+
+
+registry = ClientRegistry()
@@ -0,0 +1,164 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Packs retrieved chunks into a prompt context that fits a token budget.
+
+import math
+import re
+
+from assistant_utils.cache import normalize_text
+
+WORD = re.compile(r"\w+")
+SENTENCE_END = re.compile(r"[.!?\n]\s")
+
+# Words too common to say anything about relevance
+STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from had has have how in is it its of on or "
+    "that the their there this to was were what when where which who why will with".split()
+)
+
+# Context window in tokens of the Bedrock text models, by model id prefix, most specific first
+MODEL_CONTEXT_TOKENS = (
+    ("anthropic.claude-3", 200000),
+    ("anthropic.claude-v2:1", 200000),
+    ("anthropic.claude", 100000),
+    ("amazon.titan-text-premier", 32000),
+    ("amazon.titan-text-express", 8000),
+    ("amazon.titan-text-lite", 4000),
+    ("meta.llama3", 8000),
+    ("meta.llama2", 4096),
+    ("mistral", 32000),
+    ("cohere.command", 4000),
+    ("ai21", 8191),
+)
+DEFAULT_CONTEXT_TOKENS = 4000
+
+
+def estimate_tokens(text, chars_per_token=4.0):
+    """Rough token count, Claude and Titan average about 4 characters per token in English."""
+    return math.ceil(len(text) / chars_per_token)
+
+
+def model_context_tokens(model_id):
+    for prefix, tokens in MODEL_CONTEXT_TOKENS:
+        if model_id.startswith(prefix):
+            return tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def context_token_budget(model_id, prompt, max_tokens, chars_per_token=4.0, headroom=0.1):
+    """Tokens left for retrieved documents in the context window of ``model_id``.
+
+    The window less the prompt without its documents and the ``max_tokens``
+    of the answer, with ``headroom`` of the window kept back since the token
+    counts are estimates.
+    """
+    window = model_context_tokens(model_id)
+    used = estimate_tokens(prompt, chars_per_token) + max_tokens + int(window * headroom)
+    return max(window - used, 0)
+
+
+def terms(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+
+def shingles(text, size=5):
+    words = WORD.findall(text.lower())
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def overlap(a, b):
+    """Share of the smaller shingle set found in the other one."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def relevance(question_terms, text, rank, rank_weight=0.5):
+    """Share of the question terms found in ``text`` with a prior for the retrieval rank.
+
+    Each term counts once however often it appears, so long passages do not
+    win by length alone.
+    """
+    if not question_terms:
+        return 1.0 / (rank + 1)
+    coverage = len(question_terms & set(terms(text))) / len(question_terms)
+    return coverage + rank_weight / (rank + 1)
+
+
+def truncate(text, max_chars):
+    """Cut ``text`` to ``max_chars``, at the last sentence end or word when there is one."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    ends = [match.end() for match in SENTENCE_END.finditer(cut)]
+    if ends and ends[-1] > max_chars // 2:
+        return cut[:ends[-1]].rstrip()
+    space = cut.rfind(" ")
+    return cut[:space] if space > max_chars // 2 else cut
+
+
+def format_document(text):
+    return "\n<document>\n{}\n</document>".format(text)
+
+
+def pack_context(
+    chunks,
+    question,
+    token_budget,
+    chars_per_token=4.0,
+    min_truncated_tokens=200,
+    overlap_threshold=0.8,
+):
+    """Fill ``token_budget`` with the chunks most relevant to ``question``.
+
+    Chunks repeating one already packed (the same text, or most of its five
+    word shingles) are dropped, the rest are ranked by relevance to the question
+    and added in that order while they fit. A chunk that does not fit is
+    truncated when at least ``min_truncated_tokens`` are left and dropped
+    otherwise, smaller chunks further down can still fill what remains.
+
+    Returns the context string and a report with the packed, dropped,
+    truncated and duplicate counts and the estimated tokens used.
+    """
+    question_terms = set(terms(question))
+    candidates = []
+    for rank, chunk in enumerate(chunks):
+        text = chunk["page_content"].strip()
+        if text:
+            candidates.append((relevance(question_terms, text, rank), rank, text))
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+
+    packed = []
+    kept_shingles = []
+    kept_normalized = []
+    report = {"packed": 0, "dropped": 0, "truncated": 0, "duplicates": 0, "tokens": 0, "budget": token_budget}
+    remaining = token_budget
+    for _, _, text in candidates:
+        normalized = normalize_text(text)
+        text_shingles = shingles(text)
+        if any(normalized in other for other in kept_normalized) or any(
+            overlap(text_shingles, other) >= overlap_threshold for other in kept_shingles
+        ):
+            report["duplicates"] += 1
+            report["dropped"] += 1
+            continue
+
+        tokens = estimate_tokens(format_document(text), chars_per_token)
+        if tokens > remaining:
+            overhead = estimate_tokens(format_document(""), chars_per_token)
+            if remaining - overhead < min_truncated_tokens:
+                report["dropped"] += 1
+                continue
+            text = truncate(text, int((remaining - overhead) * chars_per_token))
+            tokens = estimate_tokens(format_document(text), chars_per_token)
+            report["truncated"] += 1
+
+        packed.append(text)
+        kept_normalized.append(normalized)
+        kept_shingles.append(text_shingles)
+        remaining -= tokens
+        report["tokens"] += tokens
+        report["packed"] += 1
+
+    return "".join(format_document(text) for text in packed), report
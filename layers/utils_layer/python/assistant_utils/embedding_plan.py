@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Packs texts into as few embedding requests as the model limits allow.
+
+import json
+import math
+import os
+
+# Planning estimate, below the usual 4 because numbers and tables of financial reports take
+# more tokens per character than prose, inputs the model still finds too long are halved
+EMBEDDING_CHARS_PER_TOKEN = float(os.environ.get("EMBEDDING_CHARS_PER_TOKEN", 3.5))
+EMBEDDING_MAX_REQUEST_BYTES = int(os.environ.get("EMBEDDING_MAX_REQUEST_BYTES", 1024 * 1024))
+
+# Texts per request, tokens and characters per text and default vector dimension, by model id prefix
+MODEL_LIMITS = (
+    ("cohere.embed", {"max_texts": 96, "max_text_tokens": 512, "max_text_chars": 2048, "dimension": 1024}),
+    ("amazon.titan-embed-text-v2", {"max_texts": 1, "max_text_tokens": 8192, "max_text_chars": 50000, "dimension": 1024}),
+    ("amazon.titan-embed", {"max_texts": 1, "max_text_tokens": 8192, "max_text_chars": None, "dimension": 1536}),
+)
+DEFAULT_LIMITS = {"max_texts": 1, "max_text_tokens": 8192, "max_text_chars": None, "dimension": 1536}
+
+
+def model_limits(model_id):
+    for prefix, limits in MODEL_LIMITS:
+        if model_id.startswith(prefix):
+            return limits
+    return DEFAULT_LIMITS
+
+
+def planned_tokens(text, chars_per_token=EMBEDDING_CHARS_PER_TOKEN):
+    return max(1, math.ceil(len(text) / chars_per_token))
+
+
+def max_piece_chars(limits, chars_per_token=EMBEDDING_CHARS_PER_TOKEN):
+    """Longest text a single input may hold under the token and character limits."""
+    max_chars = int(limits["max_text_tokens"] * chars_per_token)
+    if limits["max_text_chars"]:
+        max_chars = min(max_chars, limits["max_text_chars"])
+    return max_chars
+
+
+def split_text(text, max_chars):
+    """Cut ``text`` into pieces of at most ``max_chars``.
+
+    Cuts fall on the last line break or space of the second half of each
+    window, so the same text always gives the same pieces.
+    """
+    pieces = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = start + max_chars
+        low = start + max_chars // 2
+        cut = max(text.rfind("\n", low, end), text.rfind(" ", low, end))
+        if cut <= start:
+            cut = end
+        pieces.append(text[start:cut])
+        start = cut
+    pieces.append(text[start:])
+    return pieces
+
+
+def combine_vectors(pieces):
+    """One vector for a text embedded in pieces: the mean of the ``(length, vector)``
+    pairs weighted by length, scaled back to the average norm of the pieces."""
+    if len(pieces) == 1:
+        return pieces[0][1]
+    total = sum(length for length, _ in pieces)
+    dimension = len(pieces[0][1])
+    mean = [sum(length * vector[i] for length, vector in pieces) / total for i in range(dimension)]
+    norm = math.sqrt(sum(value * value for value in mean))
+    target = sum(math.sqrt(sum(value * value for value in vector)) for _, vector in pieces) / len(pieces)
+    if norm == 0:
+        return mean
+    return [value * target / norm for value in mean]
+
+
+def plan_requests(texts, limits, chars_per_token=EMBEDDING_CHARS_PER_TOKEN, max_request_bytes=EMBEDDING_MAX_REQUEST_BYTES):
+    """Group ``texts`` into embedding requests.
+
+    Texts over the per input limits are split with ``split_text`` first. The
+    pieces are then packed first fit decreasing into requests bounded by the
+    texts per request of the model and ``max_request_bytes``.
+
+    Returns the requests, lists of ``(text index, piece)``, and a report with the
+    number of requests, pieces and split texts and how full each request is
+    (the largest share of its text count, token or byte capacity it uses).
+    """
+    max_chars = max_piece_chars(limits, chars_per_token)
+    items = []
+    split_texts = 0
+    for index, text in enumerate(texts):
+        pieces = split_text(text, max_chars) if len(text) > max_chars else [text]
+        split_texts += len(pieces) > 1
+        items.extend((index, piece) for piece in pieces)
+
+    max_texts = limits["max_texts"]
+    token_capacity = max_texts * limits["max_text_tokens"]
+    requests = []
+    usage = []
+    # Bigger pieces first leaves the small ones to fill the gaps
+    for index, piece in sorted(items, key=lambda item: len(item[1]), reverse=True):
+        tokens = planned_tokens(piece, chars_per_token)
+        size = len(json.dumps(piece).encode()) + 2
+        for request, used in zip(requests, usage):
+            if used["texts"] < max_texts and used["bytes"] + size <= max_request_bytes:
+                break
+        else:
+            request, used = [], {"texts": 0, "tokens": 0, "bytes": 0}
+            requests.append(request)
+            usage.append(used)
+        request.append((index, piece))
+        used["texts"] += 1
+        used["tokens"] += tokens
+        used["bytes"] += size
+
+    # With one text per request the count says nothing, only the tokens do
+    text_share = (lambda used: used["texts"] / max_texts) if max_texts > 1 else (lambda used: 0.0)
+    fill = [
+        round(max(text_share(used), used["tokens"] / token_capacity, used["bytes"] / max_request_bytes), 3)
+        for used in usage
+    ]
+    report = {
+        "texts": len(texts),
+        "pieces": len(items),
+        "split_texts": split_texts,
+        "requests": len(requests),
+        "fill": fill,
+    }
+    return requests, report
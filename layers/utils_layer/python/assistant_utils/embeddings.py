@@ -0,0 +1,225 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Concurrent Bedrock embedding client with adaptive throttling.
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError
+
+from assistant_utils.embedding_plan import combine_vectors, model_limits, plan_requests, split_text
+
+logger = Logger(child=True)
+
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 8))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 8))
+EMBEDDING_BASE_DELAY = float(os.environ.get("EMBEDDING_BASE_DELAY", 0.25))
+EMBEDDING_MAX_DELAY = float(os.environ.get("EMBEDDING_MAX_DELAY", 20))
+
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelTimeoutException",
+}
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return max(1, len(text) // 4)
+
+
+class EmbeddingStats:
+    """Counters for one embedding job, safe to update from worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.throttled = 0
+        self.split = 0
+        self.fill = 0.0
+        self.planned = 0
+        self.seconds = 0.0
+
+    def add(self, chunks=0, tokens=0, requests=0, throttled=0, split=0, fill=(), seconds=0.0):
+        with self._lock:
+            self.chunks += chunks
+            self.tokens += tokens
+            self.requests += requests
+            self.throttled += throttled
+            self.split += split
+            self.fill += sum(fill)
+            self.planned += len(fill)
+            self.seconds += seconds
+
+    def as_dict(self):
+        seconds = self.seconds or float("inf")
+        return {
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "split": self.split,
+            "mean_request_fill": round(self.fill / self.planned, 3) if self.planned else None,
+            "seconds": round(self.seconds, 3),
+            "chunks_per_second": round(self.chunks / seconds, 2),
+            "tokens_per_second": round(self.tokens / seconds, 2),
+        }
+
+
+class AdaptiveLimit:
+    """Concurrency limit that halves on throttling and grows back by one on success."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def throttled(self):
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._condition:
+            self._successes += 1
+            if self.limit < self.maximum and self._successes >= self.limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+
+class BatchEmbedder:
+    """Embeds texts with parallel ``invoke_model`` calls, keeping results in input order.
+
+    Texts are packed into as few requests as the model limits allow and texts
+    over the per input limit are embedded in pieces (``embedding_plan``). A piece
+    the model still rejects as too long is halved and sent again.
+    """
+
+    def __init__(
+        self,
+        client,
+        model_id,
+        max_workers=EMBEDDING_CONCURRENCY,
+        max_retries=EMBEDDING_MAX_RETRIES,
+        base_delay=EMBEDDING_BASE_DELAY,
+        max_delay=EMBEDDING_MAX_DELAY,
+    ):
+        self.client = client
+        self.model_id = model_id
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limits = model_limits(model_id)
+        self.limit = AdaptiveLimit(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def embed_documents(self, texts, stats=None):
+        return self._embed_all(texts, stats, "search_document")
+
+    def embed_query(self, text, stats=None):
+        # Cohere embeds questions differently from the passages they are searched against
+        return self._embed_all([text], stats, "search_query")[0]
+
+    def _embed_all(self, texts, stats, input_type):
+        stats = stats if stats is not None else EmbeddingStats()
+        start = time.perf_counter()
+        requests, report = plan_requests(texts, self.limits)
+        logger.debug(f"Embedding plan: {report}")
+        # map() yields results in submission order whatever order they finish in
+        results = self._executor.map(
+            lambda request: self._embed_texts([piece for _, piece in request], stats, input_type), requests
+        )
+        pieces = [[] for _ in texts]
+        for request, vectors in zip(requests, results):
+            for (index, piece), vector in zip(request, vectors):
+                pieces[index].append((len(piece), vector))
+        stats.add(
+            chunks=len(texts),
+            split=report["split_texts"],
+            fill=report["fill"],
+            seconds=time.perf_counter() - start,
+        )
+        return [combine_vectors(text_pieces) for text_pieces in pieces]
+
+    def _request_body(self, texts, input_type):
+        if self.model_id.startswith("cohere."):
+            return {"texts": texts, "input_type": input_type}
+        return {"inputText": texts[0]}
+
+    def _parse_response(self, body, texts):
+        if self.model_id.startswith("cohere."):
+            return body["embeddings"], sum(estimate_tokens(text) for text in texts)
+        return [body["embedding"]], body.get("inputTextTokenCount", estimate_tokens(texts[0]))
+
+    def _embed_texts(self, texts, stats, input_type):
+        """Vectors of ``texts`` from one request, or several when the model rejects it."""
+        try:
+            return self._embed(texts, stats, input_type)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ValidationException":
+                raise
+            if len(texts) > 1:
+                half = len(texts) // 2
+                return self._embed_texts(texts[:half], stats, input_type) + self._embed_texts(texts[half:], stats, input_type)
+            # The token estimate was too low for this text, embed it in two halves
+            halves = split_text(texts[0], max(1, (len(texts[0]) + 1) // 2))
+            if len(halves) < 2:
+                raise
+            logger.info(f"Embedding input of {len(texts[0])} characters rejected, splitting it: {e}")
+            stats.add(split=1)
+            vectors = [self._embed_texts([half], stats, input_type)[0] for half in halves]
+            return [combine_vectors([(len(half), vector) for half, vector in zip(halves, vectors)])]
+
+    def _embed(self, texts, stats, input_type):
+        attempt = 0
+        while True:
+            try:
+                with self.limit:
+                    response = self.client.invoke_model(
+                        modelId=self.model_id,
+                        body=json.dumps(self._request_body(texts, input_type)),
+                        accept="application/json",
+                        contentType="application/json",
+                    )
+                    body = json.loads(response["body"].read())
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in THROTTLING_ERRORS or attempt >= self.max_retries:
+                    raise
+                self.limit.throttled()
+                stats.add(throttled=1)
+                # Full jitter keeps throttled workers from retrying in lockstep
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+                attempt += 1
+                logger.info(f"Bedrock throttled ({code}), retrying in {delay:.2f}s, limit {self.limit.limit}")
+                time.sleep(delay)
+                continue
+
+            self.limit.succeeded()
+            vectors, tokens = self._parse_response(body, texts)
+            stats.add(tokens=tokens, requests=1)
+            return vectors
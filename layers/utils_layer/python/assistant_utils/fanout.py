@@ -0,0 +1,392 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Fan-out ingestion of large documents: byte-range work units aligned to chunk
+# boundaries, the queue that carries them to the workers and the checkpoints
+# that let a retried unit resume where it stopped.
+
+import bisect
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from aws_lambda_powertools import Logger
+
+from assistant_utils.ingest import split_stream_offsets
+
+logger = Logger(child=True)
+
+# A unit closes before it spans more bytes or holds more chunks than this,
+# the chunk count bounds how long a worker spends embedding it
+FANOUT_UNIT_BYTES = int(os.environ.get("FANOUT_UNIT_BYTES", 4 * 1024 * 1024))
+FANOUT_UNIT_CHUNKS = int(os.environ.get("FANOUT_UNIT_CHUNKS", 500))
+# Checkpoints of finished or abandoned jobs expire after this
+CHECKPOINT_TTL = int(os.environ.get("INGEST_CHECKPOINT_TTL", 7 * 24 * 3600))
+
+# SQS accepts 10 messages and 256 KiB per batch
+SQS_BATCH_MESSAGES = 10
+SQS_BATCH_BYTES = 200 * 1024
+
+
+def job_id(url, etag):
+    """Same id for every delivery of one upload, a new one when the object changes."""
+    return hashlib.md5(f"{url}\n{etag}".encode()).hexdigest()
+
+
+class _ByteOffsets:
+    """Passes decoded pieces through and maps character offsets back to byte offsets.
+
+    Offsets must be asked in increasing order: only the text since the last
+    one is encoded and the pieces before it are forgotten.
+    """
+
+    def __init__(self, pieces, encoding):
+        self.pieces = pieces
+        self.encoding = encoding
+        self._chars = []
+        self._bytes = []
+        self._texts = []
+        self._next_char = 0
+        self._next_byte = 0
+        self._last = (0, 0)
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self._chars.append(self._next_char)
+            self._bytes.append(self._next_byte)
+            self._texts.append(piece)
+            self._next_char += len(piece)
+            self._next_byte += len(piece.encode(self.encoding, "surrogateescape"))
+            yield piece
+
+    def byte_offset(self, char_offset):
+        position = max(bisect.bisect_right(self._chars, char_offset) - 1, 0)
+        last_char, last_byte = self._last
+        if position > 0 or last_char < self._chars[0] or last_char > char_offset:
+            last_char, last_byte = self._chars[position], self._bytes[position]
+        start = self._chars[position]
+        text = self._texts[position][last_char - start:char_offset - start]
+        offset = last_byte + len(text.encode(self.encoding, "surrogateescape"))
+        self._last = (char_offset, offset)
+        del self._chars[:position], self._bytes[:position], self._texts[:position]
+        return offset
+
+
+def chunk_ranges(pieces, text_splitter, window, encoding="utf-8"):
+    """Split a document and yield ``(start, end, text)`` with the byte range of each chunk.
+
+    ``pieces`` must be decoded with ``errors="surrogateescape"`` so every byte,
+    valid or not, keeps its place. ``text`` is the chunk as a worker decoding
+    the range gets it, invalid bytes replaced. Raises ValueError when the
+    splitter does not keep chunks verbatim, their range is unknown then.
+    """
+    offsets = _ByteOffsets(pieces, encoding)
+    for offset, chunk in split_stream_offsets(offsets, text_splitter, window):
+        if offset is None:
+            raise ValueError("The splitter rewrote a chunk, it has no byte range")
+        start = offsets.byte_offset(offset)
+        data = chunk.encode(encoding, "surrogateescape")
+        yield start, start + len(data), data.decode(encoding, "replace")
+
+
+def plan_units(ranges, unit_bytes=FANOUT_UNIT_BYTES, unit_chunks=FANOUT_UNIT_CHUNKS):
+    """Group the chunk ranges of a document into work units.
+
+    Each unit is the byte range ``[start, end)`` of whole consecutive chunks
+    and the ``[offset, length]`` of each chunk in it, so a worker reads the
+    range and gets exactly the chunks of splitting the whole document. With an
+    overlap, neighbouring units share the bytes their chunks share.
+    """
+    units = []
+    current = None
+    for start, end, _ in ranges:
+        if current and (end - current["start"] > unit_bytes or len(current["chunks"]) >= unit_chunks):
+            units.append(current)
+            current = None
+        if current is None:
+            current = {"unit": len(units), "start": start, "end": end, "chunks": []}
+        current["chunks"].append([start - current["start"], end - start])
+        current["end"] = max(current["end"], end)
+    if current:
+        units.append(current)
+    return units
+
+
+def range_header(unit):
+    return f"bytes={unit['start']}-{unit['end'] - 1}"
+
+
+def unit_texts(data, unit, encoding="utf-8"):
+    """The chunks of a unit from the bytes of its range."""
+    for offset, length in unit["chunks"]:
+        yield data[offset:offset + length].decode(encoding, "replace")
+
+
+class SqsQueue:
+    """Work units as SQS messages, the worker lambda consumes them through its event source."""
+
+    local = False
+
+    def __init__(self, sqs, queue_url, max_retries=3):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.max_retries = max_retries
+
+    def send(self, messages):
+        batch = []
+        batch_bytes = 0
+        for message in messages:
+            body = json.dumps(message)
+            if batch and (len(batch) == SQS_BATCH_MESSAGES or batch_bytes + len(body) > SQS_BATCH_BYTES):
+                self._send_batch(batch)
+                batch, batch_bytes = [], 0
+            batch.append({"Id": str(len(batch)), "MessageBody": body})
+            batch_bytes += len(body)
+        if batch:
+            self._send_batch(batch)
+
+    def _send_batch(self, entries):
+        for attempt in range(self.max_retries + 1):
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed = {failure["Id"] for failure in response.get("Failed", [])}
+            entries = [entry for entry in entries if entry["Id"] in failed]
+            if not entries:
+                return
+            time.sleep(0.2 * 2 ** attempt)
+        raise RuntimeError(f"{len(entries)} work units could not be queued: {response.get('Failed')}")
+
+
+class InMemoryQueue:
+    """Local stand-in for the SQS queue, for tests and single container runs.
+
+    ``drain`` plays the worker lambda: a message whose handler raises is
+    delivered again, up to ``max_receives`` times, then moved to ``dead_letters``.
+    """
+
+    local = True
+
+    def __init__(self, max_receives=3):
+        self.max_receives = max_receives
+        self.dead_letters = []
+        self._messages = collections.deque()
+        self._lock = threading.Lock()
+
+    def send(self, messages):
+        with self._lock:
+            # Serialized like SQS would, a message the real queue refuses fails here too
+            self._messages.extend({"body": json.dumps(message), "receives": 0} for message in messages)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _receive(self):
+        with self._lock:
+            if not self._messages:
+                return None
+            message = self._messages.popleft()
+            message["receives"] += 1
+            return message
+
+    def drain(self, handler, workers=1):
+        """Run ``handler`` on each message body with ``workers`` threads until the queue is empty."""
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while True:
+                while len(running) < workers:
+                    message = self._receive()
+                    if message is None:
+                        break
+                    running[executor.submit(handler, json.loads(message["body"]))] = message
+                if not running:
+                    return results
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    message = running.pop(future)
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        logger.warning(f"Work unit failed on receive {message['receives']}: {e}")
+                        with self._lock:
+                            if message["receives"] >= self.max_receives:
+                                self.dead_letters.append({**message, "error": repr(e)})
+                            else:
+                                self._messages.append(message)
+
+
+class InMemoryCheckpoints:
+    """Local stand-in for the checkpoint table, for tests and single container runs."""
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get_job(self, job):
+        """The stored record of the job with its ``result`` once finished, None for a new job."""
+        with self._lock:
+            item = self._items.get(("job", job))
+            if item is None:
+                return None
+            return {key: value for key, value in item.items() if key not in ("completed", "lease", "finalized")}
+
+    def start_job(self, job, record):
+        """Store the job unless a delivery before this one did, returns the stored record."""
+        with self._lock:
+            item = self._items.setdefault(("job", job), {**record, "completed": set()})
+            return {key: value for key, value in item.items() if key != "completed"}
+
+    def get_unit(self, job, unit):
+        with self._lock:
+            return dict(self._items.get(("unit", job, unit), {"chunks_done": 0, "done": False}))
+
+    def save_unit(self, job, unit, chunks_done):
+        with self._lock:
+            self._items.setdefault(("unit", job, unit), {"chunks_done": 0, "done": False})["chunks_done"] = chunks_done
+
+    def complete_unit(self, job, unit):
+        """Mark the unit done, returns how many units of the job are."""
+        with self._lock:
+            self._items.setdefault(("unit", job, unit), {"chunks_done": 0})["done"] = True
+            completed = self._items[("job", job)]["completed"]
+            completed.add(unit)
+            return len(completed)
+
+    def claim_finalize(self, job, lease_seconds):
+        """The lease of this caller on finalizing the job, None when someone else holds one
+        or the job is finalized. A lease lapses after ``lease_seconds``."""
+        with self._lock:
+            item = self._items[("job", job)]
+            if item.get("finalized") or item.get("lease", 0) > time.time():
+                return None
+            item["lease"] = time.time() + lease_seconds
+            return item["lease"]
+
+    def release_finalize(self, job, lease):
+        """Give up ``lease`` after a failed finalization, unless it already lapsed and was claimed again."""
+        with self._lock:
+            item = self._items[("job", job)]
+            if item.get("lease") == lease:
+                del item["lease"]
+
+    def finish_job(self, job, result):
+        with self._lock:
+            self._items[("job", job)].update({"finalized": True, "result": result})
+
+
+class DynamoDBCheckpoints:
+    """Checkpoints on a DynamoDB table with a ``key`` hash key and ``expires_at`` TTL attribute.
+
+    One item per job and one per unit, every update is a single conditional or
+    atomic write so concurrent workers never overwrite each other.
+    """
+
+    def __init__(self, table_name, ttl=CHECKPOINT_TTL):
+        import boto3
+
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.ttl = ttl
+        self._conflict = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def _expires_at(self):
+        return int(time.time() + self.ttl)
+
+    def get_job(self, job):
+        item = self.table.get_item(Key={"key": f"job#{job}"}, ConsistentRead=True).get("Item")
+        if item is None:
+            return None
+        record = json.loads(item["record"])
+        if "result" in item:
+            record["result"] = json.loads(item["result"])
+        return record
+
+    def start_job(self, job, record):
+        item = {"key": f"job#{job}", "record": json.dumps(record), "expires_at": self._expires_at()}
+        try:
+            self.table.put_item(Item=item, ConditionExpression="attribute_not_exists(#k)",
+                                ExpressionAttributeNames={"#k": "key"})
+            return record
+        except self._conflict:
+            stored = self.table.get_item(Key={"key": f"job#{job}"}, ConsistentRead=True)["Item"]
+            return json.loads(stored["record"])
+
+    def get_unit(self, job, unit):
+        item = self.table.get_item(Key={"key": f"unit#{job}#{unit}"}, ConsistentRead=True).get("Item") or {}
+        return {"chunks_done": int(item.get("chunks_done", 0)), "done": bool(item.get("done"))}
+
+    def save_unit(self, job, unit, chunks_done):
+        self.table.update_item(
+            Key={"key": f"unit#{job}#{unit}"},
+            UpdateExpression="SET chunks_done = :n, expires_at = :e",
+            ExpressionAttributeValues={":n": chunks_done, ":e": self._expires_at()},
+        )
+
+    def complete_unit(self, job, unit):
+        self.table.update_item(
+            Key={"key": f"unit#{job}#{unit}"},
+            UpdateExpression="SET done = :t, expires_at = :e",
+            ExpressionAttributeValues={":t": True, ":e": self._expires_at()},
+        )
+        # A set, so a unit delivered twice is counted once
+        response = self.table.update_item(
+            Key={"key": f"job#{job}"},
+            UpdateExpression="ADD completed :u",
+            ExpressionAttributeValues={":u": {str(unit)}},
+            ReturnValues="UPDATED_NEW",
+        )
+        return len(response["Attributes"]["completed"])
+
+    def claim_finalize(self, job, lease_seconds):
+        now = int(time.time())
+        try:
+            self.table.update_item(
+                Key={"key": f"job#{job}"},
+                UpdateExpression="SET lease = :until",
+                ConditionExpression="attribute_not_exists(finalized) AND (attribute_not_exists(lease) OR lease < :now)",
+                ExpressionAttributeValues={":until": now + lease_seconds, ":now": now},
+            )
+            return now + lease_seconds
+        except self._conflict:
+            return None
+
+    def release_finalize(self, job, lease):
+        try:
+            self.table.update_item(
+                Key={"key": f"job#{job}"},
+                UpdateExpression="REMOVE lease",
+                ConditionExpression="lease = :lease",
+                ExpressionAttributeValues={":lease": lease},
+            )
+        except self._conflict:
+            pass
+
+    def finish_job(self, job, result):
+        self.table.update_item(
+            Key={"key": f"job#{job}"},
+            UpdateExpression="SET finalized = :t, #r = :r",
+            ExpressionAttributeNames={"#r": "result"},
+            ExpressionAttributeValues={":t": True, ":r": json.dumps(result)},
+        )
+
+
+def build_queue(prefix="INGEST"):
+    """Queue of ``<prefix>_QUEUE_URL``, None when fan-out is off, ``local`` uses the in-memory stand-in."""
+    queue_url = os.environ.get(f"{prefix}_QUEUE_URL")
+    if not queue_url:
+        return None
+    if queue_url == "local":
+        return InMemoryQueue()
+    from assistant_utils.clients import registry
+
+    return SqsQueue(registry.sqs(), queue_url)
+
+
+def build_checkpoints(prefix="INGEST"):
+    """Checkpoints on ``<prefix>_CHECKPOINT_TABLE``, the in-memory stand-in without one or with ``local``."""
+    table = os.environ.get(f"{prefix}_CHECKPOINT_TABLE")
+    if not table or table == "local":
+        return InMemoryCheckpoints()
+    return DynamoDBCheckpoints(table)
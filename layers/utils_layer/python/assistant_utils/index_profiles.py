@@ -0,0 +1,189 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Named k-NN index profiles: engine, algorithm, quantization and search parameters.
+
+import copy
+import time
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+DEFAULT_PROFILE = "nmslib_hnsw"
+
+# "method" is the knn_vector method mapping, "ef_search" the search time candidate list
+# size of nmslib and faiss HNSW profiles and "training" marks methods that need a trained
+# model first. The lucene engine has no ef_search setting, its candidates follow k.
+INDEX_PROFILES = {
+    # What create_index always used: exact enough, but ef_search=512 is slow
+    "nmslib_hnsw": {
+        "method": {
+            "name": "hnsw",
+            "space_type": "l2",
+            "engine": "nmslib",
+            "parameters": {"ef_construction": 512, "m": 16},
+        },
+        "ef_search": 512,
+    },
+    "nmslib_hnsw_fast": {
+        "method": {
+            "name": "hnsw",
+            "space_type": "l2",
+            "engine": "nmslib",
+            "parameters": {"ef_construction": 256, "m": 16},
+        },
+        "ef_search": 100,
+    },
+    "faiss_hnsw": {
+        "method": {
+            "name": "hnsw",
+            "space_type": "l2",
+            "engine": "faiss",
+            "parameters": {"ef_construction": 256, "m": 16},
+        },
+        "ef_search": 100,
+    },
+    # Vectors stored as 16 bit floats, half the graph memory
+    "faiss_hnsw_fp16": {
+        "method": {
+            "name": "hnsw",
+            "space_type": "l2",
+            "engine": "faiss",
+            "parameters": {
+                "ef_construction": 256,
+                "m": 16,
+                "encoder": {"name": "sq", "parameters": {"type": "fp16"}},
+            },
+        },
+        "ef_search": 100,
+    },
+    # Vectors quantized to one byte per dimension by the engine, queries stay float
+    "lucene_hnsw_byte": {
+        "method": {
+            "name": "hnsw",
+            "space_type": "l2",
+            "engine": "lucene",
+            "parameters": {
+                "ef_construction": 256,
+                "m": 16,
+                "encoder": {"name": "sq"},
+            },
+        },
+    },
+    # Inverted file lists, needs a model trained on a sample of vectors
+    "faiss_ivf": {
+        "method": {
+            "name": "ivf",
+            "space_type": "l2",
+            "engine": "faiss",
+            "parameters": {"nlist": 64, "nprobes": 8},
+        },
+        "training": True,
+    },
+}
+
+
+def get_profile(name):
+    if name not in INDEX_PROFILES:
+        raise ValueError(f"Unknown index profile {name}, choose one of {', '.join(INDEX_PROFILES)}")
+    return copy.deepcopy(INDEX_PROFILES[name])
+
+
+def with_ef_search(profile, ef_search):
+    """Copy of an HNSW ``profile`` searching with a different ``ef_search``."""
+    profile = copy.deepcopy(profile)
+    profile["ef_search"] = ef_search
+    return profile
+
+
+def knn_field_mapping(profile, dimension, model_id=None):
+    if profile.get("training"):
+        # Dimension and method are part of the trained model
+        return {"type": "knn_vector", "model_id": model_id}
+    method = copy.deepcopy(profile["method"])
+    if "ef_search" in profile and method["engine"] == "faiss":
+        # faiss reads ef_search from the method, nmslib from the index settings
+        method["parameters"]["ef_search"] = profile["ef_search"]
+    return {"type": "knn_vector", "dimension": int(dimension), "method": method}
+
+
+def index_body(profile, dimension, vector_field="vector_field", text_field="text", model_id=None):
+    index_settings = {"knn": True}
+    if profile["method"]["engine"] == "nmslib" and "ef_search" in profile:
+        index_settings["knn.algo_param.ef_search"] = profile["ef_search"]
+    return {
+        "settings": {"index": index_settings},
+        "mappings": {
+            "properties": {
+                vector_field: knn_field_mapping(profile, dimension, model_id),
+                text_field: {"type": "text", "index": False},
+                "url": {
+                    "type": "text",
+                    "index": True,
+                    "fields": {"keyword": {"type": "keyword", "ignore_above": 2048}},
+                },
+            }
+        },
+    }
+
+
+def vector_dimension(opensearch, index_name, vector_field="vector_field"):
+    """Dimension of ``vector_field`` in an index or alias, None when there is no such field."""
+    try:
+        mappings = opensearch.indices.get_mapping(index=index_name)
+    except Exception:
+        return None
+    for mapping in mappings.values():
+        field = mapping.get("mappings", {}).get("properties", {}).get(vector_field, {})
+        if "dimension" in field:
+            return int(field["dimension"])
+        if "model_id" in field:
+            # Fields of a trained model take the dimension of the model
+            try:
+                response = opensearch.transport.perform_request("GET", f"/_plugins/_knn/models/{field['model_id']}")
+                return int(response["dimension"])
+            except Exception:
+                continue
+    return None
+
+
+def model_id_for(index_name, profile_name):
+    """Id of the trained model indices of a ``training`` profile are created with."""
+    return f"{index_name}-{profile_name}".replace("_", "-")
+
+
+def model_state(opensearch, model_id):
+    try:
+        response = opensearch.transport.perform_request("GET", f"/_plugins/_knn/models/{model_id}")
+    except Exception:
+        return None
+    return response.get("state")
+
+
+def train_model(opensearch, model_id, profile, dimension, training_index, vector_field="vector_field",
+                max_training_vectors=10000, wait_seconds=600):
+    """Train the model of a ``training`` profile on the vectors of ``training_index``."""
+    opensearch.transport.perform_request(
+        "POST",
+        f"/_plugins/_knn/models/{model_id}/_train",
+        body={
+            "training_index": training_index,
+            "training_field": vector_field,
+            "dimension": int(dimension),
+            "max_training_vector_count": max_training_vectors,
+            "method": profile["method"],
+        },
+    )
+    deadline = time.monotonic() + wait_seconds
+    delay = 1
+    while time.monotonic() < deadline:
+        state = model_state(opensearch, model_id)
+        if state == "created":
+            logger.info(f"Trained k-NN model {model_id}")
+            return model_id
+        if state == "failed":
+            raise RuntimeError(f"Training of k-NN model {model_id} failed")
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+    raise TimeoutError(f"k-NN model {model_id} was not trained within {wait_seconds} seconds")
@@ -0,0 +1,210 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Generator based building blocks to ingest documents without holding them in memory.
+
+import codecs
+import queue
+import threading
+import time
+from itertools import islice
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+S3_READ_BYTES = 1024 * 1024
+
+_DONE = object()
+
+
+def iter_s3_text(s3, bucket_name, object_key, read_bytes=S3_READ_BYTES, encoding="utf-8", errors="replace", **params):
+    """Yield the decoded text of an S3 object piece by piece.
+
+    Extra ``params`` go to ``get_object``, e.g. ``Range`` or ``IfMatch``.
+    """
+    body = s3.get_object(Bucket=bucket_name, Key=object_key, **params)["Body"]
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    for data in body.iter_chunks(read_bytes):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def split_stream(pieces, text_splitter, window):
+    """Split a stream of text incrementally.
+
+    Text is buffered until it holds ``window`` characters, then split. Every
+    chunk except the last is emitted and the raw text of the last one is kept
+    so it can grow with the next piece, which gives the same chunks as
+    splitting the whole document at once.
+    """
+    for _, chunk in split_stream_offsets(pieces, text_splitter, window):
+        yield chunk
+
+
+def split_stream_offsets(pieces, text_splitter, window):
+    """Same as ``split_stream``, yielding ``(offset, chunk)`` pairs with the position of
+    each chunk in the document, None when the splitter did not keep its text verbatim."""
+    buffer = ""
+    base = 0
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) < window:
+            continue
+        chunks = text_splitter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+        yield from _with_offsets(buffer, base, chunks[:-1])
+        start = buffer.rfind(chunks[-1])
+        if start != -1:
+            buffer = buffer[start:]
+            base = base + start if base is not None else None
+        else:
+            buffer = chunks[-1]
+            base = None
+    if buffer:
+        yield from _with_offsets(buffer, base, text_splitter.split_text(buffer))
+
+
+def _with_offsets(text, base, chunks):
+    cursor = 0
+    for chunk in chunks:
+        position = text.find(chunk, cursor)
+        if position == -1 or base is None:
+            yield None, chunk
+            continue
+        # Overlapping chunks start before the end of the previous one
+        cursor = position + 1
+        yield base + position, chunk
+
+
+def split_hierarchy(pieces, levels, window):
+    """Split a document in one pass at every granularity of ``levels``.
+
+    ``levels`` are ``(name, text_splitter)`` pairs, largest chunks first. The
+    stream is split with the first splitter and each chunk is split again with
+    the next one, so children never cross the boundary of their parent. Yields
+    one dict per chunk, parents before their children, with its ``granularity``,
+    ``text``, ``offset`` in the document, ``parent`` chunk (None at the top
+    level) and ``parent_offset`` in the text of the parent.
+    """
+    (name, text_splitter), children = levels[0], levels[1:]
+    for offset, text in split_stream_offsets(pieces, text_splitter, window):
+        chunk = {"granularity": name, "text": text, "offset": offset, "parent": None, "parent_offset": None}
+        yield chunk
+        yield from _split_children(chunk, children)
+
+
+def _split_children(parent, levels):
+    if not levels:
+        return
+    (name, text_splitter), children = levels[0], levels[1:]
+    for position, text in _with_offsets(parent["text"], 0, text_splitter.split_text(parent["text"])):
+        offset = None
+        if parent["offset"] is not None and position is not None:
+            offset = parent["offset"] + position
+        chunk = {"granularity": name, "text": text, "offset": offset, "parent": parent, "parent_offset": position}
+        yield chunk
+        yield from _split_children(chunk, children)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def rate_limited(iterable, per_second):
+    """Yield items no faster than ``per_second`` on average, unlimited when it is not set."""
+    if not per_second:
+        yield from iterable
+        return
+    interval = 1.0 / per_second
+    next_at = time.monotonic()
+    for item in iterable:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_at = max(next_at, time.monotonic() - interval) + interval
+        yield item
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(out, item, stop):
+    # Poll so producers notice when the consumer has gone away
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _feed(source, out, stop):
+    try:
+        for item in source:
+            if not _put(out, item, stop):
+                return
+    except Exception as e:
+        _put(out, _Failure(e), stop)
+        return
+    _put(out, _DONE, stop)
+
+
+def _stage(func, inbox, out, stop):
+    while not stop.is_set():
+        try:
+            item = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE or isinstance(item, _Failure):
+            _put(out, item, stop)
+            return
+        try:
+            result = func(item)
+        except Exception as e:
+            _put(out, _Failure(e), stop)
+            return
+        if not _put(out, result, stop):
+            return
+
+
+def pipeline(source, *stages, maxsize=2):
+    """Run ``source`` and each stage in its own thread, connected by bounded queues.
+
+    A stage blocks once ``maxsize`` results are waiting downstream, so a slow
+    consumer throttles everything upstream and at most ``maxsize`` items per
+    stage are held in memory. Results are yielded in source order and the
+    first exception raised by any stage is re-raised here.
+    """
+    stop = threading.Event()
+    inbox = queue.Queue(maxsize=maxsize)
+    threads = [threading.Thread(target=_feed, args=(source, inbox, stop), daemon=True)]
+    for func in stages:
+        out = queue.Queue(maxsize=maxsize)
+        threads.append(
+            threading.Thread(target=_stage, args=(func, inbox, out, stop), daemon=True)
+        )
+        inbox = out
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-process vector store on NumPy arrays: a hot cache for small indices such as
+# <company>_performance and an offline stand-in for OpenSearch.
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from aws_lambda_powertools import Logger
+
+from assistant_utils.search import TEXT_FIELD, VECTOR_FIELD
+
+logger = Logger(child=True)
+
+
+class LocalVectorStore:
+    """Exact k-NN over a contiguous float32 matrix of chunk vectors.
+
+    Scores follow OpenSearch so results can be mixed with k-NN hits:
+    ``1 / (1 + d^2)`` for ``l2`` and ``1 + cos`` for ``cosinesimil``.
+    """
+
+    def __init__(self, texts, vectors, metadatas=None, ids=None, embedding_function=None, space_type="l2"):
+        self.texts = list(texts)
+        self.metadatas = list(metadatas) if metadatas is not None else [{} for _ in self.texts]
+        self.ids = list(ids) if ids is not None else [str(i) for i in range(len(self.texts))]
+        self.embedding_function = embedding_function
+        self.space_type = space_type
+        self._lock = threading.Lock()
+        self._set_vectors(vectors)
+
+    def _set_vectors(self, vectors):
+        # No copy for float32 arrays that are already contiguous, memory-mapped ones included
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.vectors.ndim != 2 and len(self.texts):
+            raise ValueError("vectors must be a matrix with one row per text")
+        self._squared_norms = np.einsum("ij,ij->i", self.vectors, self.vectors) if len(self.texts) else None
+
+    def __len__(self):
+        return len(self.texts)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        return cls(texts, embedding.embed_documents(list(texts)), metadatas, embedding_function=embedding, **kwargs)
+
+    @classmethod
+    def from_opensearch(cls, opensearch, index_name, embedding_function=None, max_docs=10000, complete=False, **kwargs):
+        """Copy every document of ``index_name``, meant for indices of a few hundred documents.
+
+        Only the first ``max_docs`` are copied from a larger index, with a warning,
+        or a ValueError when ``complete`` is set.
+        """
+        response = opensearch.search(
+            index=index_name, body={"size": max_docs, "query": {"match_all": {}}, "track_total_hits": True}
+        )
+        total = response["hits"].get("total", 0)
+        total = total.get("value", 0) if isinstance(total, dict) else total
+        if total > len(response["hits"]["hits"]):
+            message = f"{index_name} has {total} documents, more than the {max_docs} of the local store"
+            if complete:
+                raise ValueError(message)
+            logger.warning(f"{message}, only those were copied")
+        texts, vectors, metadatas, ids = [], [], [], []
+        for hit in response["hits"]["hits"]:
+            source = dict(hit["_source"])
+            vectors.append(source.pop(VECTOR_FIELD))
+            texts.append(source.get(TEXT_FIELD, ""))
+            metadatas.append(source)
+            ids.append(hit["_id"])
+        return cls(texts, vectors, metadatas, ids, embedding_function=embedding_function, **kwargs)
+
+    def save(self, path):
+        """Write ``<path>.npy`` with the vectors and ``<path>.json`` with the rest."""
+        np.save(path + ".npy", self.vectors)
+        with open(path + ".json", "w") as f:
+            json.dump({"texts": self.texts, "metadatas": self.metadatas, "ids": self.ids, "space_type": self.space_type}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True, embedding_function=None):
+        """Load a saved store, by default memory mapping the vectors instead of reading them."""
+        with open(path + ".json") as f:
+            data = json.load(f)
+        vectors = np.load(path + ".npy", mmap_mode="r" if mmap else None)
+        return cls(data["texts"], vectors, data["metadatas"], data["ids"],
+                   embedding_function=embedding_function, space_type=data.get("space_type", "l2"))
+
+    def add_embeddings(self, texts, vectors, metadatas=None, ids=None):
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = list(ids) if ids is not None else [str(len(self.texts) + i) for i in range(len(texts))]
+        with self._lock:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            merged = np.concatenate([self.vectors, vectors]) if len(self.texts) else vectors
+            self.texts.extend(texts)
+            self.metadatas.extend(metadatas)
+            self.ids.extend(ids)
+            self._set_vectors(merged)
+        return ids
+
+    def add_texts(self, texts, metadatas=None, ids=None):
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding_function.embed_documents(texts), metadatas, ids)
+
+    def search_vectors(self, query_vectors, k):
+        """Top ``k`` rows and scores for every row of ``query_vectors``, best first."""
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        if not len(self.texts):
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        k = min(k, len(self.texts))
+        # One matrix product for the whole batch of queries
+        products = queries @ self.vectors.T
+        if self.space_type == "cosinesimil":
+            norms = np.sqrt(np.einsum("ij,ij->i", queries, queries))[:, None] * np.sqrt(self._squared_norms)[None, :]
+            scores = 1 + products / np.maximum(norms, 1e-12)
+        else:
+            squared_distances = np.einsum("ij,ij->i", queries, queries)[:, None] - 2 * products + self._squared_norms[None, :]
+            scores = 1 / (1 + np.maximum(squared_distances, 0))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def search(self, vector, k=4):
+        """Documents shaped like :func:`assistant_utils.search.hit_to_document`."""
+        rows, scores = self.search_vectors([vector], k)
+        return [
+            {"page_content": self.texts[row], "metadata": self.metadatas[row], "score": float(score), "id": self.ids[row]}
+            for row, score in zip(rows[0], scores[0])
+        ]
+
+    # Same methods as the langchain OpenSearchVectorSearch the retriever used
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        from langchain_core.documents import Document
+
+        return [
+            (Document(page_content=doc["page_content"], metadata=doc["metadata"]), doc["score"])
+            for doc in self.search(embedding, k)
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+
+class LocalStoreCache:
+    """Per-container copies of small indices, reloaded from OpenSearch after ``ttl`` seconds.
+
+    An index with more than ``max_docs`` documents is not copied, ``get`` raises a
+    LookupError for it until the ``ttl`` has passed so callers search OpenSearch.
+    """
+
+    def __init__(self, opensearch, ttl=600, max_docs=1000):
+        self.opensearch = opensearch
+        self.ttl = ttl
+        self.max_docs = max_docs
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, index_name):
+        with self._lock:
+            entry = self._stores.get(index_name)
+            if entry is None or entry[1] < time.time():
+                try:
+                    store = LocalVectorStore.from_opensearch(
+                        self.opensearch(), index_name, max_docs=self.max_docs, complete=True
+                    )
+                    logger.info(f"Loaded {len(store)} documents of {index_name} into the local store")
+                except ValueError as e:
+                    logger.warning(f"{e}, searching it in OpenSearch")
+                    store = None
+                entry = (store, time.time() + self.ttl)
+                self._stores[index_name] = entry
+            if entry[0] is None:
+                raise LookupError(f"{index_name} is too large for the local store")
+            return entry[0]
+
+    def invalidate(self, index_name=None):
+        with self._lock:
+            if index_name is None:
+                self._stores.clear()
+            else:
+                self._stores.pop(index_name, None)
+
+
+class LocalOpenSearch:
+    """Offline stand-in answering the k-NN requests the assistant sends to OpenSearch.
+
+    Indices are :class:`LocalVectorStore` objects, only ``search`` and
+    ``msearch`` with k-NN queries are supported.
+    """
+
+    def __init__(self, stores=None):
+        self.stores = dict(stores or {})
+
+    @classmethod
+    def from_directory(cls, path, mmap=True):
+        """One store per ``<index>.npy``/``<index>.json`` pair saved in ``path``."""
+        names = sorted(name[:-4] for name in os.listdir(path) if name.endswith(".npy"))
+        return cls({name: LocalVectorStore.load(os.path.join(path, name), mmap=mmap) for name in names})
+
+    def _search(self, index, body):
+        start = time.perf_counter()
+        store = self.stores.get(index)
+        if store is None:
+            return {"error": {"type": "index_not_found_exception", "index": index}, "status": 404}
+        knn = body.get("query", {}).get("knn", {})
+        if knn:
+            field = next(iter(knn.values()))
+            documents = store.search(field["vector"], body.get("size", field.get("k", 10)))
+        else:
+            documents = [
+                {"page_content": text, "metadata": metadata, "score": 1.0, "id": doc_id}
+                for text, metadata, doc_id in zip(store.texts, store.metadatas, store.ids)
+            ][: body.get("size", 10)]
+        hits = [
+            {"_index": index, "_id": doc["id"], "_score": doc["score"],
+             "_source": {**doc["metadata"], TEXT_FIELD: doc["page_content"]}}
+            for doc in documents
+        ]
+        took = int((time.perf_counter() - start) * 1000)
+        return {"took": took, "timed_out": False, "hits": {"total": {"value": len(hits)}, "hits": hits}}
+
+    def search(self, index=None, body=None, **kwargs):
+        return self._search(index, body or {})
+
+    def msearch(self, body, **kwargs):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        return {"responses": [self._search(header["index"], query) for header, query in zip(lines[::2], lines[1::2])]}
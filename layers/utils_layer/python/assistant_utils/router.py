@@ -0,0 +1,218 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Routes a question to the company it is about: alias and ticker matches first,
+# then the closest company centroid embedding, and only then the LLM.
+
+import json
+import re
+import threading
+import time
+
+from aws_lambda_powertools import Logger
+
+from assistant_utils.cache import cosine_similarity
+from assistant_utils.search import TEXT_FIELD, VECTOR_FIELD
+
+logger = Logger(child=True)
+
+# Names people use for the workshop companies that the indexed data does not contain
+DEFAULT_ALIASES = {
+    "amazon": ["amzn", "aws", "amazon web services", "amazon.com", "prime video", "alexa", "jassy", "bezos"],
+    "google": ["goog", "googl", "alphabet", "youtube", "google cloud", "gcp", "pichai"],
+}
+
+# Legal suffixes stripped from "Company Name" to get the name people actually use
+COMPANY_SUFFIXES = re.compile(r"[,.]?\s+(inc|corp|corporation|co|ltd|plc|llc)\.?$", re.IGNORECASE)
+
+# Index names of a company are its name followed by one of these
+CHUNK_INDEX_SUFFIXES = ("_small_index", "_medium_index", "_large_index")
+INDEX_SUFFIXES = CHUNK_INDEX_SUFFIXES + ("_performance",)
+
+
+def company_of_index(index_name):
+    """Indices are named <company>_<size>_index or <company>_performance, company names can have underscores."""
+    if index_name.startswith("."):
+        return None
+    for suffix in INDEX_SUFFIXES:
+        if index_name.endswith(suffix) and len(index_name) > len(suffix):
+            return index_name[:-len(suffix)]
+    return None
+
+
+def parse_company(completion, companies):
+    """Company named by an LLM completion, tolerant of text around the JSON."""
+    for match in re.finditer(r"\{.*?\}", completion, re.DOTALL):
+        try:
+            company = str(json.loads(match.group(0)).get("company", "")).strip().lower()
+        except (ValueError, AttributeError):
+            continue
+        if company in companies or company == "none":
+            return company
+    # No usable JSON, accept a completion naming exactly one company
+    named = [company for company in companies if re.search(rf"\b{re.escape(company)}\b", completion, re.IGNORECASE)]
+    return named[0] if len(named) == 1 else "none"
+
+
+class CompanyCatalog:
+    """Companies with indices in OpenSearch, their aliases and centroid embeddings."""
+
+    def __init__(self, companies, aliases, centroids):
+        self.companies = companies
+        self.aliases = aliases
+        self.centroids = centroids
+        self._patterns = {
+            company: re.compile(
+                r"(?<![\w.])(" + "|".join(re.escape(alias) for alias in sorted(names, key=len, reverse=True)) + r")(?![\w])",
+                re.IGNORECASE,
+            )
+            for company, names in aliases.items()
+        }
+
+    def match_aliases(self, text):
+        return [company for company in self.companies if self._patterns[company].search(text)]
+
+    def nearest(self, vector):
+        """Companies ranked by the cosine similarity of their centroid with ``vector``."""
+        scores = [(cosine_similarity(vector, centroid), company) for company, centroid in self.centroids.items()]
+        return sorted(scores, reverse=True)
+
+
+def list_companies(opensearch):
+    indices = opensearch.indices.get_alias(index="*")
+    # Restored or reindexed indices are versioned and served under an alias with the plain name
+    names = set(indices).union(*(index.get("aliases", {}) for index in indices.values()))
+    companies = {company_of_index(name) for name in names}
+    companies.discard(None)
+    return sorted(companies)
+
+
+def company_aliases(opensearch, company, extra_aliases=()):
+    """Name and ticker of ``company`` as written in its performance documents."""
+    aliases = {company, *extra_aliases}
+    try:
+        response = opensearch.search(
+            index=f"{company}_performance",
+            body={"size": 20, "_source": [TEXT_FIELD]},
+            ignore_unavailable=True,
+        )
+    except Exception as e:
+        logger.warning(f"Could not read the performance data of {company}: {e}")
+        return aliases
+    for hit in response["hits"]["hits"]:
+        try:
+            data = json.loads(hit["_source"].get(TEXT_FIELD, ""))
+        except ValueError:
+            continue
+        if data.get("Ticker"):
+            aliases.add(data["Ticker"].lower())
+        if data.get("Company Name"):
+            name = data["Company Name"].strip().lower()
+            aliases.add(name)
+            aliases.add(COMPANY_SUFFIXES.sub("", name))
+    return aliases
+
+
+def company_centroid(opensearch, company, sample_size):
+    """Normalized mean of the embeddings of up to ``sample_size`` chunks of ``company``."""
+    # Exact names, a wildcard would also match companies whose name starts with this one
+    response = opensearch.search(
+        index=",".join(company + suffix for suffix in CHUNK_INDEX_SUFFIXES),
+        body={"size": sample_size, "_source": [VECTOR_FIELD], "query": {"match_all": {}}},
+        ignore_unavailable=True,
+        allow_no_indices=True,
+    )
+    vectors = [hit["_source"][VECTOR_FIELD] for hit in response["hits"]["hits"] if VECTOR_FIELD in hit["_source"]]
+    if not vectors:
+        return None
+    centroid = [sum(values) / len(vectors) for values in zip(*vectors)]
+    norm = sum(x * x for x in centroid) ** 0.5
+    return [x / norm for x in centroid] if norm else None
+
+
+def build_catalog(opensearch, extra_aliases=None, sample_size=200):
+    extra_aliases = extra_aliases or {}
+    companies = list_companies(opensearch)
+    aliases = {company: company_aliases(opensearch, company, extra_aliases.get(company, ())) for company in companies}
+    centroids = {}
+    for company in companies:
+        try:
+            centroid = company_centroid(opensearch, company, sample_size)
+        except Exception as e:
+            logger.warning(f"Could not compute the centroid of {company}: {e}")
+            continue
+        if centroid is not None:
+            centroids[company] = centroid
+    logger.info(f"Company catalog: {companies}, aliases: {aliases}, centroids: {list(centroids)}")
+    return CompanyCatalog(companies, aliases, centroids)
+
+
+class CompanyRouter:
+    """Picks the company of a question with the cheapest tier that is confident.
+
+    1. alias: exactly one company's name, ticker or alias appears in the question
+    2. centroid: the question embedding is close to one company centroid and
+       clearly closer to it than to the next one
+    3. llm: everything else, e.g. questions naming several companies or none
+
+    The catalog is rebuilt from OpenSearch every ``ttl`` seconds, so companies
+    indexed later are picked up without a deployment.
+    """
+
+    def __init__(self, opensearch, embed_query, llm_classify, fallback_companies=(),
+                 extra_aliases=None, ttl=600, min_similarity=0.3, margin=0.05, sample_size=200):
+        self.opensearch = opensearch
+        self.embed_query = embed_query
+        self.llm_classify = llm_classify
+        self.fallback_companies = list(fallback_companies)
+        self.extra_aliases = extra_aliases or {}
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.margin = margin
+        self.sample_size = sample_size
+        self._catalog = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def catalog(self):
+        with self._lock:
+            if self._catalog is None or self._expires_at < time.time():
+                try:
+                    catalog = build_catalog(self.opensearch(), self.extra_aliases, self.sample_size)
+                except Exception as e:
+                    logger.warning(f"Could not build the company catalog: {e}")
+                    catalog = None
+                if catalog is None or not catalog.companies:
+                    # Keep serving the last good catalog, or the configured companies
+                    catalog = self._catalog or CompanyCatalog(
+                        self.fallback_companies,
+                        {company: {company, *self.extra_aliases.get(company, ())} for company in self.fallback_companies},
+                        {},
+                    )
+                self._catalog = catalog
+                self._expires_at = time.time() + self.ttl
+            return self._catalog
+
+    def route(self, question):
+        catalog = self.catalog()
+        companies = catalog.companies
+        result = {"companies": companies}
+
+        matches = catalog.match_aliases(question)
+        if len(matches) == 1:
+            return {**result, "index": matches[0], "method": "alias"}
+
+        if not matches and catalog.centroids:
+            try:
+                ranked = catalog.nearest(self.embed_query(question))
+            except Exception as e:
+                logger.warning(f"Centroid routing failed: {e}")
+                ranked = []
+            if ranked:
+                best_similarity, best = ranked[0]
+                second_similarity = ranked[1][0] if len(ranked) > 1 else -1.0
+                result["similarity"] = round(best_similarity, 4)
+                if best_similarity >= self.min_similarity and best_similarity - second_similarity >= self.margin:
+                    return {**result, "index": best, "method": "centroid"}
+
+        return {**result, "index": self.llm_classify(question, companies), "method": "llm"}
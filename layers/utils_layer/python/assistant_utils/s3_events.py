@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Scheduling of S3 event records: one action per object, in its final state, run concurrently.
+
+import os
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_lambda_powertools import Logger
+
+from assistant_utils.cache import LRUCache
+
+logger = Logger(child=True)
+
+# Objects whose last processed sequencer is remembered by a container
+SEQUENCER_LOG_SIZE = int(os.environ.get("SEQUENCER_LOG_SIZE", 10000))
+SEQUENCER_LOG_TTL = int(os.environ.get("SEQUENCER_LOG_TTL", 3600))
+
+
+def sequencer_value(sequencer):
+    """Comparable value of an S3 sequencer.
+
+    Sequencers of one key order its events but can differ in length, as hex
+    numbers they compare the same as zero padded on the left.
+    """
+    return int(sequencer, 16) if sequencer else None
+
+
+def coalesce(records):
+    """Collapse S3 event records to the final state of each object.
+
+    Records are grouped by bucket and key and the one with the greatest
+    sequencer wins, S3 does not deliver them in order. A record with the
+    sequencer of the winning one is a duplicate delivery. Without sequencers
+    the later record wins. Returns one dict per object in the order they were
+    first seen, with the winning ``record``, its ``event`` name, how many
+    ``records`` were collapsed into it and how many were ``duplicates``.
+    """
+    objects = {}
+    for record in records:
+        bucket = record.s3.bucket.name
+        key = urllib.parse.unquote_plus(record.s3.get_object.key)
+        sequencer = record.s3.get_object.get("sequencer")
+        current = objects.get((bucket, key))
+        if current is None:
+            objects[(bucket, key)] = {
+                "bucket": bucket,
+                "key": key,
+                "event": record.event_name,
+                "sequencer": sequencer,
+                "record": record,
+                "records": 1,
+                "duplicates": 0,
+            }
+            continue
+        current["records"] += 1
+        new_value, current_value = sequencer_value(sequencer), sequencer_value(current["sequencer"])
+        if new_value is not None and new_value == current_value:
+            current["duplicates"] += 1
+        elif new_value is None or current_value is None or new_value > current_value:
+            current.update(event=record.event_name, sequencer=sequencer, record=record)
+    return list(objects.values())
+
+
+class SequencerLog:
+    """Last sequencer processed per object in this container.
+
+    S3 may deliver an event twice, in separate invocations, and a container
+    often sees both. Events of an object at or before the last one processed
+    are stale: a later state of the object has already been indexed.
+    """
+
+    def __init__(self, maxsize=SEQUENCER_LOG_SIZE, ttl=SEQUENCER_LOG_TTL):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def is_stale(self, bucket, key, sequencer):
+        value = sequencer_value(sequencer)
+        last = self.cache.get((bucket, key))
+        return value is not None and last is not None and value <= last
+
+    def record(self, bucket, key, sequencer):
+        value = sequencer_value(sequencer)
+        if value is None:
+            return
+        last = self.cache.get((bucket, key))
+        if last is None or value > last:
+            self.cache.set((bucket, key), value)
+
+
+def run_concurrently(func, items, max_workers):
+    """``func`` on every item with at most ``max_workers`` threads.
+
+    Returns ``(result, error)`` pairs in item order, an item that raises gets
+    its exception instead of stopping the others.
+    """
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            logger.exception(f"{func.__name__} failed: {e}")
+            return None, e
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
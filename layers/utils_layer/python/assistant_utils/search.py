@@ -0,0 +1,138 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# k-NN searches against several indices in one _msearch round trip.
+
+import json
+import threading
+import time
+
+from aws_lambda_powertools import Logger
+
+from assistant_utils.cache import normalize_text
+
+logger = Logger(child=True)
+
+VECTOR_FIELD = "vector_field"
+TEXT_FIELD = "text"
+
+
+def knn_query(vector, k, vector_field=VECTOR_FIELD, timeout_ms=None):
+    query = {
+        "size": k,
+        "query": {"knn": {vector_field: {"vector": vector, "k": k}}},
+        "_source": {"excludes": [vector_field]},
+    }
+    if timeout_ms:
+        # Shards still searching when it expires return what they found so far
+        query["timeout"] = f"{int(timeout_ms)}ms"
+    return query
+
+
+def hit_to_document(hit, text_field=TEXT_FIELD):
+    """Same shape as the langchain documents the retriever used to return."""
+    source = hit["_source"]
+    return {
+        "page_content": source.get(text_field, ""),
+        "metadata": source,
+        "score": hit.get("_score"),
+        "id": hit.get("_id"),
+    }
+
+
+def knn_msearch(opensearch, searches, vector, timeout_ms=None):
+    """Run one k-NN search per ``(index_name, k)`` pair with a single request.
+
+    Returns one result per search, in order, with the matching documents and
+    the time OpenSearch reported for it. A search that fails (e.g. a missing
+    index) returns no documents and its error instead of failing the others.
+    With ``timeout_ms`` every search returns its partial hits once it expires.
+    """
+    lines = []
+    for index_name, k in searches:
+        lines.append(json.dumps({"index": index_name}))
+        lines.append(json.dumps(knn_query(vector, k, timeout_ms=timeout_ms)))
+    body = "\n".join(lines) + "\n"
+
+    start = time.perf_counter()
+    response = opensearch.msearch(body=body)
+    round_trip_ms = (time.perf_counter() - start) * 1000
+
+    results = []
+    for (index_name, k), item in zip(searches, response["responses"]):
+        result = {
+            "index": index_name,
+            "documents": [hit_to_document(hit) for hit in item.get("hits", {}).get("hits", [])],
+            "took_ms": item.get("took"),
+            "timed_out": item.get("timed_out", False),
+        }
+        if "error" in item:
+            logger.error(f"k-NN search on {index_name} failed: {item['error']}")
+            result["error"] = item["error"]
+        results.append(result)
+    return results, round_trip_ms
+
+
+def reciprocal_rank_fusion(document_lists, k=60):
+    """Merge ranked lists, scoring each document with the sum of 1 / (k + rank).
+
+    Only ranks are used, so lists from indices whose scores are not comparable
+    merge fairly. Ties go to the document with the higher search score.
+    """
+    fused = {}
+    for documents in document_lists:
+        for rank, document in enumerate(documents, start=1):
+            key = document.get("id") or document["page_content"]
+            entry = fused.setdefault(key, {**document, "rrf_score": 0.0})
+            entry["rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda doc: (doc["rrf_score"], doc.get("score") or 0), reverse=True)
+
+
+def drop_contained(documents):
+    """Drop documents whose text is part of a document ranked above them.
+
+    Small chunks are usually contained in a medium or large chunk of the same
+    source, returning both only repeats text in the prompt.
+    """
+    kept = []
+    for document in documents:
+        text = normalize_text(document["page_content"])
+        url = document["metadata"].get("url")
+        if any(
+            text in normalize_text(other["page_content"]) and url == other["metadata"].get("url")
+            for other in kept
+        ):
+            continue
+        kept.append(document)
+    return kept
+
+
+class LatencyTracker:
+    """Moving average of the time OpenSearch takes to search each index."""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._averages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, index_name, took_ms):
+        if took_ms is None:
+            return
+        with self._lock:
+            average = self._averages.get(index_name)
+            self._averages[index_name] = took_ms if average is None else average + self.alpha * (took_ms - average)
+
+    def expected(self, index_name):
+        return self._averages.get(index_name)
+
+    def within_budget(self, index_names, budget_ms):
+        """Indices expected to answer within ``budget_ms``, never fewer than one.
+
+        Indices without measurements yet are always searched so they get one.
+        """
+        if not budget_ms:
+            return list(index_names)
+        selected = [name for name in index_names if (self.expected(name) or 0) <= budget_ms]
+        if not selected:
+            selected = [min(index_names, key=lambda name: self.expected(name))]
+        return selected
@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# SigV4 signed OpenSearch search requests on botocore and urllib3, which boto3
+# already loads, so the request path does not have to import opensearch-py.
+
+import json
+from urllib.parse import quote, urlencode
+
+import urllib3
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.httpsession import get_cert_path
+
+
+class SearchError(Exception):
+    def __init__(self, status, info):
+        super().__init__(f"OpenSearch returned {status}: {info}")
+        self.status_code = status
+        self.info = info
+
+
+def _param(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        return ",".join(value)
+    return str(value)
+
+
+class _Indices:
+    def __init__(self, client):
+        self.client = client
+
+    def get_alias(self, index="*", **params):
+        return self.client.perform_request("GET", f"/{quote(index, safe='*,')}/_alias", params=params)
+
+    def exists(self, index, **params):
+        try:
+            self.client.perform_request("HEAD", f"/{quote(index, safe='*,')}", params=params)
+        except SearchError as e:
+            if e.status_code == 404:
+                return False
+            raise
+        return True
+
+
+class SignedSearchClient:
+    """Implements ``search``, ``msearch`` and ``indices.get_alias`` of the
+    opensearch-py client, with pooled keep-alive connections."""
+
+    def __init__(self, host, region, credentials, port=443, service="es", timeout=300, maxsize=10):
+        self.base_url = f"https://{host}:{port}"
+        self.region = region
+        self.credentials = credentials
+        self.service = service
+        self.indices = _Indices(self)
+        self._http = urllib3.PoolManager(
+            maxsize=maxsize,
+            timeout=urllib3.Timeout(total=timeout),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=get_cert_path(True),
+        )
+
+    def perform_request(self, method, path, params=None, body=None, content_type="application/json"):
+        url = self.base_url + path
+        if params:
+            url += "?" + urlencode({key: _param(value) for key, value in params.items()})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        data = body.encode() if isinstance(body, str) else body
+        headers = {"Content-Type": content_type} if data is not None else {}
+
+        request = AWSRequest(method=method, url=url, data=data, headers=headers)
+        SigV4Auth(self.credentials.get_frozen_credentials(), self.service, self.region).add_auth(request)
+        response = self._http.request(method, url, body=data, headers=dict(request.headers.items()))
+
+        payload = json.loads(response.data) if response.data else {}
+        if response.status >= 400:
+            raise SearchError(response.status, payload)
+        return payload
+
+    def search(self, index=None, body=None, **params):
+        path = f"/{quote(index, safe='*,')}/_search" if index else "/_search"
+        return self.perform_request("POST", path, params=params, body=body or {})
+
+    def msearch(self, body, index=None, **params):
+        path = f"/{quote(index, safe='*,')}/_msearch" if index else "/_msearch"
+        return self.perform_request("POST", path, params=params, body=body, content_type="application/x-ndjson")
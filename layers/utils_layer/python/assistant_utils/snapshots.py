@@ -0,0 +1,116 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# S3 snapshot repository, timestamped snapshots, retention and status polling.
+
+import random
+import time
+from datetime import datetime, timezone
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+RUNNING_STATES = ("IN_PROGRESS", "STARTED")
+COMPLETED_STATES = ("SUCCESS", "PARTIAL")
+
+
+def snapshot_name(prefix, now=None):
+    """``<prefix>-<UTC timestamp>``, names sort in the order they were taken."""
+    now = now or datetime.now(timezone.utc)
+    return f"{prefix}-{now:%Y%m%d-%H%M%S}"
+
+
+def repository_settings(bucket, role_arn, region, base_path="snapshot/", max_bytes_per_sec=None):
+    settings = {"bucket": bucket, "base_path": base_path, "region": region, "role_arn": role_arn}
+    if max_bytes_per_sec:
+        # Throttles the copy to S3 so searches keep their disk and network bandwidth
+        settings["max_snapshot_bytes_per_sec"] = max_bytes_per_sec
+    return settings
+
+
+def register_repository(opensearch, repository, settings):
+    """Register the S3 repository unless it already has these settings.
+
+    Registering verifies the repository from every node, so it is only done
+    when something changed. Returns whether the repository was (re)registered.
+    """
+    try:
+        current = opensearch.snapshot.get_repository(repository=repository).get(repository, {})
+    except Exception:
+        current = {}
+    if current.get("type") == "s3" and all(
+        str(current.get("settings", {}).get(key)) == str(value) for key, value in settings.items()
+    ):
+        return False
+    response = opensearch.snapshot.create_repository(repository=repository, body={"type": "s3", "settings": settings})
+    logger.info(f"Registered snapshot repository {repository}: {response}")
+    return True
+
+
+def list_snapshots(opensearch, repository, prefix=None):
+    """Snapshots of the repository, oldest first, optionally only those named ``<prefix>-*``."""
+    pattern = f"{prefix}-*" if prefix else "_all"
+    try:
+        response = opensearch.snapshot.get(repository=repository, snapshot=pattern, ignore_unavailable=True)
+    except Exception as e:
+        if getattr(e, "status_code", None) == 404:
+            return []
+        raise
+    return sorted(response.get("snapshots", []), key=lambda snapshot: snapshot.get("start_time_in_millis", 0))
+
+
+def latest_snapshot(opensearch, repository, prefix=None, states=COMPLETED_STATES):
+    """The newest snapshot in one of ``states``, or None."""
+    snapshots = [snapshot for snapshot in list_snapshots(opensearch, repository, prefix) if snapshot["state"] in states]
+    return snapshots[-1] if snapshots else None
+
+
+def snapshot_state(opensearch, repository, name):
+    # _snapshot/<repo>/<name> reads the repository metadata, unlike _status it does
+    # not collect the progress of every shard from the data nodes
+    response = opensearch.snapshot.get(repository=repository, snapshot=name)
+    return response["snapshots"][0]["state"]
+
+
+def backoff_delays(initial=1.0, factor=2.0, maximum=30.0, jitter=0.2):
+    """Exponential delays with jitter: 1, 2, 4, ... seconds, capped at ``maximum``."""
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)  # nosec B311
+        delay = min(delay * factor, maximum)
+
+
+def wait_for_snapshot(opensearch, repository, name, deadline, delays=None):
+    """Poll the snapshot state with backoff until it stops running or ``deadline``
+    (a ``time.monotonic()`` value) would pass. Returns the last state seen."""
+    delays = delays or backoff_delays()
+    state = snapshot_state(opensearch, repository, name)
+    for delay in delays:
+        if state not in RUNNING_STATES or time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        state = snapshot_state(opensearch, repository, name)
+        logger.info(f"Snapshot {name} is {state}")
+    return state
+
+
+def prune_snapshots(opensearch, repository, prefix, keep):
+    """Delete the ``<prefix>-*`` snapshots older than the newest ``keep`` completed ones.
+
+    Running snapshots are never deleted, failed ones older than the kept ones are.
+    Returns the deleted names.
+    """
+    snapshots = list_snapshots(opensearch, repository, prefix)
+    completed = [snapshot for snapshot in snapshots if snapshot["state"] in COMPLETED_STATES]
+    if len(completed) <= keep:
+        return []
+    oldest_kept = completed[-keep]["start_time_in_millis"] if keep else float("inf")
+    deleted = []
+    for snapshot in snapshots:
+        if snapshot["state"] in RUNNING_STATES or snapshot.get("start_time_in_millis", 0) >= oldest_kept:
+            continue
+        opensearch.snapshot.delete(repository=repository, snapshot=snapshot["snapshot"])
+        deleted.append(snapshot["snapshot"])
+    logger.info(f"Pruned snapshots {deleted}")
+    return deleted
@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Token streaming from Bedrock text models.
+
+import json
+
+
+def anthropic_prompt(prompt):
+    """Wrap a prompt in the Human/Assistant turns Claude text completion requires."""
+    if "\n\nHuman:" not in prompt:
+        prompt = "\n\nHuman: " + prompt
+    if "\n\nAssistant:" not in prompt:
+        prompt = prompt + "\n\nAssistant:"
+    return prompt
+
+
+def completion_body(model_id, prompt, model_kwargs):
+    if model_id.startswith("anthropic."):
+        return {"prompt": anthropic_prompt(prompt), **model_kwargs}
+    if model_id.startswith("amazon.titan"):
+        return {"inputText": prompt, "textGenerationConfig": model_kwargs}
+    raise ValueError(f"Streaming is not supported for {model_id}")
+
+
+def completion_text(model_id, payload):
+    if model_id.startswith("anthropic."):
+        return payload.get("completion", "")
+    return payload.get("outputText", "")
+
+
+def stream_completion(client, model_id, prompt, model_kwargs):
+    """Yield the completion for ``prompt`` piece by piece as Bedrock produces it."""
+    response = client.invoke_model_with_response_stream(
+        modelId=model_id,
+        body=json.dumps(completion_body(model_id, prompt, model_kwargs)),
+        accept="application/json",
+        contentType="application/json",
+    )
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk is None:
+            continue
+        text = completion_text(model_id, json.loads(chunk["bytes"]))
+        if text:
+            yield text
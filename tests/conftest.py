@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests run against the local stand-ins of the utils layer and the benchmark stubs,
+# no AWS account is needed.
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "layers", "utils_layer", "python"), os.path.join(ROOT, "benchmarks")]
+
+os.environ.update(
+    {
+        "BUCKET": "test-bucket",
+        "REGION": "us-east-1",
+        "BEDROCK_REGION": "us-east-1",
+        "OPENSEARCH_ENDPOINT": "localhost",
+        "BEDROCK_EMBEDDING_MODEL_ID": "amazon.titan-embed-text-v1",
+        "BEDROCK_TEXT_MODEL_ID": "anthropic.claude-instant-v1",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "test",
+        "AWS_SECRET_ACCESS_KEY": "test",
+        "POWERTOOLS_TRACE_DISABLED": "true",
+        "INGEST_QUEUE_URL": "local",
+        "FANOUT_UNIT_BYTES": "8000",
+    }
+)
+
+
+@pytest.fixture(scope="session")
+def stubs():
+    import stubs
+
+    return stubs
+
+
+@pytest.fixture(scope="session")
+def no_latency(stubs):
+    return stubs.Latency({stage: 0 for stage in stubs.DEFAULT_LATENCY})
+
+
+@pytest.fixture(scope="session")
+def index_data(stubs, no_latency):
+    """The index data lambda module, its clients served by the stubs."""
+    from assistant_utils.clients import registry
+
+    registry.credentials()
+    registry._clients["opensearch"] = stubs.StubOpenSearch(no_latency)
+    registry._clients[("s3", None)] = stubs.StubS3(no_latency)
+    registry._clients[("bedrock-runtime", os.environ["BEDROCK_REGION"])] = stubs.StubBedrock(no_latency)
+    path = os.path.join(ROOT, "lambdas", "index_data_lambda", "index_data_lambda.py")
+    spec = importlib.util.spec_from_file_location("index_data_lambda", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
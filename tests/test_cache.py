@@ -0,0 +1,69 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from assistant_utils.cache import InMemorySharedTier, LRUCache, SemanticAnswerCache, TieredCache
+
+PARAMS = {"model_id": "anthropic.claude-instant-v1", "prompt": "{question}"}
+CONTEXT = "\n<document>\nNet sales increased 11 percent.\n</document>"
+
+
+@pytest.fixture
+def shared():
+    return InMemorySharedTier(ttl=60)
+
+
+def container(shared, max_entries=8):
+    """The answer cache of one container, its LRU in front of the shared tier."""
+    return SemanticAnswerCache(TieredCache(LRUCache(ttl=60), shared), threshold=0.95, max_entries=max_entries)
+
+
+def unit(n, size=8):
+    return [1.0 if i == n else 0.0 for i in range(size)]
+
+
+def test_store_merges_answers_of_other_containers(shared):
+    first, second = container(shared), container(shared)
+    bucket = first.bucket_key("acme", PARAMS, CONTEXT)
+    # The second container reads the bucket into its LRU before the first one adds to it
+    assert second.lookup(bucket, unit(0)) == (None, None)
+
+    first.store(bucket, unit(0), "first answer")
+    second.store(bucket, unit(1), "second answer")
+
+    fresh = container(shared)
+    assert fresh.lookup(bucket, unit(0)) == ("first answer", 1.0)
+    assert fresh.lookup(bucket, unit(1)) == ("second answer", 1.0)
+
+
+def test_store_keeps_the_latest_entries(shared):
+    caches = [container(shared, max_entries=3) for _ in range(2)]
+    bucket = caches[0].bucket_key("acme", PARAMS, CONTEXT)
+    for n in range(5):
+        caches[n % 2].store(bucket, unit(n), f"answer {n}")
+
+    entries = shared.get(bucket)
+    assert [entry["result"] for entry in entries] == ["answer 2", "answer 3", "answer 4"]
+
+
+def test_lookup_needs_the_threshold(shared):
+    cache = container(shared)
+    bucket = cache.bucket_key("acme", PARAMS, CONTEXT)
+    cache.store(bucket, [1.0, 0.0], "answer")
+
+    assert cache.lookup(bucket, [1.0, 0.1])[0] == "answer"
+    assert cache.lookup(bucket, [1.0, 1.0]) == (None, None)
+
+
+def test_invalidate_reaches_every_container(shared):
+    first, second = container(shared), container(shared)
+    bucket = first.bucket_key("acme", PARAMS, CONTEXT)
+    first.store(bucket, unit(0), "answer")
+
+    second.invalidate("acme")
+
+    rebuilt = first.bucket_key("acme", PARAMS, CONTEXT)
+    assert rebuilt != bucket
+    assert first.lookup(rebuilt, unit(0)) == (None, None)
+    assert first.bucket_key("globex", PARAMS, CONTEXT) == second.bucket_key("globex", PARAMS, CONTEXT)
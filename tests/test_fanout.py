@@ -0,0 +1,194 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+
+import pytest
+
+from assistant_utils.fanout import InMemoryCheckpoints, InMemoryQueue
+
+INDEX = "acme_small_index"
+KEY = f"{INDEX}/report.txt"
+URL = f"s3://test-bucket/{KEY}"
+CHUNK_SIZE = 1000
+
+
+def report_text(paragraphs=150):
+    return "\n\n".join(
+        f"Paragraph {n}. Net sales increased {n % 17} percent to {100 + n} billion dollars in quarter {n % 4 + 1}. "
+        f"Operating income was {n * 3} million and free cash flow reached {n * 7} million over the period."
+        for n in range(paragraphs)
+    )
+
+
+def started(checkpoints, job="job", units=2):
+    checkpoints.start_job(job, {"units": units})
+    return job
+
+
+def test_claim_finalize_is_exclusive_until_released():
+    checkpoints = InMemoryCheckpoints()
+    job = started(checkpoints)
+    lease = checkpoints.claim_finalize(job, 300)
+    assert lease is not None
+    assert checkpoints.claim_finalize(job, 300) is None
+
+    checkpoints.release_finalize(job, lease)
+    assert checkpoints.claim_finalize(job, 300) is not None
+
+
+def test_release_keeps_a_newer_lease():
+    checkpoints = InMemoryCheckpoints()
+    job = started(checkpoints)
+    lapsed = checkpoints.claim_finalize(job, -1)
+    current = checkpoints.claim_finalize(job, 300)
+    assert current is not None
+
+    # The first worker gives its lapsed lease back after the second one claimed
+    checkpoints.release_finalize(job, lapsed)
+    assert checkpoints.claim_finalize(job, 300) is None
+    checkpoints.release_finalize(job, current)
+    assert checkpoints.claim_finalize(job, 300) is not None
+
+
+def test_finished_job_cannot_be_claimed():
+    checkpoints = InMemoryCheckpoints()
+    job = started(checkpoints)
+    lease = checkpoints.claim_finalize(job, 300)
+    checkpoints.finish_job(job, {"state": "DONE"})
+    checkpoints.release_finalize(job, lease)
+    assert checkpoints.claim_finalize(job, -1) is None
+    assert checkpoints.get_job(job)["result"] == {"state": "DONE"}
+
+
+def test_complete_unit_counts_each_unit_once():
+    checkpoints = InMemoryCheckpoints()
+    job = started(checkpoints)
+    assert checkpoints.complete_unit(job, 0) == 1
+    assert checkpoints.complete_unit(job, 0) == 1
+    assert checkpoints.complete_unit(job, 1) == 2
+    assert checkpoints.get_unit(job, 1)["done"]
+
+
+def test_queue_redelivers_then_dead_letters():
+    queue = InMemoryQueue(max_receives=2)
+    queue.send([{"unit": 0}, {"unit": 1}])
+    failures = {0: 1, 1: 5}
+
+    def handler(message):
+        if failures[message["unit"]]:
+            failures[message["unit"]] -= 1
+            raise RuntimeError("throttled")
+        return message["unit"]
+
+    assert queue.drain(handler) == [0]
+    assert len(queue.dead_letters) == 1
+    assert len(queue) == 0
+
+
+@pytest.fixture
+def ingest(index_data, stubs, no_latency, tmp_path, monkeypatch):
+    """The index data lambda with fresh stubs, checkpoints and local queue, and one report in S3."""
+    path = tmp_path / "report.txt"
+    path.write_text(report_text())
+    opensearch = stubs.StubOpenSearch(no_latency)
+    opensearch.indices.create(
+        INDEX,
+        body={
+            "mappings": {
+                "_meta": {"chunk_size": CHUNK_SIZE, "chunk_overlap": 0},
+                "properties": {"url": {"type": "text", "fields": {"keyword": {"type": "keyword"}}}},
+            }
+        },
+    )
+    monkeypatch.setattr(index_data, "opensearch", opensearch)
+    monkeypatch.setattr(index_data, "s3", stubs.StubS3(no_latency, {KEY: str(path)}))
+    monkeypatch.setattr(index_data, "checkpoints", InMemoryCheckpoints())
+    monkeypatch.setattr(index_data, "ingest_queue", InMemoryQueue())
+    monkeypatch.setattr(index_data, "embedding_batch_size", 2)
+    monkeypatch.setattr(index_data, "fanout_local_workers", 2)
+    index_data.forget_mappings(INDEX)
+    return index_data
+
+
+def expected_ids(module):
+    text = open(module.s3.files[KEY]).read()
+    return {hashlib.md5(chunk.encode()).hexdigest() for chunk in module.get_splitter(CHUNK_SIZE, 0).split_text(text)}
+
+
+def indexed_ids(module):
+    return set(module.opensearch.indices_data[INDEX]["docs"])
+
+
+def queued_units(module, monkeypatch):
+    """Plan the report into units and return their messages without running them."""
+    monkeypatch.setattr(module.ingest_queue, "local", False)
+    response = module.fan_out_document("test-bucket", KEY, INDEX)
+    return response, module.ingest_queue.drain(lambda message: message)
+
+
+def test_last_unit_finalizes_the_job(ingest, monkeypatch):
+    # A chunk of an older version of the report, the finalization removes it
+    ingest.opensearch.index(INDEX, "stale", {"text": "old", "url": URL, "vector_field": [0.0]})
+    finalized = []
+    finalize_job = ingest.finalize_job
+    monkeypatch.setattr(ingest, "finalize_job", lambda message: finalized.append(message["unit"]) or finalize_job(message))
+
+    response = ingest.fan_out_document("test-bucket", KEY, INDEX)
+
+    assert response["units"] > 1
+    assert response["state"] == "DONE"
+    assert response["dead_letters"] == 0
+    assert len(finalized) == 1
+    assert indexed_ids(ingest) == expected_ids(ingest)
+    assert ingest.checkpoints.get_job(response["job"])["result"]["deleted"] == 1
+
+
+def test_unit_resumes_after_its_last_checkpoint(ingest, monkeypatch):
+    # Without it the chunks already written would be skipped as indexed, not by the checkpoint
+    monkeypatch.setattr(ingest, "incremental_indexing", False)
+    _, messages = queued_units(ingest, monkeypatch)
+    message = max(messages, key=lambda message: message["end"] - message["start"])
+    embedded = []
+    embed_positions = ingest._embed_positions
+
+    def failing_third_batch(items, stats=None):
+        if len(embedded) == 2:
+            raise RuntimeError("throttled")
+        embedded.append([position for position, _ in items])
+        return embed_positions(items, stats)
+
+    monkeypatch.setattr(ingest, "_embed_positions", failing_third_batch)
+    with pytest.raises(RuntimeError):
+        ingest.process_unit(message)
+    checkpoint = ingest.checkpoints.get_unit(message["job"], message["unit"])
+    assert checkpoint == {"chunks_done": 4, "done": False}
+
+    resumed = []
+    monkeypatch.setattr(
+        ingest, "_embed_positions",
+        lambda items, stats=None: resumed.extend(position for position, _ in items) or embed_positions(items, stats),
+    )
+    result = ingest.process_unit(message)
+    assert result["state"] == "DONE"
+    assert min(resumed) == 4
+    assert ingest.checkpoints.get_unit(message["job"], message["unit"])["done"]
+
+
+def test_failed_finalization_releases_its_lease(ingest, monkeypatch):
+    attempts = []
+    finalize_job = ingest.finalize_job
+
+    def failing_once(message):
+        attempts.append(message["unit"])
+        if len(attempts) == 1:
+            raise RuntimeError("refresh timed out")
+        return finalize_job(message)
+
+    monkeypatch.setattr(ingest, "finalize_job", failing_once)
+    response = ingest.fan_out_document("test-bucket", KEY, INDEX)
+
+    assert len(attempts) == 2
+    assert response["state"] == "DONE"
+    assert response["dead_letters"] == 0
+    assert indexed_ids(ingest) == expected_ids(ingest)
@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from assistant_utils.local_store import LocalStoreCache, LocalVectorStore
+from assistant_utils.search import TEXT_FIELD, VECTOR_FIELD
+
+
+class CountingOpenSearch:
+    """Serves the first ``size`` of ``total`` documents and counts the searches."""
+
+    def __init__(self, total):
+        self.total = total
+        self.searches = 0
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+        hits = [
+            {"_id": str(n), "_source": {TEXT_FIELD: f"chunk {n}", VECTOR_FIELD: [float(n), 1.0], "url": "s3://b/k"}}
+            for n in range(min(body["size"], self.total))
+        ]
+        return {"hits": {"total": {"value": self.total, "relation": "eq"}, "hits": hits}}
+
+
+def test_from_opensearch_copies_max_docs_of_a_larger_index():
+    opensearch = CountingOpenSearch(total=5)
+    store = LocalVectorStore.from_opensearch(opensearch, "acme_performance", max_docs=3)
+
+    assert len(store) == 3
+    assert store.ids == ["0", "1", "2"]
+    assert store.metadatas[0] == {TEXT_FIELD: "chunk 0", "url": "s3://b/k"}
+    with pytest.raises(ValueError):
+        LocalVectorStore.from_opensearch(opensearch, "acme_performance", max_docs=3, complete=True)
+
+
+def test_cache_loads_a_small_index_once():
+    opensearch = CountingOpenSearch(total=2)
+    cache = LocalStoreCache(lambda: opensearch, max_docs=3)
+
+    store = cache.get("acme_performance")
+    assert len(store) == 2
+    assert cache.get("acme_performance") is store
+    assert opensearch.searches == 1
+
+
+def test_cache_remembers_an_oversized_index():
+    opensearch = CountingOpenSearch(total=5)
+    cache = LocalStoreCache(lambda: opensearch, max_docs=3)
+
+    for _ in range(2):
+        with pytest.raises(LookupError):
+            cache.get("acme_performance")
+    assert opensearch.searches == 1
+
+    # Copied again once the index fits, after an invalidation or the ttl
+    opensearch.total = 3
+    cache.invalidate("acme_performance")
+    assert len(cache.get("acme_performance")) == 3
+    assert opensearch.searches == 2
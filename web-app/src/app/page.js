@@ -73,6 +73,10 @@ export default async function Home() {
                   };
                 },
               },
+              // streaming response function URL, read by the chat context
+              ...(amplifyConfig.streamUrl
+                ? [{ name: "stream", endpoint: amplifyConfig.streamUrl }]
+                : []),
             ],
           },
         });
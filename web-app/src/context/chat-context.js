@@ -18,6 +18,7 @@
 
 import { createContext, useState } from "react";
 import { Auth, API } from "aws-amplify";
+import config from "../config.json";
 
 const ChatContext = createContext();
 
@@ -48,6 +49,59 @@ function listToOrString(list) {
 }
 
 
+// Plotly bar/line chart of the performance data returned by the retriever
+function buildGraph(data) {
+    if (!data || !("Annual Data" in data)) {
+        return "none";
+    }
+    let title = data.Label;
+    let data_years = data["Annual Data"].map(({ Date }) => Date);
+    let data_values = data["Annual Data"].map(({ Value }) =>
+        parseFloat(Value.split(" ")[0].substr(1))
+    ); //value is like "$45.23 Billion"
+    let data_growth = data["Annual Data"].map(({ Growth }) =>
+        parseFloat(Growth)
+    ); // value is like "83.21%"
+    switch (data["Annual Data"][0]["Value"].split(" ")[1]) {
+        case "Million":
+        case "M":
+            data_values = data_values.map((x) => x * 1000000);
+            break;
+        case "Billion":
+        case "B":
+            data_values = data_values.map((x) => x * 1000000000);
+            break;
+        default:
+            break;
+    }
+    return {
+        data: [
+            {
+                x: data_years,
+                y: data_values,
+                name: "Value",
+                type: "bar",
+                marker: { color: "rgb(2, 132, 199)" },
+            },
+            {
+                x: data_years,
+                y: data_growth,
+                name: "Growth",
+                yaxis: "y2",
+                type: "scatter",
+                mode: "lines+markers",
+                marker: { color: "rgb(125, 211, 252)" },
+            },
+        ],
+        layout: {
+            title: title,
+            xaxis: { title: "Year" },
+            yaxis: { title: "Value" },
+            yaxis2: { title: "Growth", overlaying: "y", side: "right" },
+        },
+    };
+}
+
 export const ChatProvider = ({ children }) => {
     const [messages, setMessages] = useState([]);
     const [input, setInput] = useState("");
@@ -73,6 +127,69 @@ export const ChatProvider = ({ children }) => {
         }
     };
 
+    // Streams the answer from the response function URL when one is configured,
+    // calling onToken with the text received so far. Resolves to the same payload
+    // as /api/response, which is used instead when streaming is not available.
+    const callResponseAPI = async (body, onToken) => {
+        let streamUrl = "";
+        try {
+            streamUrl = await API.endpoint("stream");
+        } catch (error) {
+            streamUrl = "";
+        }
+        if (!streamUrl) {
+            return callAPI(body, "/api/response");
+        }
+        try {
+            const session = await Auth.currentSession();
+            const response = await fetch(streamUrl, {
+                method: "POST",
+                headers: {
+                    "Content-Type": "application/json",
+                    Authorization: `Bearer ${session.getAccessToken().getJwtToken()}`,
+                },
+                body: JSON.stringify(body),
+            });
+            if (!response.ok) {
+                throw new Error(`Streaming request failed with status ${response.status}`);
+            }
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            let answer = "";
+            let result = "none";
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) {
+                    break;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split("\n");
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line) {
+                        continue;
+                    }
+                    const event = JSON.parse(line);
+                    if (event.type === "token") {
+                        answer += event.text;
+                        onToken(answer);
+                    } else if (event.type === "done") {
+                        const { type, ...payload } = event;
+                        result = payload;
+                    } else if (event.type === "error") {
+                        console.error("Streaming error:", event.error);
+                    }
+                }
+            }
+            console.log(result);
+            return result;
+        } catch (error) {
+            console.error("Streaming API call error:", error);
+            return "none";
+        }
+    };
+
     const setTempMessage = (message, content, validation) => {
         setMessages([
             ...messages,
@@ -103,8 +220,52 @@ export const ChatProvider = ({ children }) => {
         ]);
     };
 
+    // Runs classification, retrieval and generation with a single /api/ask call
+    const appendAsk = (message) => {
+        let val = {
+            step1: "working",
+            step2: "waiting",
+            step3: "waiting",
+            step4: "waiting",
+            step5: "waiting",
+            info: "",
+        };
+        setTempMessage(message, "Generating answer...", val);
+        callAPI({ message: message.content }, "/api/ask").then((askResponse) => {
+            if (askResponse === "none") {
+                val.step1 = "failed";
+                val.info =
+                    "Lambda Error: There seems to be an error in the pipeline. Please check the CloudWatch logs of your Ask Lambda to see what went wrong.";
+                setFinalMessage(
+                    message,
+                    "Validation failed, no answer received.",
+                    "Validation failed, no context received.",
+                    val,
+                    "none"
+                );
+                setIsLoading(false);
+                return;
+            }
+            if (askResponse.complete) {
+                setWsComplete(true);
+            }
+            setFinalMessage(
+                message,
+                askResponse.result,
+                askResponse.context,
+                askResponse.val,
+                buildGraph(askResponse.json)
+            );
+            setIsLoading(false);
+        });
+    };
+
     const append = (message) => {
         setIsLoading(true);
+        if (config.REACT_APP_USE_ASK_API) {
+            appendAsk(message);
+            return;
+        }
         let body = { message: message.content };
         let val = {
             step1: "working",
@@ -174,58 +335,8 @@ export const ChatProvider = ({ children }) => {
                                 return;
                             }
                             let chunks = retrieverResponse.response;
-                            if (
-                                "json" in retrieverResponse &&
-                                "Annual Data" in retrieverResponse.json
-                            ) {
-                                let data = retrieverResponse.json;
-                                let title = data.Label;
-                                let data_years = data["Annual Data"].map(({ Date }) => Date);
-                                let data_values = data["Annual Data"].map(({ Value }) =>
-                                    parseFloat(Value.split(" ")[0].substr(1))
-                                ); //value is like "$45.23 Billion"
-                                let data_growth = data["Annual Data"].map(({ Growth }) =>
-                                    parseFloat(Growth)
-                                ); // value is like "83.21%"
-                                switch (data["Annual Data"][0]["Value"].split(" ")[1]) {
-                                    case "Million":
-                                    case "M":
-                                        data_values = data_values.map((x) => x * 1000000);
-                                        break;
-                                    case "Billion":
-                                    case "B":
-                                        data_values = data_values.map((x) => x * 1000000000);
-                                        break;
-                                    default:
-                                        break;
-                                }
-                                data = [
-                                    {
-                                        x: data_years,
-                                        y: data_values,
-                                        name: "Value",
-                                        type: "bar",
-                                        marker: { color: "rgb(2, 132, 199)" },
-                                    },
-                                    {
-                                        x: data_years,
-                                        y: data_growth,
-                                        name: "Growth",
-                                        yaxis: "y2",
-                                        type: "scatter",
-                                        mode: "lines+markers",
-                                        marker: { color: "rgb(125, 211, 252)" },
-                                    },
-                                ];
-                                graph = {
-                                    data: data,
-                                    layout: {
-                                        title: title,
-                                        xaxis: { title: "Year" },
-                                        yaxis: { title: "Value" },
-                                        yaxis2: { title: "Growth", overlaying: "y", side: "right" },
-                                    },
-                                };
+                            if ("json" in retrieverResponse) {
+                                graph = buildGraph(retrieverResponse.json);
                             }
 
                             if (
@@ -250,7 +361,9 @@ export const ChatProvider = ({ children }) => {
                                 setTempMessage(message, "Generating answer...", val);
                             }
                             try {
-                                callAPI({ ...body, ...retrieverResponse }, "/api/response").then(
+                                callResponseAPI({ ...body, ...retrieverResponse }, (partial) =>
+                                    setTempMessage(message, partial, val)
+                                ).then(
                                     (generatorResponse) => {
                                         if (generatorResponse === "none") {
                                             val.step3 = "failed";